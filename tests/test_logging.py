@@ -1,4 +1,5 @@
 import unittest
+import shutil
 import time
 import json
 from pathlib import Path
@@ -8,18 +9,22 @@ class TestAuditLogging(unittest.TestCase):
     def setUp(self):
         # Clear the audit log before each test
         if AUDIT_LOG.exists():
-            AUDIT_LOG.unlink()
+            shutil.rmtree(AUDIT_LOG)
+        legacy = AUDIT_LOG.with_suffix('.json')
+        if legacy.exists():
+            legacy.unlink()
     
     def test_log_event_creates_file(self):
-        """Test that logging an event creates the audit log file"""
+        """Test that logging an event creates an audit log segment"""
         log_event('test_event', {'message': 'test'})
-        self.assertTrue(AUDIT_LOG.exists())
+        self.assertTrue((AUDIT_LOG / 'manifest.json').exists())
         
-        with open(AUDIT_LOG, 'r') as f:
-            data = json.load(f)
-            self.assertIn('events', data)
-            self.assertEqual(len(data['events']), 1)
-            self.assertEqual(data['events'][0]['type'], 'test_event')
+        segments = sorted(AUDIT_LOG.glob('segment-*.jsonl'))
+        self.assertEqual(len(segments), 1)
+        with open(segments[0], 'r') as f:
+            lines = f.readlines()
+            self.assertEqual(len(lines), 1)
+            self.assertEqual(json.loads(lines[0])['type'], 'test_event')
     
     def test_get_events_filtering(self):
         """Test retrieving events with different filters"""
@@ -1,31 +1,109 @@
-import json
 import os
-import hashlib
-import secrets
-import re
-from pathlib import Path
+from itertools import islice
+from typing import Iterable
 
-DB_PATH = Path(__file__).parent.parent / 'db' / 'users.json'
+# hashlib, hmac, re, secrets and the process pool are imported where they
+# are used: most CLI commands import this module without hashing anything.
 
-def _ensure_db_exists():
-    """Ensure the users database file exists."""
-    DB_PATH.parent.mkdir(exist_ok=True)
-    if not DB_PATH.exists():
-        with open(DB_PATH, 'w') as f:
-            json.dump({}, f)
+from whisperchain.metrics.instrument import span, timed
+from whisperchain.storage.engine import DB_DIR, get_engine, normalize_email, retry_on_conflict
+
+DB_PATH = DB_DIR / 'users.json'
+
+DARTMOUTH_EMAIL = r'^[a-zA-Z0-9._%+-]+@dartmouth\.edu$'
+# DARTMOUTH_EMAIL compiled on first use, which a bulk import makes per row
+_dartmouth_email = None
+VALID_ROLES = ['sender', 'receiver', 'moderator', 'admin']
+
+# Rows validated and hashed together by register_users_bulk
+BULK_BATCH_SIZE = 1000
+
+# Key derivation function for new password hashes: 'scrypt' or 'pbkdf2_sha256'
+# (defaults to scrypt where OpenSSL provides it)
+PASSWORD_KDF = os.environ.get('WHISPERCHAIN_KDF')
+
+# Cost parameters; passwords hashed with other parameters are rehashed at login
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+PBKDF2_ITERATIONS = 600_000
+
+def _password_scheme() -> tuple[str, tuple]:
+    """Return the scheme and parameters new password hashes use."""
+    kdf = PASSWORD_KDF
+    if kdf is None:
+        import hashlib
+        kdf = 'scrypt' if hasattr(hashlib, 'scrypt') else 'pbkdf2_sha256'
+    if kdf == 'scrypt':
+        return 'scrypt', (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    if kdf == 'pbkdf2_sha256':
+        return 'pbkdf2_sha256', (PBKDF2_ITERATIONS,)
+    raise ValueError(f"Unknown password KDF '{kdf}'")
+
+def _parse_password_hash(password_hash: str) -> tuple[str, tuple, str]:
+    """
+    Split a stored hash, ``scheme$param...$digest``, into its parts.
+    Hashes from before the KDF was introduced are a bare salted SHA-256 digest.
+    """
+    if '$' not in password_hash:
+        return 'sha256', (), password_hash
+    scheme, *params, digest = password_hash.split('$')
+    return scheme, tuple(map(int, params)), digest
+
+def _derive(password: str, salt: str, scheme: str, params: tuple) -> str:
+    import hashlib
+    with span('auth.hash_password', scheme):
+        if scheme == 'scrypt':
+            n, r, p = params
+            return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                                  maxmem=256 * n * r * p, dklen=32).hex()
+        if scheme == 'pbkdf2_sha256':
+            return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), params[0]).hex()
+        if scheme == 'sha256':
+            return hashlib.sha256((password + salt).encode()).hexdigest()
+    raise ValueError(f"Unknown password hash scheme '{scheme}'")
 
 def _hash_password(password: str, salt: str = None) -> tuple[str, str]:
-    """Hash a password with a salt."""
+    """Hash a password with a salt, returning the hash tagged with its scheme and parameters."""
     if salt is None:
+        import secrets
         salt = secrets.token_hex(16)
-    hashed = hashlib.sha256((password + salt).encode()).hexdigest()
+    scheme, params = _password_scheme()
+    hashed = '$'.join([scheme, *map(str, params), _derive(password, salt, scheme, params)])
     return hashed, salt
 
 def _validate_dartmouth_email(email: str) -> bool:
     # Validate that the email is a Dartmouth email address.
-    dartmouth_pattern = r'^[a-zA-Z0-9._%+-]+@dartmouth\.edu$'
-    return bool(re.match(dartmouth_pattern, email))
+    global _dartmouth_email
+    if _dartmouth_email is None:
+        import re
+        _dartmouth_email = re.compile(DARTMOUTH_EMAIL)
+    return bool(_dartmouth_email.match(email))
+
+def _validate_new_user(engine, username: str, role: str, email: str) -> None:
+    """Raise ValueError if a user with these details cannot be registered."""
+    _validate_user_details(role, email)
+    _check_not_taken(engine, username, email)
 
+def _validate_user_details(role: str, email: str) -> None:
+    """Raise ValueError if the email or role is not acceptable, without reading the store."""
+    # Validate email
+    if not _validate_dartmouth_email(email):
+        raise ValueError("Only Dartmouth email addresses (@dartmouth.edu) are allowed")
+    
+    # Validate role
+    if role.lower() not in VALID_ROLES:
+        raise ValueError("Invalid role. Must be one of: Sender, Receiver, Moderator, Admin")
+
+def _check_not_taken(engine, username: str, email: str) -> None:
+    """Raise ValueError if the username or email is already registered."""
+    # Check if username already exists
+    if engine.get_user(username) is not None:
+        raise ValueError("Username already exists")
+    
+    # Check if email already registered
+    if engine.find_user_by_email(email) is not None:
+        raise ValueError("Email address already registered")
+
+@timed('auth.register_user')
 def register_user(username: str, password: str, role: str, email: str) -> None:
     """
     Register a new user with the given credentials and role.
@@ -37,66 +115,208 @@ def register_user(username: str, password: str, role: str, email: str) -> None:
     Raises:
         ValueError: If the email is not a valid Dartmouth email or if other validations fail
     """
-    _ensure_db_exists()
-    
-    # Validate email
-    if not _validate_dartmouth_email(email):
-        raise ValueError("Only Dartmouth email addresses (@dartmouth.edu) are allowed")
-    
-    # Validate role
-    if role.lower() not in ['sender', 'receiver', 'moderator', 'admin']:
-        raise ValueError("Invalid role. Must be one of: Sender, Receiver, Moderator, Admin")
-    
-    # Load existing users
-    with open(DB_PATH, 'r') as f:
-        users = json.load(f)
-    
-    # Check if username already exists
-    if username in users:
-        raise ValueError("Username already exists")
-    
-    # Check if email already registered
-    for user_data in users.values():
-        if user_data.get('email') == email:
-            raise ValueError("Email address already registered")
-    
-    # Hash password and store user
+    # Validate before hashing, then hash outside the transaction so no lock
+    # is held meanwhile; register_user_hashed checks again when it commits
+    _validate_new_user(get_engine(), username, role, email)
     hashed_password, salt = _hash_password(password)
-    users[username] = {
+    register_user_hashed(username, hashed_password, salt, role, email)
+
+@retry_on_conflict
+def register_user_hashed(username: str, hashed_password: str, salt: str, role: str, email: str) -> None:
+    """
+    Register a new user whose password has already been hashed with _hash_password.
+    Raises:
+        ValueError: If the email is not a valid Dartmouth email or if other validations fail
+    """
+    engine = get_engine()
+    with engine.transaction():
+        _validate_new_user(engine, username, role, email)
+        _store_user(engine, username, hashed_password, salt, role, email)
+
+def _store_user(engine, username: str, hashed_password: str, salt: str, role: str, email: str) -> None:
+    engine.add_user(username, {
         'password_hash': hashed_password,
         'salt': salt,
         'role': role,
         'email': email
-    }
+    })
+
+@retry_on_conflict
+def _store_users(users: list) -> tuple[list, list]:
+    """
+    Store hashed users in one transaction, checking each against the store again.
+    Args:
+        users: List of (row number, username, password hash, salt, role, email)
+    Returns:
+        tuple: (stored usernames, list of (row number, username, error message))
+    """
+    engine = get_engine()
+    stored, rejected = [], []
+    with engine.transaction():
+        for row_number, username, hashed_password, salt, role, email in users:
+            try:
+                _validate_new_user(engine, username, role, email)
+            except ValueError as e:
+                rejected.append((row_number, username, str(e)))
+                continue
+            _store_user(engine, username, hashed_password, salt, role, email)
+            stored.append(username)
+    return stored, rejected
+
+@retry_on_conflict
+def _find_taken(users: list) -> dict:
+    """
+    Check a batch of users against the store in one transaction, so each
+    store file is read once per batch rather than once per user.
+    Args:
+        users: List of (row number, username, password, role, email)
+    Returns:
+        dict: Row number -> error message, for each user already registered
+    """
+    engine = get_engine()
+    taken = {}
+    with engine.transaction():
+        for row_number, username, _, _, email in users:
+            try:
+                _check_not_taken(engine, username, email)
+            except ValueError as e:
+                taken[row_number] = str(e)
+    return taken
+
+@timed('auth.register_users_bulk')
+def register_users_bulk(rows: Iterable[dict], workers: int = None,
+                        batch_size: int = BULK_BATCH_SIZE, first_row: int = 1) -> tuple[list, list]:
+    """
+    Register many users at once, e.g. from a class roster.
+    
+    Rows are read lazily and handled in batches; invalid rows are reported
+    without aborting the import. A batch's passwords are hashed across a
+    process pool before any lock is taken, and its users are then committed
+    in one storage transaction, retried on conflict. A row whose username or
+    email was taken by another writer meanwhile is reported like any other.
+    Args:
+        rows: Iterable of dicts with 'username', 'password', 'role' and 'email'
+        workers: Number of hashing processes (defaults to the CPU count; 1 hashes in-process)
+        batch_size: Number of rows validated, hashed and committed together
+        first_row: Number reported for the first row, for callers importing in chunks
+    Returns:
+        tuple: (registered usernames, list of (row number, username, error message))
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    registered, errors = [], []
+    pending_usernames, pending_emails = set(), set()
+    rows = enumerate(rows, first_row)
     
-    # Save updated users
-    with open(DB_PATH, 'w') as f:
-        json.dump(users, f, indent=4)
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = None
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            
+            # Validate each row's fields, then check the batch against the
+            # store in one read and against the rows already accepted
+            checked = []
+            for row_number, row in batch:
+                username = (row.get('username') or '').strip()
+                try:
+                    missing = [field for field in ('username', 'password', 'role', 'email')
+                               if not (row.get(field) or '').strip()]
+                    if missing:
+                        raise ValueError(f"Missing field(s): {', '.join(missing)}")
+                    role, email = row['role'].strip(), row['email'].strip()
+                    _validate_user_details(role, email)
+                except ValueError as e:
+                    errors.append((row_number, username, str(e)))
+                    continue
+                checked.append((row_number, username, row['password'], role, email))
+            
+            taken = _find_taken(checked)
+            accepted = []
+            for row_number, username, password, role, email in checked:
+                try:
+                    if row_number in taken:
+                        raise ValueError(taken[row_number])
+                    if username in pending_usernames:
+                        raise ValueError("Username already exists")
+                    if normalize_email(email) in pending_emails:
+                        raise ValueError("Email address already registered")
+                except ValueError as e:
+                    errors.append((row_number, username, str(e)))
+                    continue
+                pending_usernames.add(username)
+                pending_emails.add(normalize_email(email))
+                accepted.append((row_number, username, password, role, email))
+            
+            # Hash the accepted passwords in parallel, then store the users
+            passwords = [user[2] for user in accepted]
+            if pool is not None:
+                hashes = pool.map(_hash_password, passwords,
+                                  chunksize=max(1, len(passwords) // (workers * 4)))
+            else:
+                hashes = map(_hash_password, passwords)
+            users = [(row_number, username, hashed_password, salt, role, email)
+                     for (row_number, username, _, role, email), (hashed_password, salt)
+                     in zip(accepted, hashes)]
+            stored, rejected = _store_users(users)
+            registered.extend(stored)
+            errors.extend(rejected)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    
+    errors.sort(key=lambda error: error[0])
+    return registered, errors
 
+@timed('auth.login_user')
 def login_user(username: str, password: str) -> bool:
-    """Verify user credentials and return True if valid."""
-    if not DB_PATH.exists():
+    """
+    Verify user credentials and return True if valid.
+
+    A password stored with an older scheme or parameters is rehashed with
+    the current ones once it has been verified.
+    """
+    user = get_engine().get_user(username)
+    if user is None:
         return False
     
-    with open(DB_PATH, 'r') as f:
-        users = json.load(f)
-    
-    if username not in users:
+    if not _check_password(user, password):
         return False
     
-    user = users[username]
-    hashed_password, _ = _hash_password(password, user['salt'])
-    return hashed_password == user['password_hash']
+    if _needs_rehash(user):
+        hashed_password, salt = _hash_password(password)
+        _update_password_hash(username, user['password_hash'], hashed_password, salt)
+    return True
+
+def _check_password(user: dict, password: str) -> bool:
+    """Return True if a password matches a stored user record."""
+    import hmac
+    scheme, params, digest = _parse_password_hash(user['password_hash'])
+    return hmac.compare_digest(_derive(password, user['salt'], scheme, params), digest)
+
+def _needs_rehash(user: dict) -> bool:
+    """Return True if a user's password was hashed with other than the current scheme and parameters."""
+    scheme, params, _ = _parse_password_hash(user['password_hash'])
+    return (scheme, params) != _password_scheme()
+
+@retry_on_conflict
+def _update_password_hash(username: str, previous_hash: str, hashed_password: str, salt: str) -> None:
+    """Replace a user's password hash, unless it has changed since it was verified."""
+    engine = get_engine()
+    with engine.transaction():
+        user = engine.get_user(username)
+        if user is not None and user['password_hash'] == previous_hash:
+            engine.add_user(username, {**user, 'password_hash': hashed_password, 'salt': salt})
 
 def get_user_role(username: str) -> str:
     # Get the role of a user.
-    if not DB_PATH.exists():
-        raise ValueError("User database does not exist")
-    
-    with open(DB_PATH, 'r') as f:
-        users = json.load(f)
-    
-    if username not in users:
+    user = get_engine().get_user(username)
+    if user is None:
         raise ValueError("User does not exist")
     
-    return users[username]['role'] 
+    return user['role'] 
@@ -0,0 +1,168 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+
+from whisperchain.auth.register import get_user_role, login_user
+from whisperchain.metrics.instrument import timed
+from whisperchain.storage.engine import get_engine
+from whisperchain.storage.locking import FileLock
+
+KEY_FILE = 'session.key'
+REVOKED_FILE = 'session_revoked.json'
+
+# Seconds a session ticket stays valid after login
+SESSION_TTL = int(os.environ.get('WHISPERCHAIN_SESSION_TTL', 60 * 60))
+
+_authorities = {}
+_authorities_lock = threading.Lock()
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+class SessionAuthority:
+    """
+    Issues and verifies session tickets for one data directory.
+
+    A ticket is ``<payload>.<signature>``: the username, role, expiry and a
+    random session ID, signed with HMAC-SHA256 under a key kept in
+    ``db/session.key``. Verifying one takes a single HMAC and no store
+    reads. Revoked sessions are listed by ID with their expiry in
+    ``db/session_revoked.json``; entries are dropped once the ticket
+    would have expired anyway, so the list stays small.
+    """
+
+    def __init__(self, db_dir):
+        self.db_dir = Path(db_dir)
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(self.db_dir / 'session.lock')
+        self._key = None
+        self._revoked = (None, {})
+
+    def _signing_key(self) -> bytes:
+        if self._key is None:
+            path = self.db_dir / KEY_FILE
+            with self._lock, self._file_lock.exclusive():
+                if not path.exists():
+                    tmp = path.with_suffix('.tmp')
+                    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(secrets.token_bytes(32))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, path)
+                self._key = path.read_bytes()
+        return self._key
+
+    def _sign(self, payload: str) -> str:
+        return _encode(hmac.new(self._signing_key(), payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, username: str, role: str, ttl: int = None) -> str:
+        """Return a signed ticket for a user that has already been authenticated."""
+        expires_at = int(time.time()) + (SESSION_TTL if ttl is None else ttl)
+        payload = _encode(json.dumps({'u': username, 'r': role, 'e': expires_at, 'i': secrets.token_hex(8)},
+                                     separators=(',', ':')).encode())
+        return f'{payload}.{self._sign(payload)}'
+
+    def _open(self, ticket: str) -> dict:
+        """Check a ticket's signature and return its claims."""
+        payload, _, signature = ticket.partition('.')
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            raise ValueError("Invalid session ticket")
+        return json.loads(_decode(payload))
+
+    def _revoked_ids(self) -> dict:
+        path = self.db_dir / REVOKED_FILE
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return {}
+        stamp = stat.st_ino, stat.st_mtime_ns
+        if self._revoked[0] != stamp:
+            with open(path, 'r') as f:
+                self._revoked = (stamp, json.load(f))
+        return self._revoked[1]
+
+    def verify(self, ticket: str) -> dict:
+        """
+        Return the session a ticket stands for.
+        Returns:
+            dict: 'username', 'role', 'expires_at' and 'session_id'
+        Raises:
+            ValueError: If the ticket is forged, expired or revoked
+        """
+        claims = self._open(ticket)
+        if claims['e'] <= time.time():
+            raise ValueError("Session expired, please log in again")
+        if claims['i'] in self._revoked_ids():
+            raise ValueError("Session has been revoked")
+        return {'username': claims['u'], 'role': claims['r'], 'expires_at': claims['e'],
+                'session_id': claims['i']}
+
+    def revoke(self, ticket: str) -> None:
+        """Revoke a ticket before it expires."""
+        claims = self._open(ticket)
+        now = time.time()
+        path = self.db_dir / REVOKED_FILE
+        with self._lock, self._file_lock.exclusive():
+            revoked = {session_id: expires_at for session_id, expires_at in self._revoked_ids().items()
+                       if expires_at > now}
+            if claims['e'] > now:
+                revoked[claims['i']] = claims['e']
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(revoked, f, separators=(',', ':'))
+            os.replace(tmp, path)
+
+def get_authority(db_dir=None) -> SessionAuthority:
+    """Return the session authority for a data directory (defaults to the engine's)."""
+    path = Path(db_dir if db_dir is not None else get_engine().db_dir)
+    with _authorities_lock:
+        if path not in _authorities:
+            _authorities[path] = SessionAuthority(path)
+        return _authorities[path]
+
+@timed('auth.start_session')
+def start_session(username: str, password: str, ttl: int = None) -> str:
+    """
+    Log a user in and issue a session ticket for later commands.
+    Args:
+        username: The username for the account
+        password: The user's password
+        ttl: Seconds until the ticket expires (defaults to SESSION_TTL)
+    Returns:
+        str: The session ticket
+    Raises:
+        ValueError: If the credentials are invalid
+    """
+    if not login_user(username, password):
+        raise ValueError("Invalid credentials!")
+    return get_authority().issue(username, get_user_role(username), ttl)
+
+@timed('auth.verify_session')
+def verify_session(ticket: str) -> dict:
+    """
+    Verify a session ticket.
+    Returns:
+        dict: 'username', 'role', 'expires_at' and 'session_id'
+    Raises:
+        ValueError: If the ticket is forged, expired or revoked
+    """
+    return get_authority().verify(ticket)
+
+@timed('auth.revoke_session')
+def revoke_session(ticket: str) -> None:
+    """
+    Revoke a session ticket, e.g. on logout.
+    Raises:
+        ValueError: If the ticket is forged
+    """
+    get_authority().revoke(ticket)
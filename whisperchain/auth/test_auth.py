@@ -1,5 +1,13 @@
+import hashlib
+import time
 import unittest
-from whisperchain.auth.register import register_user, login_user, get_user_role
+from unittest import mock
+from whisperchain.auth import register
+from whisperchain.auth.register import register_user, register_users_bulk, login_user, get_user_role
+from whisperchain.auth.session import get_authority, revoke_session, start_session, verify_session
+from whisperchain.storage import json_store
+from whisperchain.storage.engine import open_engine
+from whisperchain.storage.testing import TempEngineTestCase
 
 class TestAuth(unittest.TestCase):
     def setUp(self):
@@ -50,5 +58,115 @@ class TestAuth(unittest.TestCase):
         # Test non-existent user
         self.assertIsNone(get_user_role("nonexistent"))
 
+class TestBulkRegistration(TempEngineTestCase):
+    def test_register_users_bulk(self):
+        register_user("existing", "password123", "Sender", "existing@dartmouth.edu")
+        rows = [
+            {"username": "bulk1", "password": "pw1", "role": "Sender", "email": "bulk1@dartmouth.edu"},
+            {"username": "bulk2", "password": "pw2", "role": "Receiver", "email": "bulk2@dartmouth.edu"},
+            {"username": "bulk3", "password": "pw3", "role": "Sender", "email": "bulk3@gmail.com"},
+            {"username": "bulk1", "password": "pw4", "role": "Sender", "email": "other@dartmouth.edu"},
+            {"username": "bulk5", "password": "pw5", "role": "Sender", "email": "EXISTING@dartmouth.edu"},
+            {"username": "bulk6", "password": "pw6", "role": "Janitor", "email": "bulk6@dartmouth.edu"},
+            {"username": "bulk7", "password": "", "role": "Sender", "email": "bulk7@dartmouth.edu"},
+        ]
+        registered, errors = register_users_bulk(iter(rows), workers=2, batch_size=3)
+        self.assertEqual(registered, ["bulk1", "bulk2"])
+        self.assertEqual([row for row, _, _ in errors], [3, 4, 5, 6, 7])
+        self.assertTrue(login_user("bulk1", "pw1"))
+        self.assertEqual(get_user_role("bulk2"), "Receiver")
+
+    def test_bulk_import_reads_store_once_per_batch(self):
+        register_user("existing", "password123", "Sender", "existing@dartmouth.edu")
+        rows = [{"username": f"bulk{i}", "password": "pw", "role": "Sender",
+                 "email": f"bulk{i}@dartmouth.edu"} for i in range(3000)]
+        rows.append({"username": "existing", "password": "pw", "role": "Sender",
+                     "email": "new@dartmouth.edu"})
+        with mock.patch.object(register, "_hash_password", lambda password: ("h", "s")), \
+                mock.patch.object(json_store, "decode_document", wraps=json_store.decode_document) as decode:
+            registered, errors = register_users_bulk(rows, workers=1, batch_size=1000)
+        self.assertEqual(len(registered), 3000)
+        self.assertEqual(errors, [(3001, "existing", "Username already exists")])
+        # A handful of documents per batch, not per row
+        self.assertLess(decode.call_count, 40)
+
+    def test_bulk_import_survives_concurrent_registration(self):
+        rows = [{"username": f"bulk{i}", "password": "pw", "role": "Sender",
+                 "email": f"bulk{i}@dartmouth.edu"} for i in range(4)]
+        hash_password = register._hash_password
+        peer = open_engine("json", self.tmp.name)
+        self.addCleanup(peer.close)
+
+        def hash_while_another_process_writes(password):
+            # Another process takes bulk2's email while the batch is hashed
+            if peer.find_user_by_email("bulk2@dartmouth.edu") is None:
+                peer.add_user("other", {"password_hash": "h", "salt": "s", "role": "Sender",
+                                        "email": "bulk2@dartmouth.edu"})
+            return hash_password(password)
+
+        with mock.patch.object(register, "_hash_password", hash_while_another_process_writes):
+            registered, errors = register_users_bulk(rows, workers=1, first_row=2)
+        self.assertEqual(registered, ["bulk0", "bulk1", "bulk3"])
+        self.assertEqual(errors, [(4, "bulk2", "Email address already registered")])
+        self.assertEqual(get_user_role("other"), "Sender")
+
+class TestPasswordHashing(TempEngineTestCase):
+    def test_legacy_hash_rehashed_on_login(self):
+        legacy = hashlib.sha256(("password123" + "salt").encode()).hexdigest()
+        self.engine.add_user("old", {"password_hash": legacy, "salt": "salt", "role": "Sender",
+                                     "email": "old@dartmouth.edu"})
+        self.assertFalse(login_user("old", "wrong"))
+        self.assertEqual(self.engine.get_user("old")["password_hash"], legacy)
+        self.assertTrue(login_user("old", "password123"))
+        self.assertTrue(self.engine.get_user("old")["password_hash"].startswith("scrypt$16384$8$1$"))
+        self.assertTrue(login_user("old", "password123"))
+
+    def test_kdf_change_rehashes(self):
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        with mock.patch.object(register, "PASSWORD_KDF", "pbkdf2_sha256"), \
+                mock.patch.object(register, "PBKDF2_ITERATIONS", 1000):
+            self.assertTrue(login_user("alice", "password123"))
+            self.assertEqual(self.engine.get_user("alice")["password_hash"].split("$")[:2],
+                             ["pbkdf2_sha256", "1000"])
+            self.assertTrue(login_user("alice", "password123"))
+            self.assertFalse(login_user("alice", "wrong"))
+
+class TestSessions(TempEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+
+    def test_ticket_verified_without_password(self):
+        ticket = start_session("alice", "password123")
+        with mock.patch.object(register, "_derive") as derive, \
+                mock.patch.object(self.engine, "get_user") as get_user:
+            session = verify_session(ticket)
+            derive.assert_not_called()
+            get_user.assert_not_called()
+        self.assertEqual((session["username"], session["role"]), ("alice", "Sender"))
+        with self.assertRaises(ValueError):
+            start_session("alice", "wrong")
+
+    def test_forged_expired_and_revoked_tickets(self):
+        ticket = start_session("alice", "password123")
+        payload, signature = ticket.split(".")
+        other = get_authority().issue("mallory", "Moderator")
+        with self.assertRaises(ValueError):
+            verify_session(other.split(".")[0] + "." + signature)
+        with self.assertRaises(ValueError):
+            verify_session(payload)
+        expired = get_authority().issue("alice", "Sender", ttl=-1)
+        with self.assertRaises(ValueError):
+            verify_session(expired)
+        revoke_session(ticket)
+        with self.assertRaises(ValueError):
+            verify_session(ticket)
+        # Revoking prunes entries whose tickets have expired anyway
+        revoke_session(expired)
+        with mock.patch("time.time", return_value=time.time() + 2 * 60 * 60):
+            revoke_session(other)
+        self.assertEqual(get_authority()._revoked_ids(), {})
+        self.assertTrue(verify_session(get_authority().issue("alice", "Sender")))
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
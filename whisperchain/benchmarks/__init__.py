@@ -0,0 +1,3 @@
+"""
+Benchmarks for WhisperChain+.
+"""
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+if __package__ in (None, ''):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+CLI = Path(__file__).resolve().parent.parent / 'cli.py'
+
+# Password of the fixture users created by prepare()
+PASSWORD = 'startup'
+
+# Command lines timed by default, built per run from the fixture prepare()
+# creates. Each command runs its operation to completion: sends spend a
+# fresh token and flags a fresh message every run. login includes hashing
+# the password, which the import time column leaves out.
+COMMANDS = {
+    'help': lambda fixture: ['--help'],
+    'register': lambda fixture: ['register', '--help'],
+    'login': lambda fixture: ['login', '--username', 'alice', '--password', PASSWORD],
+    'get-token': lambda fixture: ['get-token', '--session', fixture['sender']],
+    'send': lambda fixture: ['send', '--session', fixture['sender'], '--token', fixture['tokens'].pop(),
+                             '--message', 'm', '--receiver', 'bob'],
+    'view': lambda fixture: ['view', '--session', fixture['receiver']],
+    'flag': lambda fixture: ['flag', '--session', fixture['moderator'],
+                             '--message-id', str(fixture['messages'].pop())],
+    'list-flags': lambda fixture: ['list-flags', '--session', fixture['moderator']],
+}
+
+def prepare(db_dir: str, runs: int) -> dict:
+    """
+    Create what the timed commands act on: a sender, a receiver and a
+    moderator with session tickets, and enough tokens and messages for
+    ``runs`` sends and flags.
+    Returns:
+        dict: Session tickets under 'sender', 'receiver' and 'moderator',
+        unused 'tokens' and unflagged 'messages'
+    """
+    from whisperchain.auth.register import register_user
+    from whisperchain.auth.session import get_authority
+    from whisperchain.messaging.send import send_message
+    from whisperchain.storage.engine import open_engine, set_engine
+    from whisperchain.tokens.generate import generate_tokens
+
+    engine = open_engine('json', db_dir)
+    previous = set_engine(engine)
+    try:
+        fixture = {}
+        for username, role in (('alice', 'Sender'), ('bob', 'Receiver'), ('mod', 'Moderator')):
+            register_user(username, PASSWORD, role, f'{username}@dartmouth.edu')
+            fixture[role.lower()] = get_authority(db_dir).issue(username, role)
+        engine.add_receiver('bob')
+        tokens = generate_tokens('alice', 2 * runs)
+        fixture['messages'] = [send_message('alice', tokens.pop(), 'Hello', 'bob') for _ in range(runs)]
+        fixture['tokens'] = tokens
+    finally:
+        set_engine(previous)
+        engine.close()
+    return fixture
+
+def parse_importtime(stderr: str) -> list:
+    """
+    Parse the report written by ``python -X importtime``.
+    Returns:
+        list: (module, self microseconds, cumulative microseconds), in import order
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+def time_command(command, fixture: dict, db_dir: str, runs: int) -> dict:
+    """
+    Start the CLI ``runs`` times with one command.
+    Args:
+        command: Function building the arguments passed to cli.py from the fixture
+        fixture: What prepare() created in ``db_dir``
+        db_dir: Data directory the command runs against
+        runs: Number of cold starts to time
+    Returns:
+        dict: Median and best wall time in ms, import time in ms, the
+        imports of the last run as parsed by parse_importtime, and the
+        number of runs that exited with an error
+    """
+    env = dict(os.environ, WHISPERCHAIN_DB_DIR=db_dir,
+               WHISPERCHAIN_SOCKET=str(Path(db_dir) / 'none.sock'))
+    env.pop('WHISPERCHAIN_SESSION', None)
+    walls, imports, failures = [], [], 0
+    for _ in range(runs):
+        argv = command(fixture)
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', str(CLI), *argv],
+                                env=env, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+        walls.append((time.perf_counter() - start) * 1000)
+        imports = parse_importtime(result.stderr)
+        failures += result.returncode != 0
+    return {
+        'median_ms': statistics.median(walls),
+        'best_ms': min(walls),
+        'import_ms': sum(self_us for _, self_us, _ in imports) / 1000,
+        'imports': imports,
+        'failures': failures,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Time WhisperChain+ CLI startup per command')
+    parser.add_argument('commands', nargs='*', metavar='command',
+                        help=f"Commands to time (default: all of {', '.join(COMMANDS)})")
+    parser.add_argument('--runs', type=int, default=5, help='Cold starts timed per command')
+    parser.add_argument('--top', type=int, default=0,
+                        help='Also list the N slowest imports of each command')
+    args = parser.parse_args()
+    unknown = [name for name in args.commands if name not in COMMANDS]
+    if unknown:
+        parser.error(f"unknown command(s): {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        fixture = prepare(db_dir, args.runs)
+        print(f"{'command':<12} {'median ms':>10} {'best ms':>9} {'imports ms':>11} {'modules':>8}")
+        for name in args.commands or COMMANDS:
+            report = time_command(COMMANDS[name], fixture, db_dir, args.runs)
+            print(f"{name:<12} {report['median_ms']:>10.1f} {report['best_ms']:>9.1f} "
+                  f"{report['import_ms']:>11.1f} {len(report['imports']):>8}"
+                  + (f"  ({report['failures']} runs failed)" if report['failures'] else ''))
+            slowest = sorted(report['imports'], key=lambda entry: entry[1], reverse=True)
+            for module, self_us, cumulative_us in slowest[:args.top]:
+                print(f"    {module:<40} {self_us / 1000:>7.1f} ms self {cumulative_us / 1000:>7.1f} ms total")
+
+if __name__ == '__main__':
+    main()
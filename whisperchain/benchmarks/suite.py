@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module; peak RSS is not reported there
+    resource = None
+
+if __package__ in (None, ''):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from whisperchain.auth.register import register_user
+from whisperchain.benchmarks.workload import DAY, EPOCH, EVENT_TYPES, PASSWORD, SIZES, add_user, populate
+from whisperchain.logging.audit import get_events
+from whisperchain.messaging.flag import flag_message
+from whisperchain.messaging.send import get_receiver_messages, mark_message_read, send_message
+from whisperchain.rbac.access_control import PERMISSION_BITS, check_permission
+from whisperchain.storage.engine import BACKENDS, get_engine, open_engine, set_engine
+from whisperchain.tokens.generate import generate_token
+
+# Calls timed per operation and data set size by default
+ITERATIONS = 200
+
+# Slowdown over the baseline reported as a regression by default
+THRESHOLD = 0.25
+
+# Result fields compared with the baseline, and whether higher is better (p99
+# is left out: with a few hundred calls it moves with a handful of outliers)
+COMPARED = {'p50_ms': False, 'p95_ms': False, 'ops_per_sec': True}
+
+def _register(population, rng, i):
+    username = f'bench{i}'
+    return register_user, (username, PASSWORD, 'Sender', f'{username}@dartmouth.edu')
+
+def _generate_token(population, rng, i):
+    # Every populated sender already holds unused tokens, which generate_token
+    # would hand back; a new sender with none makes each call issue one
+    username = f'tokenless{i}'
+    add_user(get_engine(), username, 'sender')
+    return generate_token, (username,)
+
+def _send_message(population, rng, i):
+    sender = rng.choice([sender for sender, tokens in population['tokens'].items() if tokens])
+    token = population['tokens'][sender].pop()
+    return send_message, (sender, token, f'benchmark {i}', rng.choice(population['receivers']))
+
+def _view(population, rng, i):
+    return (lambda username: list(get_receiver_messages(username))), (rng.choice(population['receivers']),)
+
+def _mark_read(population, rng, i):
+    receiver = rng.choice([receiver for receiver, inbox in population['inbox'].items() if inbox])
+    return mark_message_read, (receiver, rng.choice(population['inbox'][receiver]))
+
+def _flag(population, rng, i):
+    unflagged = population['unflagged']
+    message_id = unflagged.pop(rng.randrange(len(unflagged)))
+    return flag_message, (rng.choice(population['moderators']), message_id)
+
+def _check_permission(population, rng, i):
+    username = rng.choice(population[rng.choice(['senders', 'receivers', 'moderators'])])
+    return check_permission, (username, rng.choice(list(PERMISSION_BITS)))
+
+def _get_events(population, rng, i):
+    start = rng.randrange(EPOCH, EPOCH + DAY)
+    return get_events, (rng.choice(EVENT_TYPES), start, start + 60 * 60)
+
+# Operations timed, in order, each returning (function, arguments) for its i-th call.
+# Arguments are chosen before the clock starts.
+OPERATIONS = {
+    'register_user': _register,
+    'generate_token': _generate_token,
+    'send_message': _send_message,
+    'get_receiver_messages': _view,
+    'mark_message_read': _mark_read,
+    'flag_message': _flag,
+    'check_permission': _check_permission,
+    'get_events': _get_events,
+}
+
+def percentile(samples: list, fraction: float) -> float:
+    """Return the nearest-rank percentile of sorted samples."""
+    return samples[max(0, math.ceil(fraction * len(samples)) - 1)]
+
+def summarize(samples_ns: list) -> dict:
+    """
+    Summarize the durations of one operation's calls.
+    Returns:
+        dict: 'calls', 'p50_ms', 'p95_ms', 'p99_ms' and 'ops_per_sec'
+    """
+    samples = sorted(samples_ns)
+    total = sum(samples) or 1
+    return {
+        'calls': len(samples),
+        'p50_ms': percentile(samples, 0.50) / 1e6,
+        'p95_ms': percentile(samples, 0.95) / 1e6,
+        'p99_ms': percentile(samples, 0.99) / 1e6,
+        'ops_per_sec': len(samples) / (total / 1e9),
+    }
+
+def peak_rss_kb():
+    """Return this process's peak resident set size in KiB, or None where it is unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def run_size(size: str, backend: str, seed: int, iterations: int, operations: list) -> dict:
+    """
+    Populate a fresh store at one data set size and time the operations against it.
+    Args:
+        size: Key of SIZES
+        backend: Storage backend to use
+        seed: Seed for the workload and the arguments of each call
+        iterations: Calls timed per operation
+        operations: Names of the operations to time, keys of OPERATIONS
+    Returns:
+        dict: 'size', 'counts', 'populate_s', 'operations' ({name: summarize()}) and 'peak_rss_kb'
+    """
+    counts = SIZES[size]
+    with tempfile.TemporaryDirectory() as db_dir:
+        engine = open_engine(backend, db_dir)
+        previous = set_engine(engine)
+        try:
+            start = time.perf_counter()
+            population = populate(engine, seed=seed, **counts)
+            populate_s = time.perf_counter() - start
+            rng = random.Random(seed)
+            results = {}
+            for name in operations:
+                samples = []
+                for i in range(iterations):
+                    try:
+                        function, args = OPERATIONS[name](population, rng, i)
+                    except (IndexError, ValueError):
+                        break  # the data set has run out of e.g. unflagged messages
+                    start = time.perf_counter_ns()
+                    function(*args)
+                    samples.append(time.perf_counter_ns() - start)
+                if samples:
+                    results[name] = summarize(samples)
+        finally:
+            set_engine(previous)
+            engine.close()
+    return {'size': size, 'counts': counts, 'populate_s': populate_s, 'operations': results,
+            'peak_rss_kb': peak_rss_kb()}
+
+def compare(results: dict, baseline: dict, threshold: float = THRESHOLD) -> list:
+    """
+    Find the results that are worse than a baseline run.
+    Args:
+        results: Output of this suite
+        baseline: Output of an earlier run
+        threshold: Fraction by which a result may be worse before it is reported
+    Returns:
+        list: (size, operation, field, baseline value, current value) per regression
+    """
+    previous = {run['size']: run['operations'] for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        for name, summary in run['operations'].items():
+            before = previous.get(run['size'], {}).get(name)
+            if before is None:
+                continue
+            for field, higher_is_better in COMPARED.items():
+                old, new = before[field], summary[field]
+                worse = new < old / (1 + threshold) if higher_is_better else new > old * (1 + threshold)
+                if worse:
+                    regressions.append((run['size'], name, field, old, new))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WhisperChain+ operations on synthetic data')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES),
+                        help='Data set sizes to run, smallest first')
+    parser.add_argument('--operations', nargs='+', default=list(OPERATIONS), choices=list(OPERATIONS),
+                        help='Operations to time')
+    parser.add_argument('--backend', default='json', choices=BACKENDS, help='Storage backend')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic workload')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS, help='Calls timed per operation')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Fraction by which a result may be worse than the baseline')
+    args = parser.parse_args()
+
+    results = {
+        'backend': args.backend,
+        'seed': args.seed,
+        'iterations': args.iterations,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': [],
+    }
+    print(f"{'size':<8} {'operation':<22} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/sec':>10}")
+    for size in args.sizes:
+        # Each size runs in a fresh process so its peak RSS is its own
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            run = pool.submit(run_size, size, args.backend, args.seed, args.iterations,
+                              args.operations).result()
+        results['runs'].append(run)
+        for name, summary in run['operations'].items():
+            print(f"{size:<8} {name:<22} {summary['calls']:>6} {summary['p50_ms']:>9.3f} "
+                  f"{summary['p95_ms']:>9.3f} {summary['p99_ms']:>9.3f} {summary['ops_per_sec']:>10.1f}")
+        print(f"{size:<8} populated in {run['populate_s']:.2f}s, peak RSS {run['peak_rss_kb']} KiB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for size, name, field, old, new in regressions:
+            print(f"REGRESSION {size} {name} {field}: {old:.3f} -> {new:.3f}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+from whisperchain.benchmarks.startup import COMMANDS, prepare, time_command
+from whisperchain.benchmarks.suite import OPERATIONS, compare, run_size, summarize
+from whisperchain.benchmarks.workload import populate
+from whisperchain.storage.engine import open_engine, set_engine
+
+SIZE = {'users': 20, 'tokens': 30, 'messages': 40, 'flags': 5, 'events': 50}
+
+class TestWorkload(unittest.TestCase):
+    def _populate(self, seed):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = open_engine("json", tmp)
+            try:
+                population = populate(engine, seed=seed, **SIZE)
+                queues = {receiver: engine.get_queue(receiver) for receiver in population['receivers']}
+                events = list(engine.iter_events())
+            finally:
+                engine.close()
+        return population, queues, events
+
+    def test_same_seed_same_data(self):
+        self.assertEqual(self._populate(1), self._populate(1))
+        self.assertNotEqual(self._populate(1)[1], self._populate(2)[1])
+
+    def test_sizes(self):
+        population, queues, events = self._populate(0)
+        self.assertEqual(sum(map(len, population['tokens'].values())), SIZE['tokens'])
+        self.assertEqual(sum(map(len, queues.values())), SIZE['messages'])
+        self.assertEqual(len(population['unflagged']), SIZE['messages'] - SIZE['flags'])
+        self.assertEqual(len(events), SIZE['events'])
+
+class TestSuite(unittest.TestCase):
+    def test_summarize(self):
+        summary = summarize([i * 1_000_000 for i in range(1, 101)])
+        self.assertEqual((summary['p50_ms'], summary['p95_ms'], summary['p99_ms']), (50, 95, 99))
+        self.assertEqual(summary['calls'], 100)
+
+    def test_compare_reports_regressions(self):
+        def results(p50, ops_per_sec):
+            return {'runs': [{'size': 'small', 'operations': {
+                'send_message': {'p50_ms': p50, 'p95_ms': p50, 'p99_ms': p50, 'ops_per_sec': ops_per_sec}}}]}
+        baseline = results(10, 100)
+        self.assertEqual(compare(results(11, 95), baseline), [])
+        self.assertEqual(compare(results(20, 100), baseline, 0.5),
+                         [('small', 'send_message', 'p50_ms', 10, 20), ('small', 'send_message', 'p95_ms', 10, 20)])
+        self.assertEqual(compare(results(10, 50), baseline), [('small', 'send_message', 'ops_per_sec', 100, 50)])
+
+    def test_run_size(self):
+        run = run_size('small', 'json', 0, 3, ['check_permission', 'get_receiver_messages'])
+        self.assertEqual(set(run['operations']), {'check_permission', 'get_receiver_messages'})
+        self.assertEqual(run['operations']['check_permission']['calls'], 3)
+
+    def test_generate_token_issues(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = open_engine("json", tmp)
+            previous = set_engine(engine)
+            try:
+                population = populate(engine, **SIZE)
+                function, args = OPERATIONS['generate_token'](population, None, 0)
+                self.assertIsNone(engine.find_unused_token(*args))
+                token = function(*args)
+                self.assertEqual(engine.get_token(token)['username'], args[0])
+            finally:
+                set_engine(previous)
+                engine.close()
+
+class TestStartup(unittest.TestCase):
+    def test_commands_complete(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fixture = prepare(tmp, 1)
+            failures = {name: time_command(command, fixture, tmp, 1)['failures']
+                        for name, command in COMMANDS.items()}
+        self.assertEqual(failures, dict.fromkeys(COMMANDS, 0))
+
+if __name__ == "__main__":
+    unittest.main()
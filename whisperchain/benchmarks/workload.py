@@ -0,0 +1,113 @@
+import random
+from functools import lru_cache
+
+from whisperchain.auth.register import _hash_password
+
+# Data set sizes timed by the benchmark suite
+SIZES = {
+    'small': {'users': 100, 'tokens': 500, 'messages': 1_000, 'flags': 100, 'events': 2_000},
+    'medium': {'users': 1_000, 'tokens': 5_000, 'messages': 10_000, 'flags': 1_000, 'events': 20_000},
+    'large': {'users': 10_000, 'tokens': 50_000, 'messages': 100_000, 'flags': 10_000, 'events': 200_000},
+}
+
+# Every generated user has this password
+PASSWORD = 'benchmark'
+
+# Generated messages and events fall in the day after this timestamp; tokens
+# expire long after it, so the data is identical from run to run
+EPOCH = 1_700_000_000
+DAY = 24 * 60 * 60
+TOKEN_EXPIRY = EPOCH + 20 * 365 * DAY
+
+EVENT_TYPES = ['registration', 'login', 'token_generation', 'message_sent',
+               'messages_viewed', 'message_flagged']
+
+def _token(rng: random.Random) -> str:
+    return rng.getrandbits(192).to_bytes(24, 'big').hex()
+
+@lru_cache(maxsize=None)
+def _password() -> tuple:
+    return _hash_password(PASSWORD, 'benchmark-salt')
+
+def add_user(engine, username: str, role: str) -> None:
+    """Store a user with the benchmark password, without hashing it again."""
+    password_hash, salt = _password()
+    engine.add_user(username, {
+        'password_hash': password_hash,
+        'salt': salt,
+        'role': role.capitalize(),
+        'email': f'{username}@dartmouth.edu'
+    })
+
+def populate(engine, users: int, tokens: int, messages: int, flags: int, events: int,
+             seed: int = 0) -> dict:
+    """
+    Fill an empty store with a reproducible synthetic data set.
+
+    Records are written straight through the storage engine in one
+    transaction, so populating does not hash a password per user. The same
+    sizes and seed always produce the same data.
+    Args:
+        engine: The storage engine to fill
+        users: Number of users; half senders, 40% receivers, 10% moderators
+        tokens: Number of unused tokens, spread over the senders
+        messages: Number of messages, each sent with its own (used) token
+        flags: Number of messages flagged by moderators
+        events: Number of audit log events
+        seed: Seed for the random choices
+    Returns:
+        dict: What was generated, for picking operation arguments:
+              'senders', 'receivers', 'moderators', 'tokens' ({sender: [token, ...]}),
+              'inbox' ({receiver: [message_id, ...]}) and 'unflagged' (message IDs)
+    Raises:
+        ValueError: If there are more flags than messages
+    """
+    if flags > messages:
+        raise ValueError("Cannot flag more messages than there are")
+    rng = random.Random(seed)
+    moderators = max(1, users // 10)
+    receivers = max(1, users * 4 // 10)
+    senders = max(1, users - moderators - receivers)
+    roles = {'sender': senders, 'receiver': receivers, 'moderator': moderators}
+    population = {role + 's': [f'{role}{i}' for i in range(count)] for role, count in roles.items()}
+    population['tokens'] = {sender: [] for sender in population['senders']}
+    population['inbox'] = {receiver: [] for receiver in population['receivers']}
+
+    with engine.transaction():
+        for role in roles:
+            for username in population[role + 's']:
+                add_user(engine, username, role)
+        for receiver in population['receivers']:
+            engine.add_receiver(receiver)
+
+        for _ in range(tokens):
+            sender, token = rng.choice(population['senders']), _token(rng)
+            engine.add_token(token, {'username': sender, 'created_at': EPOCH,
+                                     'expires_at': TOKEN_EXPIRY, 'used': False})
+            population['tokens'][sender].append(token)
+
+        timestamps = sorted(rng.randrange(EPOCH, EPOCH + DAY) for _ in range(messages))
+        message_ids = []
+        for timestamp in timestamps:
+            sender, receiver = rng.choice(population['senders']), rng.choice(population['receivers'])
+            token = _token(rng)
+            engine.add_token(token, {'username': sender, 'created_at': EPOCH,
+                                     'expires_at': TOKEN_EXPIRY, 'used': True})
+            message_id = engine.add_message({'content': f'message {len(message_ids)}', 'token': token,
+                                             'created_at': timestamp, 'flagged': False, 'read_by': []})
+            engine.append_to_queue(receiver, {'message_id': str(message_id), 'received_at': timestamp,
+                                              'read': rng.random() < 0.5})
+            message_ids.append(str(message_id))
+            population['inbox'][receiver].append(str(message_id))
+
+        flagged = set(rng.sample(message_ids, flags))
+        for message_id in sorted(flagged, key=int):
+            engine.add_flag({'message_id': message_id, 'moderator': rng.choice(population['moderators']),
+                             'created_at': EPOCH + DAY})
+            engine.set_message_flagged(message_id)
+        population['unflagged'] = [message_id for message_id in message_ids if message_id not in flagged]
+
+    for timestamp in sorted(rng.randrange(EPOCH, EPOCH + DAY) for _ in range(events)):
+        engine.append_event({'timestamp': timestamp, 'type': rng.choice(EVENT_TYPES),
+                             'data': {'username': rng.choice(population['senders'])}})
+    return population
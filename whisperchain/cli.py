@@ -1,15 +1,47 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
-from auth.register import register_user, login_user
-from tokens.generate import generate_token
-from messaging.send import send_message, get_receiver_messages, mark_message_read
-from messaging.flag import flag_message
-from rbac.access_control import check_permission
-from logging.audit import log_event
+from pathlib import Path
+
+# Running ``python cli.py`` puts this directory on sys.path, where the
+# ``logging`` package would shadow the standard library; import from the
+# parent directory instead.
+if __package__ in (None, ''):
+    sys.path[0] = str(Path(__file__).resolve().parent.parent)
+
+# Keep imports here to what parsing arguments needs: each command imports
+# the modules behind its operations when it first calls them (see
+# server/operations.py), so e.g. ``login`` never loads the messaging code.
+from whisperchain.server.client import SOCKET_PATH, LocalClient, connect
+
+def add_credentials(parser: argparse.ArgumentParser) -> None:
+    """Add the options a command authenticates with."""
+    parser.add_argument('--session', default=os.environ.get('WHISPERCHAIN_SESSION'),
+                        help='Session ticket from login (defaults to $WHISPERCHAIN_SESSION)')
+    parser.add_argument('--username', help='Username (with --password, instead of a session)')
+    parser.add_argument('--password', help='Password')
+
+def authenticate(api, args) -> None:
+    """
+    Check who is running a command, setting ``args.username``.
+    Raises:
+        ValueError: If the session or the credentials are not valid
+    """
+    if args.session:
+        username = api.verify_session(args.session)['username']
+        if args.username and args.username != username:
+            raise ValueError("Session belongs to another user")
+        args.username = username
+    elif not (args.username and args.password):
+        raise ValueError("Log in first (--session), or pass --username and --password")
+    elif not api.login_user(args.username, args.password):
+        raise ValueError("Invalid credentials!")
 
 def main():
     parser = argparse.ArgumentParser(description='WhisperChain+ CLI')
+    parser.add_argument('--socket', default=str(SOCKET_PATH),
+                        help='Daemon socket; commands run in-process if no daemon is listening')
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
 
     # Register command
@@ -19,35 +51,76 @@ def main():
     register_parser.add_argument('--role', required=True, choices=['Sender', 'Receiver', 'Moderator'], help='User role')
     register_parser.add_argument('--email', required=True, help='Dartmouth email address (@dartmouth.edu)')
 
+    # Import users command
+    import_parser = subparsers.add_parser('import-users', help='Register users in bulk from a CSV roster')
+    import_parser.add_argument('--csv', required=True, help='CSV file with username,password,role,email columns')
+    import_parser.add_argument('--workers', type=int, help='Number of password hashing processes')
+
     # Login command
     login_parser = subparsers.add_parser('login', help='Login to the system')
     login_parser.add_argument('--username', required=True, help='Username')
     login_parser.add_argument('--password', required=True, help='Password')
+    login_parser.add_argument('--ttl', type=int, help='Seconds until the session ticket expires')
+
+    # Logout command
+    logout_parser = subparsers.add_parser('logout', help='Revoke a session ticket')
+    logout_parser.add_argument('--session', default=os.environ.get('WHISPERCHAIN_SESSION'),
+                               help='Session ticket (defaults to $WHISPERCHAIN_SESSION)')
 
     # Get token command
     token_parser = subparsers.add_parser('get-token', help='Get an anonymous token')
-    token_parser.add_argument('--username', required=True, help='Username')
-    token_parser.add_argument('--password', required=True, help='Password')
+    add_credentials(token_parser)
+    token_parser.add_argument('--count', type=int, default=1, help='Number of new tokens to issue')
 
     # Send message command
     send_parser = subparsers.add_parser('send', help='Send a message')
-    send_parser.add_argument('--username', required=True, help='Username')
-    send_parser.add_argument('--password', required=True, help='Password')
+    add_credentials(send_parser)
     send_parser.add_argument('--token', required=True, help='Anonymous token')
     send_parser.add_argument('--message', required=True, help='Message content')
     send_parser.add_argument('--receiver', required=True, help='Receiver username')
 
     # View messages command
     view_parser = subparsers.add_parser('view', help='View messages')
-    view_parser.add_argument('--username', required=True, help='Username')
-    view_parser.add_argument('--password', required=True, help='Password')
+    add_credentials(view_parser)
     view_parser.add_argument('--mark-read', action='store_true', help='Mark messages as read')
+    view_parser.add_argument('--unread-only', action='store_true', help='Only show unread messages')
+    view_parser.add_argument('--since-id', type=int, help='Only show messages after this message ID')
+    view_parser.add_argument('--page-size', type=int, help='Messages shown per page')
 
     # Flag message command
     flag_parser = subparsers.add_parser('flag', help='Flag a message')
-    flag_parser.add_argument('--username', required=True, help='Username')
-    flag_parser.add_argument('--password', required=True, help='Password')
-    flag_parser.add_argument('--message-id', required=True, help='Message ID to flag')
+    add_credentials(flag_parser)
+    flag_parser.add_argument('--message-id', required=True, nargs='+', help='Message ID(s) to flag')
+
+    # Moderation queue commands
+    flags_parser = subparsers.add_parser('list-flags', help='List flagged messages')
+    add_credentials(flags_parser)
+    flags_parser.add_argument('--since', type=int, help='Only list flags created at or after this timestamp')
+    flags_parser.add_argument('--moderator', help='Only list flags raised by this moderator')
+    flags_parser.add_argument('--limit', type=int, help='Maximum number of flags to list')
+
+    unreviewed_parser = subparsers.add_parser('list-unreviewed', help='List messages not yet flagged')
+    add_credentials(unreviewed_parser)
+    unreviewed_parser.add_argument('--since-id', type=int, help='Only list messages after this message ID')
+    unreviewed_parser.add_argument('--limit', type=int, help='Maximum number of messages to list')
+
+    # Daemon command
+    serve_parser = subparsers.add_parser('serve', help='Run the WhisperChain+ daemon')
+    serve_parser.add_argument('--socket', default=str(SOCKET_PATH), help='Unix socket to listen on')
+    serve_parser.add_argument('--batch-window-ms', type=float,
+                              help='Longest a send waits for others to share its commit')
+    serve_parser.add_argument('--batch-size', type=int,
+                              help='Most sends committed together (1 disables batching)')
+    serve_parser.add_argument('--metrics', action='store_true', help='Record instrumentation spans')
+    serve_parser.add_argument('--metrics-file', default=os.environ.get('WHISPERCHAIN_METRICS_FILE'),
+                              help='Add the metrics to the totals in this Prometheus text file')
+
+    # Metrics command
+    stats_parser = subparsers.add_parser('stats', help='Show latency, call counts and bytes per span')
+    stats_parser.add_argument('--prometheus', help='Also write the metrics to this file in the Prometheus text format')
+    stats_parser.add_argument('--reset', action='store_true', help='Clear the metrics after showing them')
+    stats_parser.add_argument('--metrics-file', default=os.environ.get('WHISPERCHAIN_METRICS_FILE'),
+                              help='Metrics file to show when no daemon is running')
 
     args = parser.parse_args()
 
@@ -55,46 +128,105 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if args.command == 'serve':
+        from whisperchain.server.daemon import serve
+        try:
+            serve(args.socket, ready=lambda: print(f"Serving on {args.socket}", flush=True),
+                  batch_window_ms=args.batch_window_ms, batch_size=args.batch_size,
+                  metrics=args.metrics, metrics_file=args.metrics_file)
+        except ValueError as e:
+            print(f"Error: {str(e)}")
+            sys.exit(1)
+        return
+
+    api = connect(args.socket)
     try:
         if args.command == 'register':
-            register_user(args.username, args.password, args.role, args.email)
-            log_event('registration', {'username': args.username, 'role': args.role, 'email': args.email})
+            api.register_user(args.username, args.password, args.role, args.email)
+            api.log_event('registration', {'username': args.username, 'role': args.role, 'email': args.email})
             print(f"User {args.username} registered successfully!")
 
+        elif args.command == 'import-users':
+            import csv
+            from itertools import islice
+            from whisperchain.auth.register import BULK_BATCH_SIZE
+            # Stream the roster a batch at a time; each batch commits on its own
+            registered, errors = [], []
+            with open(args.csv, newline='') as f:
+                rows = csv.DictReader(f)
+                first_row = 1
+                while True:
+                    batch = list(islice(rows, BULK_BATCH_SIZE))
+                    if not batch:
+                        break
+                    done, rejected = api.register_users_bulk(batch, workers=args.workers, first_row=first_row)
+                    registered.extend(done)
+                    errors.extend(rejected)
+                    first_row += len(batch)
+            api.log_event('bulk_registration', {'count': len(registered), 'usernames': registered,
+                                            'errors': len(errors)})
+            for row_number, username, error in errors:
+                print(f"Row {row_number} ({username or 'no username'}): {error}")
+            print(f"Imported {len(registered)} users ({len(errors)} rows rejected)")
+
         elif args.command == 'login':
-            if login_user(args.username, args.password):
-                log_event('login', {'username': args.username})
-                print(f"Welcome back, {args.username}!")
-            else:
+            try:
+                ticket = api.start_session(args.username, args.password, args.ttl)
+            except ValueError:
                 print("Invalid credentials!")
                 sys.exit(1)
+            api.log_event('login', {'username': args.username})
+            print(f"Welcome back, {args.username}!")
+            print("Session ticket (pass it with --session or set WHISPERCHAIN_SESSION):")
+            print(ticket)
+
+        elif args.command == 'logout':
+            if not args.session:
+                raise ValueError("No session ticket given")
+            api.revoke_session(args.session)
+            print("Logged out.")
 
         elif args.command == 'get-token':
-            if not check_permission(args.username, 'get_token'):
+            authenticate(api, args)
+            if not api.check_permission(args.username, 'get_token'):
                 print("Permission denied: Only Senders can get tokens")
                 sys.exit(1)
-            token = generate_token(args.username)
-            log_event('token_generation', {'username': args.username})
-            print(f"Your anonymous token: {token}")
+            if args.count > 1:
+                tokens = api.generate_tokens(args.username, args.count)
+                api.log_event('token_generation', {'username': args.username, 'count': len(tokens)})
+                print("Your anonymous tokens:")
+                for token in tokens:
+                    print(token)
+            else:
+                token = api.generate_token(args.username)
+                api.log_event('token_generation', {'username': args.username})
+                print(f"Your anonymous token: {token}")
 
         elif args.command == 'send':
-            if not check_permission(args.username, 'send_message'):
+            authenticate(api, args)
+            if not api.check_permission(args.username, 'send_message'):
                 print("Permission denied: Only Senders can send messages")
                 sys.exit(1)
-            message_id = send_message(args.username, args.token, args.message, args.receiver)
-            log_event('message_sent', {'username': args.username, 'message_id': message_id, 'receiver': args.receiver})
+            message_id = api.send_message(args.username, args.token, args.message, args.receiver)
+            api.log_event('message_sent', {'username': args.username, 'message_id': message_id, 'receiver': args.receiver})
             print(f"Message sent successfully! (ID: {message_id})")
 
         elif args.command == 'view':
-            if not check_permission(args.username, 'view_messages'):
+            authenticate(api, args)
+            if not api.check_permission(args.username, 'view_messages'):
                 print("Permission denied: Only Receivers can view messages")
                 sys.exit(1)
             
-            messages = get_receiver_messages(args.username)
-            if not messages:
-                print("No messages available.")
-            else:
-                print("\nYour messages:")
+            if args.page_size is None:
+                from whisperchain.messaging.send import PAGE_SIZE
+                args.page_size = PAGE_SIZE
+            shown = 0
+            since_id = args.since_id
+            while True:
+                page = api.get_receiver_page(args.username, since_id, args.page_size, args.unread_only)
+                messages = page['messages']
+                if messages and not shown:
+                    print("\nYour messages:")
                 for msg in messages:
                     status = "✓" if msg['read'] else "✗"
                     flagged = "🚩" if msg['flagged'] else ""
@@ -103,22 +235,97 @@ def main():
                     print(f"Received: {msg['received_at']}")
                     
                     if args.mark_read and not msg['read']:
-                        mark_message_read(args.username, msg['message_id'])
                         print("(Marked as read)")
+                if args.mark_read:
+                    api.mark_messages_read(args.username, [msg['message_id'] for msg in messages if not msg['read']])
+                shown += len(messages)
+                since_id = page['next']
+                if since_id is None:
+                    break
+                # Wait between pages when someone is reading along
+                if sys.stdin.isatty() and input("\n-- More (Enter to continue, q to quit) -- ").strip().lower() == 'q':
+                    break
+            if not shown:
+                print("No messages available.")
             
-            log_event('messages_viewed', {'username': args.username})
+            api.log_event('messages_viewed', {'username': args.username})
 
         elif args.command == 'flag':
-            if not check_permission(args.username, 'flag_message'):
+            authenticate(api, args)
+            if not api.check_permission(args.username, 'flag_message'):
                 print("Permission denied: Only Moderators can flag messages")
                 sys.exit(1)
-            flag_id = flag_message(args.username, args.message_id)
-            log_event('message_flagged', {'username': args.username, 'message_id': args.message_id})
-            print(f"Message flagged successfully! (Flag ID: {flag_id})")
+            if len(args.message_id) == 1:
+                flag_id = api.flag_message(args.username, args.message_id[0])
+                api.log_event('message_flagged', {'username': args.username, 'message_id': args.message_id[0]})
+                print(f"Message flagged successfully! (Flag ID: {flag_id})")
+            else:
+                flagged, errors = api.flag_messages(args.username, args.message_id)
+                api.log_event('messages_flagged', {'username': args.username, 'message_ids': list(flagged)})
+                for message_id, flag_id in flagged.items():
+                    print(f"Message {message_id} flagged (Flag ID: {flag_id})")
+                for message_id, error in errors:
+                    print(f"Message {message_id}: {error}")
+                print(f"Flagged {len(flagged)} of {len(args.message_id)} messages.")
+                if errors:
+                    sys.exit(1)
+
+        elif args.command in ('list-flags', 'list-unreviewed'):
+            authenticate(api, args)
+            if not api.check_permission(args.username, 'flag_message'):
+                print("Permission denied: Only Moderators can review messages")
+                sys.exit(1)
+            if args.command == 'list-flags':
+                for flag in api.list_flags(args.since, args.moderator, args.limit):
+                    print(f"Flag {flag['flag_id']}: message {flag['message_id']} "
+                          f"by {flag['moderator']} at {flag['created_at']}")
+            else:
+                for msg in api.list_unreviewed(args.since_id, args.limit):
+                    print(f"Message {msg['message_id']} ({msg['created_at']}): {msg['content']}")
+
+        elif args.command == 'stats':
+            from whisperchain.metrics.instrument import dump_prometheus, load_metrics, quantile
+            if isinstance(api, LocalClient):
+                # No daemon: show the totals other processes saved to the metrics file
+                metrics = load_metrics(args.metrics_file) if args.metrics_file else None
+                if metrics is not None:
+                    metrics['enabled'] = True
+            else:
+                metrics = api.get_metrics()
+            if metrics is not None and args.prometheus:
+                dump_prometheus(args.prometheus, metrics)
+                print(f"Metrics written to {args.prometheus}")
+            if metrics is None:
+                print("No daemon is running and no metrics have been saved "
+                      "(set WHISPERCHAIN_METRICS_FILE so each command saves what it records)")
+            elif not metrics['enabled']:
+                print("The daemon is not recording metrics "
+                      "(start it with --metrics or --metrics-file)")
+            elif not metrics['spans']:
+                print("No calls recorded yet.")
+            else:
+                def ms(seconds):
+                    return f"{seconds * 1000:.2f}" if seconds is not None else 'slower'
+                print(f"{'span':<32} {'target':<16} {'calls':>7} {'errors':>6} {'mean ms':>9} "
+                      f"{'p50 ms':>8} {'p99 ms':>8} {'read':>10} {'written':>10}")
+                for stats in metrics['spans']:
+                    print(f"{stats['name']:<32} {stats['target']:<16} {stats['calls']:>7} {stats['errors']:>6} "
+                          f"{ms(stats['seconds'] / stats['calls']):>9} "
+                          f"{ms(quantile(stats, metrics['buckets'], 0.5)):>8} "
+                          f"{ms(quantile(stats, metrics['buckets'], 0.99)):>8} "
+                          f"{stats['bytes_read']:>10} {stats['bytes_written']:>10}")
+            if args.reset:
+                if isinstance(api, LocalClient):
+                    if args.metrics_file:
+                        Path(args.metrics_file).unlink(missing_ok=True)
+                else:
+                    api.reset_metrics()
 
     except Exception as e:
         print(f"Error: {str(e)}")
         sys.exit(1)
+    finally:
+        api.close()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -1,18 +1,12 @@
-import json
 import time
-from pathlib import Path
+from typing import Iterator
 
-AUDIT_LOG = Path(__file__).parent.parent / 'db' / 'audit_log.json'
+from whisperchain.metrics.instrument import timed
+from whisperchain.storage.engine import DB_DIR, get_engine
 
-def _ensure_audit_log():
-    """Ensure the audit log file exists."""
-    AUDIT_LOG.parent.mkdir(exist_ok=True)
-    if not AUDIT_LOG.exists():
-        with open(AUDIT_LOG, 'w') as f:
-            json.dump({
-                'events': []
-            }, f)
+AUDIT_LOG = DB_DIR / 'audit_log'
 
+@timed('logging.log_event')
 def log_event(event_type: str, data: dict) -> None:
     """
     Log an event to the audit log.
@@ -20,12 +14,6 @@ def log_event(event_type: str, data: dict) -> None:
         event_type: The type of event (e.g., 'registration', 'login', 'message_sent')
         data: Additional event data to log
     """
-    _ensure_audit_log()
-    
-    # Load existing log
-    with open(AUDIT_LOG, 'r') as f:
-        log_data = json.load(f)
-    
     # Create event entry
     event = {
         'timestamp': int(time.time()),
@@ -34,13 +22,32 @@ def log_event(event_type: str, data: dict) -> None:
     }
     
     # Add event to log
-    log_data['events'].append(event)
+    get_engine().append_event(event)
+
+@timed('logging.query_events')
+def query_events(event_type: str = None, start_time: int = None, end_time: int = None,
+                 limit: int = None, offset: int = 0) -> Iterator[dict]:
+    """
+    Lazily retrieve events from the audit log, oldest first.
+    
+    Only the events in the requested type and time range are read, so large
+    ranges can be streamed without loading the whole log.
+    
+    Args:
+        event_type: Filter events by type
+        start_time: Filter events after this timestamp
+        end_time: Filter events before this timestamp
+        limit: Maximum number of events to return
+        offset: Number of matching events to skip
     
-    # Save updated log
-    with open(AUDIT_LOG, 'w') as f:
-        json.dump(log_data, f, indent=4)
+    Returns:
+        Iterator[dict]: Iterator over matching events
+    """
+    return get_engine().iter_events(event_type or None, start_time or None, end_time or None,
+                                    limit, offset)
 
-def get_events(event_type: str = None, start_time: int = None, end_time: int = None) -> list:
+def get_events(event_type: str = None, start_time: int = None, end_time: int = None,
+               limit: int = None, offset: int = 0) -> list:
     """
     Retrieve events from the audit log with optional filtering.
     
@@ -48,24 +55,10 @@ def get_events(event_type: str = None, start_time: int = None, end_time: int = N
         event_type: Filter events by type
         start_time: Filter events after this timestamp
         end_time: Filter events before this timestamp
+        limit: Maximum number of events to return
+        offset: Number of matching events to skip
     
     Returns:
         list: List of matching events
     """
-    if not AUDIT_LOG.exists():
-        return []
-    
-    with open(AUDIT_LOG, 'r') as f:
-        log_data = json.load(f)
-    
-    events = log_data['events']
-    
-    # Apply filters
-    if event_type:
-        events = [e for e in events if e['type'] == event_type]
-    if start_time:
-        events = [e for e in events if e['timestamp'] >= start_time]
-    if end_time:
-        events = [e for e in events if e['timestamp'] <= end_time]
-    
-    return events 
\ No newline at end of file
+    return list(query_events(event_type, start_time, end_time, limit, offset))
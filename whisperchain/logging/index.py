@@ -0,0 +1,87 @@
+import json
+import os
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Iterator
+
+INDEX_VERSION = 1
+
+def index_path(segment_path: Path) -> Path:
+    """Return the index file kept next to a sealed segment."""
+    return segment_path.with_suffix('.idx')
+
+def _columns(entries: list) -> dict:
+    return {
+        'timestamps': [entry[0] for entry in entries],
+        'offsets': [entry[1] for entry in entries]
+    }
+
+def build_index(segment_path: Path) -> dict:
+    """
+    Build the index of a segment file.
+
+    The index holds every event's timestamp and byte offset sorted by
+    timestamp, both for the whole segment and per event type, so a
+    type + time-range query is two binary searches.
+    Args:
+        segment_path: The segment to index
+    Returns:
+        dict: The index
+    """
+    entries = []
+    offset = 0
+    with open(segment_path, 'rb') as f:
+        for line in f:
+            # A torn final line from a crashed writer is skipped
+            if line.endswith(b'\n'):
+                event = json.loads(line)
+                entries.append((event['timestamp'], offset, event['type']))
+            offset += len(line)
+    entries.sort(key=lambda entry: (entry[0], entry[1]))
+
+    by_type = {}
+    for entry in entries:
+        by_type.setdefault(entry[2], []).append(entry)
+
+    return {
+        'version': INDEX_VERSION,
+        'count': len(entries),
+        'all': _columns(entries),
+        'types': {event_type: _columns(typed) for event_type, typed in by_type.items()}
+    }
+
+def write_index(segment_path: Path, index: dict) -> None:
+    """Atomically write the index of a segment."""
+    path = index_path(segment_path)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+def load_index(segment_path: Path) -> dict:
+    """Load the index of a sealed segment, building it if it is missing or corrupt."""
+    path = index_path(segment_path)
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (FileNotFoundError, ValueError):
+        pass
+    index = build_index(segment_path)
+    write_index(segment_path, index)
+    return index
+
+def matching_range(columns: dict, start_time: int = None, end_time: int = None) -> tuple[int, int]:
+    """Return the [lo, hi) slice of an index column inside a time window."""
+    timestamps = columns['timestamps']
+    lo = 0 if start_time is None else bisect_left(timestamps, start_time)
+    hi = len(timestamps) if end_time is None else bisect_right(timestamps, end_time)
+    return lo, max(lo, hi)
+
+def read_at(segment_path: Path, offsets: list) -> Iterator[dict]:
+    """Yield the events stored at the given byte offsets of a segment."""
+    with open(segment_path, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            yield json.loads(f.readline())
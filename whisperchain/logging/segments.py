@@ -0,0 +1,312 @@
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator, Optional
+
+from whisperchain.logging.index import build_index, load_index, matching_range, read_at, write_index
+from whisperchain.storage.locking import FileLock
+
+# Rotation and durability defaults for the audit log
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+SEGMENT_MAX_AGE = 24 * 60 * 60
+SYNC_EVERY = 0
+
+# Number of sealed-segment indexes kept in memory
+INDEX_CACHE_SIZE = 8
+
+MANIFEST = 'manifest.json'
+
+# Lock taken shared to append and exclusively to rotate, index or import
+LOCK_FILE = 'manifest.lock'
+
+class SegmentedLog:
+    """
+    Append-only, line-delimited event log split into bounded segments.
+
+    Each event is one JSON line written with a single ``write()``. When the
+    active segment grows past ``max_bytes`` or ``max_age`` seconds it is
+    sealed and a new one is started. ``manifest.json`` records the time
+    range of every segment so readers only open segments that overlap the
+    requested window, and each sealed segment has a ``.idx`` file of
+    timestamps and byte offsets (see ``index.py``) so only matching events
+    are read from it.
+
+    Several processes may append to the same log. Each append holds a
+    shared lock on ``manifest.lock``; sealing, starting a segment and
+    importing events hold it exclusively and re-read the manifest first,
+    so a segment is never sealed twice or appended to once it is indexed.
+    """
+
+    def __init__(self, directory, max_bytes: int = SEGMENT_MAX_BYTES,
+                 max_age: int = SEGMENT_MAX_AGE, sync_every: int = SYNC_EVERY):
+        """
+        Args:
+            directory: Directory holding the segments and manifest
+            max_bytes: Size at which the active segment is rotated
+            max_age: Age in seconds at which the active segment is rotated
+            sync_every: fsync after this many appends (0 leaves it to the OS)
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sync_every = sync_every
+        self._manifest = None
+        self._manifest_mtime = None
+        self._file = None
+        self._file_name = None
+        self._unsynced = 0
+        self._indexes = OrderedDict()
+        self._lock = FileLock(self.directory / LOCK_FILE)
+
+    # Manifest
+
+    def _manifest_path(self) -> Path:
+        return self.directory / MANIFEST
+
+    def manifest(self, reload: bool = False) -> dict:
+        """Return the manifest, reloading it if another writer changed it (or ``reload`` is set)."""
+        path = self._manifest_path()
+        try:
+            stat = path.stat()
+            mtime = stat.st_ino, stat.st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if reload or self._manifest is None or mtime != self._manifest_mtime:
+            # Another writer rotated or reset the log; reopen on next append
+            self._close_file()
+            self._indexes.clear()
+            if mtime is None:
+                self._manifest = {'version': 1, 'segments': []}
+            else:
+                with open(path, 'r') as f:
+                    self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def _write_manifest(self, manifest: dict) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._manifest_path()
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._manifest = manifest
+        stat = path.stat()
+        self._manifest_mtime = stat.st_ino, stat.st_mtime_ns
+
+    # Writing
+
+    def append(self, event: dict) -> None:
+        """Append one event, rotating the active segment first if needed."""
+        timestamp = event['timestamp']
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self._lock.shared():
+            segment = self._writable_segment(timestamp)
+            if segment is not None:
+                self._write_line(segment, line)
+                return
+        with self._lock.exclusive():
+            self._write_line(self._active_segment(timestamp), line)
+
+    def _write_line(self, segment: dict, line: str) -> None:
+        if self._file_name != segment['name']:
+            self._close_file()
+            self._file = open(self.directory / segment['name'], 'a')
+            self._file_name = segment['name']
+        self._file.write(line)
+        self._file.flush()
+        self._unsynced += 1
+        if self.sync_every and self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        """Flush appended events to disk."""
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        """Sync and close the active segment file."""
+        self.sync()
+        self._close_file()
+        self._lock.close()
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_name = None
+
+    def _writable_segment(self, timestamp: int) -> Optional[dict]:
+        """Return the active segment if an event at ``timestamp`` still belongs in it, else None."""
+        segments = self.manifest()['segments']
+        if segments and segments[-1]['end'] is None:
+            active = segments[-1]
+            path = self.directory / active['name']
+            size = path.stat().st_size if path.exists() else 0
+            if size < self.max_bytes and timestamp - active['start'] < self.max_age:
+                return active
+        return None
+
+    def _active_segment(self, timestamp: int) -> dict:
+        """Return the segment to append to, sealing and starting segments as needed (lock held exclusively)."""
+        manifest = self.manifest(reload=True)
+        active = self._writable_segment(timestamp)
+        if active is not None:
+            return active
+        if manifest['segments'] and manifest['segments'][-1]['end'] is None:
+            self._seal(manifest, manifest['segments'][-1])
+        return self._start_segment(manifest, timestamp)
+
+    def _start_segment(self, manifest: dict, timestamp: int) -> dict:
+        number = manifest.get('next_segment', len(manifest['segments']) + 1)
+        segment = {'name': f'segment-{number:06d}.jsonl', 'start': timestamp, 'end': None}
+        manifest['segments'].append(segment)
+        manifest['next_segment'] = number + 1
+        self._write_manifest(manifest)
+        return segment
+
+    def _seal(self, manifest: dict, segment: dict) -> None:
+        self.sync()
+        self._close_file()
+        path = self.directory / segment['name']
+        timestamps = []
+        if path.exists():
+            index = build_index(path)
+            write_index(path, index)
+            timestamps = index['all']['timestamps']
+        segment['start'] = timestamps[0] if timestamps else segment['start']
+        segment['end'] = timestamps[-1] if timestamps else segment['start']
+        segment['count'] = len(timestamps)
+        self._write_manifest(manifest)
+
+    def rotate(self) -> None:
+        """Seal the active segment so the next append starts a new one."""
+        with self._lock.exclusive():
+            self._rotate(self.manifest(reload=True))
+
+    def _rotate(self, manifest: dict) -> None:
+        if manifest['segments'] and manifest['segments'][-1]['end'] is None:
+            self._seal(manifest, manifest['segments'][-1])
+
+    def import_events(self, events: list) -> None:
+        """Write a batch of existing events as one sealed segment."""
+        with self._lock.exclusive():
+            self._import_events(events)
+
+    def _import_events(self, events: list) -> None:
+        if not events:
+            return
+        manifest = self.manifest(reload=True)
+        self._rotate(manifest)
+        segment = self._start_segment(manifest, events[0]['timestamp'])
+        with open(self.directory / segment['name'], 'w') as f:
+            for event in events:
+                f.write(json.dumps(event, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._seal(manifest, segment)
+
+    def import_file(self, path: Path, read_events) -> None:
+        """
+        Import the events of an older log file and rename it to ``<name>.bak``.
+        The check, import and rename happen under the exclusive lock, so
+        processes opening the log together import the file only once.
+        Args:
+            path: The file to import
+            read_events: Function returning the list of events in the file
+        """
+        with self._lock.exclusive():
+            if not path.exists():
+                return
+            self._import_events(read_events(path))
+            path.rename(path.with_name(path.name + '.bak'))
+
+    # Reading
+
+    def segments(self, start_time: int = None, end_time: int = None) -> list:
+        """Return the manifest entries overlapping a time window."""
+        result = []
+        for segment in self.manifest()['segments']:
+            if start_time is not None and segment['end'] is not None and segment['end'] < start_time:
+                continue
+            if end_time is not None and segment['start'] > end_time:
+                continue
+            result.append(segment)
+        return result
+
+    def _read_segment(self, name: str) -> Iterator[dict]:
+        path = self.directory / name
+        if not path.exists():
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                # A torn final line from a crashed writer is skipped
+                if line.endswith('\n'):
+                    yield json.loads(line)
+
+    def _index(self, name: str) -> dict:
+        if name in self._indexes:
+            self._indexes.move_to_end(name)
+            return self._indexes[name]
+        index = load_index(self.directory / name)
+        self._indexes[name] = index
+        if len(self._indexes) > INDEX_CACHE_SIZE:
+            self._indexes.popitem(last=False)
+        return index
+
+    def iter_events(self, event_type: Optional[str] = None, start_time: int = None,
+                    end_time: int = None, limit: int = None, offset: int = 0) -> Iterator[dict]:
+        """
+        Lazily yield matching events, oldest first.
+
+        Sealed segments are answered from their index with a binary search
+        and reads of only the matching lines; whole segments are skipped
+        for ``offset`` using the index counts. The active segment is scanned.
+        Args:
+            event_type: Only yield events of this type
+            start_time: Only yield events at or after this timestamp
+            end_time: Only yield events at or before this timestamp
+            limit: Stop after this many events
+            offset: Skip this many matching events first
+        """
+        remaining = limit
+        for segment in self.segments(start_time, end_time):
+            if remaining is not None and remaining <= 0:
+                return
+            if segment['end'] is None:
+                events = self._read_segment(segment['name'])
+            else:
+                index = self._index(segment['name'])
+                columns = index['all'] if event_type is None else index['types'].get(event_type)
+                if not columns:
+                    continue
+                lo, hi = matching_range(columns, start_time, end_time)
+                if offset >= hi - lo:
+                    offset -= hi - lo
+                    continue
+                lo, offset = lo + offset, 0
+                if remaining is not None:
+                    hi = min(hi, lo + remaining)
+                    remaining -= hi - lo
+                yield from read_at(self.directory / segment['name'], columns['offsets'][lo:hi])
+                continue
+
+            for event in events:
+                if event_type is not None and event['type'] != event_type:
+                    continue
+                if start_time is not None and event['timestamp'] < start_time:
+                    continue
+                if end_time is not None and event['timestamp'] > end_time:
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                if remaining is not None:
+                    if remaining <= 0:
+                        return
+                    remaining -= 1
+                yield event
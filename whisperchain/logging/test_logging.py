@@ -1,5 +1,9 @@
+import json
 import unittest
+import tempfile
+from pathlib import Path
 from whisperchain.logging.audit import log_event, get_events
+from whisperchain.logging.segments import SegmentedLog
 import time
 
 class TestLogging(unittest.TestCase):
@@ -43,5 +47,90 @@ class TestLogging(unittest.TestCase):
         self.assertEqual(events1[0]["data"]["data"], "test3")
         self.assertEqual(events1[1]["data"]["data"], "test1")
 
+class TestSegmentedLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rotation_by_age(self):
+        log = SegmentedLog(self.tmp.name, max_age=100)
+        for timestamp in (0, 50, 100, 150, 250):
+            log.append({"timestamp": timestamp, "type": "t", "data": {"ts": timestamp}})
+        segments = log.manifest()["segments"]
+        self.assertEqual(len(segments), 3)
+        self.assertEqual((segments[0]["start"], segments[0]["end"]), (0, 50))
+        self.assertEqual((segments[1]["start"], segments[1]["end"]), (100, 150))
+        self.assertIsNone(segments[2]["end"])
+        log.close()
+
+    def test_rotation_by_size(self):
+        log = SegmentedLog(self.tmp.name, max_bytes=1)
+        for timestamp in range(3):
+            log.append({"timestamp": timestamp, "type": "t", "data": {}})
+        self.assertEqual(len(log.manifest()["segments"]), 3)
+        self.assertEqual(len(list(log.iter_events())), 3)
+        log.close()
+
+    def test_time_window_skips_segments(self):
+        log = SegmentedLog(self.tmp.name, max_age=100, sync_every=2)
+        for timestamp in (0, 50, 100, 150, 250):
+            log.append({"timestamp": timestamp, "type": "t", "data": {"ts": timestamp}})
+        self.assertEqual([s["name"] for s in log.segments(120, 200)],
+                         ["segment-000002.jsonl"])
+        events = list(log.iter_events(start_time=120, end_time=260))
+        self.assertEqual([e["timestamp"] for e in events], [150, 250])
+        log.close()
+
+    def test_indexed_query_with_paging(self):
+        log = SegmentedLog(self.tmp.name, max_age=100)
+        for timestamp in range(0, 300, 10):
+            event_type = "even" if timestamp % 20 == 0 else "odd"
+            log.append({"timestamp": timestamp, "type": event_type, "data": {"ts": timestamp}})
+        events = log.iter_events(event_type="even", start_time=40, end_time=260)
+        self.assertEqual([e["timestamp"] for e in events],
+                         [40, 60, 80, 100, 120, 140, 160, 180, 200, 220, 240, 260])
+        events = log.iter_events(event_type="even", start_time=40, end_time=260, limit=4, offset=2)
+        self.assertEqual([e["timestamp"] for e in events], [80, 100, 120, 140])
+        events = log.iter_events(start_time=190, limit=3, offset=1)
+        self.assertEqual([e["timestamp"] for e in events], [200, 210, 220])
+        log.close()
+
+    def test_index_rebuilt_when_missing(self):
+        log = SegmentedLog(self.tmp.name, max_age=100)
+        for timestamp in (0, 50, 100):
+            log.append({"timestamp": timestamp, "type": "t", "data": {}})
+        log.close()
+        for path in Path(self.tmp.name).glob("*.idx"):
+            path.write_text("corrupt")
+        log = SegmentedLog(self.tmp.name, max_age=100)
+        self.assertEqual([e["timestamp"] for e in log.iter_events(end_time=60)], [0, 50])
+        log.close()
+
+    def test_writers_share_rotation(self):
+        first = SegmentedLog(self.tmp.name, max_age=100)
+        second = SegmentedLog(self.tmp.name, max_age=100)
+        for log, timestamp in ((first, 0), (second, 10), (second, 150), (first, 160), (first, 300)):
+            log.append({"timestamp": timestamp, "type": "t", "data": {}})
+        segments = second.manifest()["segments"]
+        self.assertEqual([s["name"] for s in segments],
+                         ["segment-000001.jsonl", "segment-000002.jsonl", "segment-000003.jsonl"])
+        self.assertEqual([s.get("count") for s in segments], [2, 2, None])
+        self.assertEqual([e["timestamp"] for e in second.iter_events()], [0, 10, 150, 160, 300])
+        first.close()
+        second.close()
+
+    def test_legacy_file_imported_once(self):
+        legacy = Path(self.tmp.name) / "audit_log.json"
+        legacy.write_text(json.dumps({"events": [{"timestamp": 1, "type": "t", "data": {}}]}))
+        logs = [SegmentedLog(Path(self.tmp.name) / "audit_log") for _ in range(2)]
+        for log in logs:
+            log.import_file(legacy, lambda path: json.loads(path.read_text())["events"])
+        self.assertEqual(len(list(logs[0].iter_events())), 1)
+        self.assertTrue(legacy.with_name("audit_log.json.bak").exists())
+        for log in logs:
+            log.close()
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
@@ -1,20 +1,35 @@
-import json
 import time
-from pathlib import Path
+from typing import Iterator
 
-MESSAGES_DB = Path(__file__).parent.parent / 'db' / 'messages.json'
-FLAGS_DB = Path(__file__).parent.parent / 'db' / 'flags.json'
+from whisperchain.metrics.instrument import timed
+from whisperchain.storage.engine import DB_DIR, get_engine, retry_on_conflict
 
-def _ensure_flags_db():
-    """Ensure the flags database file exists."""
-    FLAGS_DB.parent.mkdir(exist_ok=True)
-    if not FLAGS_DB.exists():
-        with open(FLAGS_DB, 'w') as f:
-            json.dump({
-                'flags': {},
-                'next_id': 1
-            }, f)
+MESSAGES_DB = DB_DIR / 'messages.json'
+FLAGS_DB = DB_DIR / 'flags.json'
 
+def _flag(engine, username: str, message_id: str, timestamp: int) -> int:
+    """Flag one message inside the caller's transaction."""
+    # Check if message exists
+    message = engine.get_message(message_id)
+    if message is None:
+        raise ValueError("Message does not exist")
+
+    if message['flagged']:
+        raise ValueError("Message is already flagged")
+
+    # Store flag
+    flag_id = engine.add_flag({
+        'message_id': message_id,
+        'moderator': username,
+        'created_at': timestamp
+    })
+
+    # Mark message as flagged
+    engine.set_message_flagged(message_id)
+    return flag_id
+
+@timed('messaging.flag_message')
+@retry_on_conflict
 def flag_message(username: str, message_id: str) -> int:
     """
     Flag a message for review.
@@ -26,46 +41,69 @@ def flag_message(username: str, message_id: str) -> int:
     Raises:
         ValueError: If the message doesn't exist or is already flagged
     """
-    _ensure_flags_db()
-    
-    # Check if message exists
-    if not MESSAGES_DB.exists():
-        raise ValueError("Messages database does not exist")
-    
-    with open(MESSAGES_DB, 'r') as f:
-        messages_data = json.load(f)
-    
-    if message_id not in messages_data['messages']:
-        raise ValueError("Message does not exist")
-    
-    message = messages_data['messages'][message_id]
-    if message['flagged']:
-        raise ValueError("Message is already flagged")
-    
-    # Load flags database
-    with open(FLAGS_DB, 'r') as f:
-        flags_data = json.load(f)
-    
-    # Generate flag ID
-    flag_id = flags_data['next_id']
-    flags_data['next_id'] += 1
-    
-    # Store flag
+    engine = get_engine()
+    with engine.transaction():
+        return _flag(engine, username, str(message_id), int(time.time()))
+
+@timed('messaging.flag_messages')
+@retry_on_conflict
+def flag_messages(username: str, message_ids: list) -> tuple[dict, list]:
+    """
+    Flag a batch of messages in one transaction.
+
+    Messages that do not exist or are already flagged are reported and
+    skipped; the rest are flagged.
+    Args:
+        username: The username of the moderator
+        message_ids: The IDs of the messages to flag
+    Returns:
+        tuple: ({message_id: flag_id} for each flagged message,
+                [(message_id, error message)] for each one skipped)
+    """
+    engine = get_engine()
+    flagged, errors = {}, []
     timestamp = int(time.time())
-    flags_data['flags'][str(flag_id)] = {
-        'message_id': message_id,
-        'moderator': username,
-        'created_at': timestamp
-    }
-    
-    # Mark message as flagged
-    messages_data['messages'][message_id]['flagged'] = True
-    
-    # Save updated data
-    with open(FLAGS_DB, 'w') as f:
-        json.dump(flags_data, f, indent=4)
-    
-    with open(MESSAGES_DB, 'w') as f:
-        json.dump(messages_data, f, indent=4)
-    
-    return flag_id 
\ No newline at end of file
+    with engine.transaction():
+        for message_id in map(str, message_ids):
+            try:
+                flagged[message_id] = _flag(engine, username, message_id, timestamp)
+            except ValueError as e:
+                errors.append((message_id, str(e)))
+    return flagged, errors
+
+@timed('messaging.list_flags')
+def list_flags(since: int = None, moderator: str = None, limit: int = None) -> Iterator[dict]:
+    """
+    List flags oldest first.
+    Args:
+        since: Only list flags created at or after this timestamp
+        moderator: Only list flags raised by this moderator
+        limit: Maximum number of flags to list
+    Returns:
+        Iterator[dict]: Flags with their IDs
+    """
+    for flag_id, record in get_engine().query_flags(since, moderator, limit):
+        yield {'flag_id': flag_id, **record}
+
+@timed('messaging.list_unreviewed')
+def list_unreviewed(since_id: int = None, limit: int = None) -> Iterator[dict]:
+    """
+    List messages no moderator has flagged yet, oldest first.
+    Args:
+        since_id: Only list messages with a higher ID than this
+        limit: Maximum number of messages to list
+    Returns:
+        Iterator[dict]: Messages with their IDs
+    """
+    if limit is not None and limit <= 0:
+        return
+    for message_id, record in get_engine().iter_messages(since_id, unflagged_only=True):
+        yield {
+            'message_id': str(message_id),
+            'content': record['content'],
+            'created_at': record['created_at']
+        }
+        if limit is not None:
+            limit -= 1
+            if limit <= 0:
+                return
@@ -1,127 +1,143 @@
-import json
 import time
-from pathlib import Path
-from tokens.generate import validate_token, mark_token_used
+from typing import Iterator
 
-MESSAGES_DB = Path(__file__).parent.parent / 'db' / 'messages.json'
-RECEIVERS_DB = Path(__file__).parent.parent / 'db' / 'receivers.json'
+from whisperchain.metrics.instrument import timed
+from whisperchain.storage.engine import DB_DIR, get_engine, retry_on_conflict
+from whisperchain.tokens.generate import consume_token
 
-def _ensure_messages_db():
-    """Ensure the messages database file exists."""
-    MESSAGES_DB.parent.mkdir(exist_ok=True)
-    if not MESSAGES_DB.exists():
-        with open(MESSAGES_DB, 'w') as f:
-            json.dump({
-                'messages': {},
-                'next_id': 1
-            }, f)
+MESSAGES_DB = DB_DIR / 'messages.json'
+RECEIVERS_DB = DB_DIR / 'receivers.json'
 
-def _ensure_receivers_db():
-    """Ensure the receivers database file exists."""
-    RECEIVERS_DB.parent.mkdir(exist_ok=True)
-    if not RECEIVERS_DB.exists():
-        with open(RECEIVERS_DB, 'w') as f:
-            json.dump({
-                'receivers': {}
-            }, f)
+# Messages returned per call to get_receiver_messages or get_receiver_page by default
+PAGE_SIZE = 50
 
-def send_message(username: str, token: str, message: str, receiver: str) -> int:
-    """
-    Send a message using an anonymous token to a specific receiver.
-    Args:
-        username: The username of the sender
-        token: The anonymous token to use
-        message: The message content
-        receiver: The username of the receiver
-    Returns:
-        int: The message ID
-    Raises:
-        ValueError: If the token is invalid or already used, or receiver does not exist
-    """
-    _ensure_messages_db()
-    _ensure_receivers_db()
-    
-    # Validate token
-    token_username = validate_token(token)
-    if not token_username or token_username != username:
-        raise ValueError("Invalid or already used token")
-    
-    # Load messages database
-    with open(MESSAGES_DB, 'r') as f:
-        data = json.load(f)
+def _send(engine, username: str, token: str, message: str, receiver: str, timestamp: int) -> int:
+    """Send one message inside the caller's transaction."""
+    if not engine.receiver_exists(receiver):
+        raise ValueError(f"Receiver '{receiver}' does not exist.")
     
-    # Generate message ID
-    message_id = data['next_id']
-    data['next_id'] += 1
+    # Validate the token and mark it used in one step
+    consume_token(token, username)
     
     # Store message
-    timestamp = int(time.time())
-    data['messages'][str(message_id)] = {
+    message_id = engine.add_message({
         'content': message,
         'token': token,
         'created_at': timestamp,
         'flagged': False,
         'read_by': []
-    }
-    
-    # Mark token as used
-    mark_token_used(token)
-    
-    # Save updated messages
-    with open(MESSAGES_DB, 'w') as f:
-        json.dump(data, f, indent=4)
+    })
     
     # Add message to the specified receiver's queue
-    with open(RECEIVERS_DB, 'r') as f:
-        receivers_data = json.load(f)
-    
-    if receiver not in receivers_data['receivers']:
-        raise ValueError(f"Receiver '{receiver}' does not exist.")
-    
-    if 'messages' not in receivers_data['receivers'][receiver]:
-        receivers_data['receivers'][receiver]['messages'] = []
-    receivers_data['receivers'][receiver]['messages'].append({
+    engine.append_to_queue(receiver, {
         'message_id': str(message_id),
         'received_at': timestamp,
         'read': False
     })
-    
-    # Save updated receivers data
-    with open(RECEIVERS_DB, 'w') as f:
-        json.dump(receivers_data, f, indent=4)
-    
     return message_id
 
-def get_receiver_messages(username: str) -> list:
+@timed('messaging.send_message')
+@retry_on_conflict
+def send_message(username: str, token: str, message: str, receiver: str) -> int:
     """
-    Get all messages for a receiver.
+    Send a message using an anonymous token to a specific receiver.
     Args:
-        username: The username of the receiver
+        username: The username of the sender
+        token: The anonymous token to use
+        message: The message content
+        receiver: The username of the receiver
     Returns:
-        list: List of messages with their read status
+        int: The message ID
+    Raises:
+        ValueError: If the token is invalid or already used, or receiver does not exist
     """
-    if not RECEIVERS_DB.exists() or not MESSAGES_DB.exists():
-        return []
+    engine = get_engine()
     
-    with open(RECEIVERS_DB, 'r') as f:
-        receivers_data = json.load(f)
-    
-    if username not in receivers_data['receivers']:
-        return []
-    
-    receiver_messages = receivers_data['receivers'][username].get('messages', [])
+    # The token, message and queue entry are committed together or not at all
+    with engine.transaction():
+        return _send(engine, username, token, message, receiver, int(time.time()))
+
+@timed('messaging.send_messages')
+@retry_on_conflict
+def send_messages(sends: list) -> list:
+    """
+    Send a batch of messages in one transaction, so they are persisted together.
+
+    Each send is checked on its own: one with an invalid token or an unknown
+    receiver is reported and changes nothing, and the rest are sent in order.
+    Args:
+        sends: (username, token, message, receiver) for each message
+    Returns:
+        list: (message ID, None) for each message sent and (None, error
+              message) for each one refused, in the order given
+    """
+    engine = get_engine()
+    timestamp = int(time.time())
+    results = []
+    with engine.transaction():
+        for username, token, message, receiver in sends:
+            try:
+                results.append((_send(engine, username, token, message, receiver, timestamp), None))
+            except ValueError as e:
+                results.append((None, str(e)))
+    return results
+
+@timed('messaging.get_receiver_messages')
+def get_receiver_messages(username: str, since_id: int = None, limit: int = PAGE_SIZE,
+                          unread_only: bool = False) -> Iterator[dict]:
+    """
+    Get one page of a receiver's messages, oldest first.
+
+    Only the receiver's own inbox and the bodies of the returned messages
+    are read. To read the inbox page by page, use get_receiver_page, which
+    also says where the next page starts.
+    Args:
+        username: The username of the receiver
+        since_id: Only return messages queued after this message (or with a
+            higher ID, if it is not in the inbox)
+        limit: Maximum number of messages to return (None for all)
+        unread_only: Only return messages not yet marked as read
+    Returns:
+        Iterator[dict]: Messages with their read status
+    """
+    yield from _receiver_page(username, since_id, limit, unread_only)['messages']
+
+@timed('messaging.get_receiver_page')
+def get_receiver_page(username: str, since_id: int = None, limit: int = PAGE_SIZE,
+                      unread_only: bool = False) -> dict:
+    """
+    Get one page of a receiver's messages and where the next page starts.
+
+    A page can hold fewer than ``limit`` messages before the end of the
+    inbox, when a queued message's body is missing, so callers page on
+    the returned cursor rather than on the messages.
+    Args:
+        username: The username of the receiver
+        since_id: Cursor returned with the previous page, or a message ID
+        limit: Maximum number of messages to return (None for all)
+        unread_only: Only return messages not yet marked as read
+    Returns:
+        dict: 'messages' as returned by get_receiver_messages, and 'next',
+        the since_id of the next page or None at the end of the inbox
+    """
+    return _receiver_page(username, since_id, limit, unread_only)
+
+def _receiver_page(username: str, since_id, limit, unread_only: bool) -> dict:
+    engine = get_engine()
+    with engine.transaction():
+        receiver_messages = list(engine.iter_queue(username, since_id, unread_only, limit))
+        bodies = engine.get_messages([msg['message_id'] for msg in receiver_messages])
     
-    # Load message contents
-    with open(MESSAGES_DB, 'r') as f:
-        messages_data = json.load(f)
+    # The queue ran out before the page filled: nothing follows
+    full = limit is not None and receiver_messages and len(receiver_messages) == limit
+    page = {'messages': [], 'next': receiver_messages[-1]['message_id'] if full else None}
     
     # Combine message content with receiver's read status
-    result = []
     for msg in receiver_messages:
         message_id = msg['message_id']
-        if message_id in messages_data['messages']:
-            message_content = messages_data['messages'][message_id]
-            result.append({
+        message_content = bodies.get(message_id)
+        if message_content is not None:
+            page['messages'].append({
                 'message_id': message_id,
                 'content': message_content['content'],
                 'created_at': message_content['created_at'],
@@ -129,8 +145,7 @@ def get_receiver_messages(username: str) -> list:
                 'read': msg['read'],
                 'flagged': message_content['flagged']
             })
-    
-    return result
+    return page
 
 def mark_message_read(username: str, message_id: str) -> None:
     """
@@ -139,21 +154,16 @@ def mark_message_read(username: str, message_id: str) -> None:
         username: The username of the receiver
         message_id: The ID of the message to mark as read
     """
-    if not RECEIVERS_DB.exists():
-        return
-    
-    with open(RECEIVERS_DB, 'r') as f:
-        receivers_data = json.load(f)
-    
-    if username not in receivers_data['receivers']:
-        return
-    
-    # Find and mark the message as read
-    for msg in receivers_data['receivers'][username].get('messages', []):
-        if msg['message_id'] == message_id:
-            msg['read'] = True
-            break
-    
-    # Save updated data
-    with open(RECEIVERS_DB, 'w') as f:
-        json.dump(receivers_data, f, indent=4) 
\ No newline at end of file
+    mark_messages_read(username, [message_id])
+
+@timed('messaging.mark_messages_read')
+def mark_messages_read(username: str, message_ids: list) -> int:
+    """
+    Mark several messages as read by a receiver in one write.
+    Args:
+        username: The username of the receiver
+        message_ids: The IDs of the messages to mark as read
+    Returns:
+        int: The number of messages that were unread
+    """
+    return get_engine().set_queue_read(username, [str(message_id) for message_id in message_ids])
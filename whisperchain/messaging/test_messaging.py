@@ -1,8 +1,9 @@
 import unittest
-from whisperchain.messaging.send import send_message
-from whisperchain.messaging.flag import flag_message
+from whisperchain.messaging.send import get_receiver_messages, send_message, send_messages
+from whisperchain.messaging.flag import flag_message, flag_messages, list_flags, list_unreviewed
+from whisperchain.storage.testing import TempEngineTestCase
 from whisperchain.auth.register import register_user
-from whisperchain.tokens.generate import generate_token
+from whisperchain.tokens.generate import generate_token, generate_tokens
 
 class TestMessaging(unittest.TestCase):
     def setUp(self):
@@ -46,5 +47,36 @@ class TestMessaging(unittest.TestCase):
         with self.assertRaises(ValueError):
             flag_message("sender_msg", str(message_id))
 
+class TestModeration(TempEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ids = [self.engine.add_message({"content": f"m{i}", "token": "t", "created_at": i, "flagged": False})
+                    for i in range(4)]
+
+    def test_flag_messages_reports_each_id(self):
+        flagged, errors = flag_messages("mod", [self.ids[0], self.ids[2], "999", self.ids[0]])
+        self.assertEqual(sorted(flagged), [str(self.ids[0]), str(self.ids[2])])
+        self.assertEqual(errors, [("999", "Message does not exist"),
+                                  (str(self.ids[0]), "Message is already flagged")])
+        self.assertEqual(len(list(list_flags())), 2)
+
+    def test_list_unreviewed(self):
+        flag_messages("mod", [self.ids[1]])
+        unreviewed = list(list_unreviewed())
+        self.assertEqual([m["content"] for m in unreviewed], ["m0", "m2", "m3"])
+        self.assertEqual([m["content"] for m in list_unreviewed(since_id=self.ids[0], limit=1)], ["m2"])
+
+    def test_send_messages_reports_each_send(self):
+        self.engine.add_receiver("bob")
+        tokens = generate_tokens("alice", 2)
+        results = send_messages([("alice", tokens[0], "first", "bob"),
+                                 ("alice", tokens[1], "lost", "nobody"),
+                                 ("alice", tokens[0], "again", "bob"),
+                                 ("alice", tokens[1], "second", "bob")])
+        self.assertEqual([error for _, error in results],
+                         [None, "Receiver 'nobody' does not exist.", "Invalid or already used token", None])
+        self.assertEqual([m["message_id"] for m in get_receiver_messages("bob")],
+                         [str(results[0][0]), str(results[3][0])])
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
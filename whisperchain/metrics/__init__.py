@@ -0,0 +1,3 @@
+"""
+Instrumentation and metrics for WhisperChain+.
+"""
\ No newline at end of file
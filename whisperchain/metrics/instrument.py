@@ -0,0 +1,353 @@
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from types import GeneratorType
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; concurrent merges into a metrics file may then collide
+    fcntl = None
+
+# Upper bounds, in seconds, of the latency histogram buckets; a last bucket
+# holds everything slower
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prometheus text file each process adds what it recorded to when it exits
+# (see save_metrics); setting it turns recording on
+METRICS_FILE = os.environ.get('WHISPERCHAIN_METRICS_FILE') or None
+
+# Instrumentation is off unless WHISPERCHAIN_METRICS or METRICS_FILE is set
+# (or enable() is called); while off, a span or timed call costs one flag check
+_enabled = os.environ.get('WHISPERCHAIN_METRICS', '') not in ('', '0') or METRICS_FILE is not None
+
+def enable(enabled: bool = True) -> None:
+    """Turn recording on or off for this process."""
+    global _enabled
+    _enabled = enabled
+
+def enabled() -> bool:
+    """Return True if spans are being recorded."""
+    return _enabled
+
+class _Stats:
+    __slots__ = ('calls', 'errors', 'seconds', 'buckets', 'bytes_read', 'bytes_written')
+
+    def __init__(self):
+        self.calls = self.errors = self.bytes_read = self.bytes_written = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+class Registry:
+    """
+    Latency histograms, call and error counts and bytes moved, per span.
+
+    A span is identified by its name, e.g. ``messaging.send_message``, and
+    an optional target such as the store a JSON document belongs to.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}
+
+    def observe(self, name: str, target: str, seconds: float, error: bool = False,
+                bytes_read: int = 0, bytes_written: int = 0) -> None:
+        """Record one finished span."""
+        with self._lock:
+            stats = self._spans.get((name, target))
+            if stats is None:
+                stats = self._spans[(name, target)] = _Stats()
+            stats.calls += 1
+            stats.errors += error
+            stats.seconds += seconds
+            stats.buckets[bisect_left(BUCKETS, seconds)] += 1
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of everything recorded so far.
+        Returns:
+            dict: 'buckets' (the histogram bounds) and 'spans', a list of dicts with
+                  'name', 'target', 'calls', 'errors', 'seconds', 'buckets'
+                  (non-cumulative counts, one more than the bounds),
+                  'bytes_read' and 'bytes_written', sorted by name and target
+        """
+        with self._lock:
+            spans = [{'name': name, 'target': target, 'calls': stats.calls, 'errors': stats.errors,
+                      'seconds': stats.seconds, 'buckets': list(stats.buckets),
+                      'bytes_read': stats.bytes_read, 'bytes_written': stats.bytes_written}
+                     for (name, target), stats in sorted(self._spans.items())]
+        return {'buckets': list(BUCKETS), 'spans': spans}
+
+    def reset(self) -> None:
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._spans = {}
+
+_registry = Registry()
+
+class _Span:
+    __slots__ = ('name', 'target', 'bytes_read', 'bytes_written', '_start')
+
+    def __init__(self, name: str, target: str):
+        self.name = name
+        self.target = target
+        self.bytes_read = self.bytes_written = 0
+
+    def add_bytes(self, read: int = 0, written: int = 0) -> None:
+        """Count bytes read or written inside the span."""
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _registry.observe(self.name, self.target, time.perf_counter() - self._start,
+                          exc_type is not None, self.bytes_read, self.bytes_written)
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add_bytes(self, read: int = 0, written: int = 0) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def span(name: str, target: str = ''):
+    """
+    Time the enclosed block as one call of a span.
+
+    Use as ``with span('storage.json.load', 'users') as s: ...``; call
+    ``s.add_bytes(read=..., written=...)`` to count the bytes it moves. A
+    block that raises is counted as an error.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, target)
+
+def timed(name: str):
+    """
+    Decorator recording every call of a function as a span.
+
+    For a function returning a generator, the span covers producing every
+    item, not the time the caller spends between them.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                _registry.observe(name, '', time.perf_counter() - start, True)
+                raise
+            if isinstance(result, GeneratorType):
+                return _timed_iteration(name, result, time.perf_counter() - start)
+            _registry.observe(name, '', time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorate
+
+def _timed_iteration(name: str, generator, elapsed: float):
+    error = False
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except BaseException:
+                error = True
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        generator.close()
+        _registry.observe(name, '', elapsed, error)
+
+def get_metrics() -> dict:
+    """
+    Return everything recorded in this process, see Registry.snapshot.
+    Returns:
+        dict: The snapshot, with 'enabled' telling whether recording is on
+    """
+    return {'enabled': _enabled, **_registry.snapshot()}
+
+def reset_metrics() -> None:
+    """Forget everything recorded in this process."""
+    with _saved_lock:
+        _registry.reset()
+        _saved.clear()
+
+def quantile(snapshot_span: dict, bounds: list, q: float):
+    """
+    Estimate a latency quantile of one span from its histogram.
+    Returns:
+        float: The upper bound of the bucket holding the quantile, in seconds
+               (None if it falls in the last, unbounded bucket or there are no calls)
+    """
+    rank, seen = q * snapshot_span['calls'], 0
+    for bound, count in zip(bounds, snapshot_span['buckets']):
+        seen += count
+        if seen and seen >= rank:
+            return bound
+    return None
+
+def _labels(**labels) -> str:
+    """Format Prometheus labels, leaving out empty ones."""
+    pairs = []
+    for key, value in labels.items():
+        if value != '':
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def prometheus_text(snapshot: dict = None) -> str:
+    """
+    Render a snapshot (this process's by default) in the Prometheus text exposition format.
+    """
+    if snapshot is None:
+        snapshot = get_metrics()
+    bounds = [*map(repr, snapshot['buckets']), '+Inf']
+    lines = ['# HELP whisperchain_span_seconds Time spent in instrumented code.',
+             '# TYPE whisperchain_span_seconds histogram']
+    for stats in snapshot['spans']:
+        cumulative = 0
+        for bound, count in zip(bounds, stats['buckets']):
+            cumulative += count
+            lines.append(f"whisperchain_span_seconds_bucket"
+                         f"{_labels(span=stats['name'], target=stats['target'], le=bound)} {cumulative}")
+        labels = _labels(span=stats['name'], target=stats['target'])
+        lines.append(f"whisperchain_span_seconds_sum{labels} {stats['seconds']!r}")
+        lines.append(f"whisperchain_span_seconds_count{labels} {stats['calls']}")
+    for field, help_text in (('errors', 'Spans that ended with an exception.'),
+                             ('bytes_read', 'Bytes read inside spans.'),
+                             ('bytes_written', 'Bytes written inside spans.')):
+        lines.append(f'# HELP whisperchain_span_{field}_total {help_text}')
+        lines.append(f'# TYPE whisperchain_span_{field}_total counter')
+        for stats in snapshot['spans']:
+            lines.append(f"whisperchain_span_{field}_total"
+                         f"{_labels(span=stats['name'], target=stats['target'])} {stats[field]}")
+    return '\n'.join(lines) + '\n'
+
+def dump_prometheus(path, snapshot: dict = None) -> None:
+    """Write a snapshot in the Prometheus text format, replacing ``path`` atomically."""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text(snapshot))
+    os.replace(tmp, path)
+
+def parse_prometheus(text: str) -> dict:
+    """
+    Read back a snapshot written by prometheus_text.
+    Returns:
+        dict: The snapshot, see Registry.snapshot
+    """
+    import re
+    sample = re.compile(r'^whisperchain_span_(seconds_bucket|seconds_sum|seconds_count|errors_total'
+                        r'|bytes_read_total|bytes_written_total)\{(.*)\} (\S+)$')
+    label = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+    bounds, spans = [], {}
+    for line in text.splitlines():
+        match = sample.match(line)
+        if match is None:
+            continue
+        field, labels, value = match.groups()
+        labels = {key: re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), raw)
+                  for key, raw in label.findall(labels)}
+        key = (labels['span'], labels.get('target', ''))
+        stats = spans.get(key)
+        if stats is None:
+            stats = spans[key] = {'name': key[0], 'target': key[1], 'calls': 0, 'errors': 0, 'seconds': 0.0,
+                                  'buckets': [], 'bytes_read': 0, 'bytes_written': 0}
+        if field == 'seconds_bucket':
+            # Buckets are written cumulatively, in order
+            stats['buckets'].append(int(value) - sum(stats['buckets']))
+            if len(spans) == 1 and labels['le'] != '+Inf':
+                bounds.append(float(labels['le']))
+        elif field == 'seconds_sum':
+            stats['seconds'] = float(value)
+        elif field == 'seconds_count':
+            stats['calls'] = int(value)
+        else:
+            stats[field[:-len('_total')]] = int(value)
+    return {'buckets': bounds, 'spans': [spans[key] for key in sorted(spans)]}
+
+def load_metrics(path):
+    """Return the snapshot kept in a Prometheus text file, or None if there is none."""
+    try:
+        with open(path) as f:
+            return parse_prometheus(f.read())
+    except FileNotFoundError:
+        return None
+
+def merge_snapshots(base: dict, other: dict, sign: int = 1) -> dict:
+    """Return the span totals of two snapshots added together (subtracted with ``sign=-1``)."""
+    spans = {(stats['name'], stats['target']): {**stats, 'buckets': list(stats['buckets'])}
+             for stats in base['spans']}
+    for stats in other['spans']:
+        total = spans.get((stats['name'], stats['target']))
+        if total is None:
+            total = spans[(stats['name'], stats['target'])] = {
+                'name': stats['name'], 'target': stats['target'], 'calls': 0, 'errors': 0, 'seconds': 0.0,
+                'buckets': [0] * len(stats['buckets']), 'bytes_read': 0, 'bytes_written': 0}
+        for field in ('calls', 'errors', 'seconds', 'bytes_read', 'bytes_written'):
+            total[field] += sign * stats[field]
+        total['buckets'] = [count + sign * added for count, added in zip(total['buckets'], stats['buckets'])]
+    return {'buckets': list(base['buckets']),
+            'spans': [spans[key] for key in sorted(spans) if spans[key]['calls']]}
+
+def merge_into_file(path, snapshot: dict) -> None:
+    """
+    Add a snapshot to the totals kept in a Prometheus text file. Writers
+    take a lock on ``<path>.lock``, so processes exiting together do not
+    lose each other's counts; totals with other histogram bounds are replaced.
+    """
+    with open(f'{path}.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        totals = load_metrics(path)
+        if totals is None or totals['buckets'] != snapshot['buckets']:
+            totals = {'buckets': snapshot['buckets'], 'spans': []}
+        dump_prometheus(path, merge_snapshots(totals, snapshot))
+
+# Snapshot each metrics file was last brought up to, per path, so repeated
+# saves add only what was recorded since
+_saved = {}
+_saved_lock = threading.Lock()
+
+def save_metrics(path=None) -> None:
+    """
+    Add what this process recorded since its last save to a metrics file
+    (METRICS_FILE by default). Every process with WHISPERCHAIN_METRICS_FILE
+    set does so when it exits; the daemon also saves periodically.
+    """
+    path = path or METRICS_FILE
+    if path is None:
+        return
+    with _saved_lock:
+        snapshot = _registry.snapshot()
+        previous = _saved.get(str(path))
+        delta = merge_snapshots(snapshot, previous, sign=-1) if previous is not None else snapshot
+        if delta['spans']:
+            merge_into_file(path, delta)
+        _saved[str(path)] = snapshot
+
+if METRICS_FILE is not None:
+    import atexit
+    atexit.register(save_metrics)
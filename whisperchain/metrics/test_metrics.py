@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from whisperchain.metrics import instrument
+from whisperchain.metrics.instrument import (get_metrics, load_metrics, parse_prometheus, prometheus_text, quantile,
+                                             reset_metrics, save_metrics, span, timed)
+from whisperchain.storage.engine import open_engine
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.was_enabled = instrument.enabled()
+        instrument.enable()
+        reset_metrics()
+
+    def tearDown(self):
+        instrument.enable(self.was_enabled)
+        reset_metrics()
+
+    def spans(self):
+        return {(stats['name'], stats['target']): stats for stats in get_metrics()['spans']}
+
+    def test_span_counts_calls_errors_and_bytes(self):
+        with span('test.block', 'a') as timing:
+            timing.add_bytes(read=10, written=3)
+        with self.assertRaises(KeyError):
+            with span('test.block', 'a'):
+                raise KeyError()
+        stats = self.spans()[('test.block', 'a')]
+        self.assertEqual((stats['calls'], stats['errors']), (2, 1))
+        self.assertEqual((stats['bytes_read'], stats['bytes_written']), (10, 3))
+        self.assertEqual(sum(stats['buckets']), 2)
+
+    def test_timed_generator_covers_iteration(self):
+        @timed('test.items')
+        def items():
+            yield from range(3)
+        self.assertEqual(list(items()), [0, 1, 2])
+        self.assertEqual(self.spans()[('test.items', '')]['calls'], 1)
+
+    def test_disabled_records_nothing(self):
+        instrument.enable(False)
+        timed('test.off')(lambda: None)()
+        with span('test.off') as timing:
+            timing.add_bytes(read=1)
+        self.assertEqual(get_metrics()['spans'], [])
+
+    def test_json_store_load_and_dump(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer, reader = open_engine("json", tmp), open_engine("json", tmp)
+            try:
+                writer.add_receiver("bob")
+                reader.receiver_exists("bob")
+            finally:
+                writer.close()
+                reader.close()
+        spans = self.spans()
+        written = spans[('storage.json.dump', 'receivers')]['bytes_written']
+        self.assertGreater(written, 0)
+        self.assertEqual(spans[('storage.json.load', 'receivers')]['bytes_read'], written)
+        self.assertIn(('storage.commit', 'json'), spans)
+
+    def test_prometheus_text(self):
+        for seconds in (0.00001, 0.002, 20):
+            instrument._registry.observe('test.op', 'x"y', seconds, bytes_read=5)
+        snapshot = get_metrics()
+        text = prometheus_text(snapshot)
+        self.assertIn('whisperchain_span_seconds_bucket{span="test.op",target="x\\"y",le="0.0025"} 2', text)
+        self.assertIn('whisperchain_span_seconds_bucket{span="test.op",target="x\\"y",le="+Inf"} 3', text)
+        self.assertIn('whisperchain_span_seconds_count{span="test.op",target="x\\"y"} 3', text)
+        self.assertIn('whisperchain_span_bytes_read_total{span="test.op",target="x\\"y"} 15', text)
+        stats = snapshot['spans'][0]
+        self.assertEqual(quantile(stats, snapshot['buckets'], 0.5), 0.0025)
+        self.assertIsNone(quantile(stats, snapshot['buckets'], 0.99))
+
+    def test_prometheus_text_parsed_back(self):
+        instrument._registry.observe('test.op', 'a"b\\c\nd', 0.003, bytes_read=4)
+        instrument._registry.observe('test.op', '', 0.3, error=True, bytes_written=2)
+        snapshot = get_metrics()
+        del snapshot['enabled']
+        self.assertEqual(parse_prometheus(prometheus_text(snapshot)), snapshot)
+
+    def test_processes_add_to_metrics_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'whisperchain.prom')
+            instrument._registry.observe('test.op', '', 0.001)
+            save_metrics(path)
+            # Saving again adds only what was recorded since
+            instrument._registry.observe('test.op', '', 0.001)
+            save_metrics(path)
+            save_metrics(path)
+            # Another process's counts are added, not overwritten
+            reset_metrics()
+            instrument._registry.observe('test.op', '', 0.001)
+            instrument._registry.observe('test.other', '', 0.001)
+            save_metrics(path)
+            calls = {stats['name']: stats['calls'] for stats in load_metrics(path)['spans']}
+        self.assertEqual(calls, {'test.op': 3, 'test.other': 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,10 @@
-from auth.register import get_user_role
+import threading
+from types import MappingProxyType
+from typing import Iterable, Optional
+
+from whisperchain.auth.register import VALID_ROLES
+from whisperchain.metrics.instrument import timed
+from whisperchain.storage.engine import get_engine, retry_on_conflict
 
 # Define role permissions
 ROLE_PERMISSIONS = {
@@ -22,6 +28,70 @@ ROLE_PERMISSIONS = {
     }
 }
 
+# One bit per permission, in the order the permissions are listed above
+PERMISSION_BITS = MappingProxyType({
+    permission: 1 << bit for bit, permission in enumerate(
+        dict.fromkeys(permission for permissions in ROLE_PERMISSIONS.values() for permission in permissions))
+})
+
+# Each role's permissions as a bitmask, fixed when the module is imported
+ROLE_MASKS = MappingProxyType({
+    role: sum(PERMISSION_BITS[permission] for permission, allowed in permissions.items() if allowed)
+    for role, permissions in ROLE_PERMISSIONS.items()
+})
+
+class PermissionCache:
+    """
+    Permission masks of users, by username.
+
+    Entries are dropped whenever the storage engine reports a new version
+    of the user store, so a check costs a version lookup, a dict lookup and
+    a bit test instead of reading the user's record.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engine = None
+        self._version = None
+        self._masks = {}
+
+    def mask(self, username: str) -> Optional[int]:
+        """Return a user's permission mask, or None if the user does not exist."""
+        return self.masks([username])[username]
+
+    def masks(self, usernames: Iterable[str]) -> dict:
+        """Return {username: mask or None} for several users, reading the misses in one call."""
+        engine = get_engine()
+        version = engine.users_version()
+        with self._lock:
+            if engine is not self._engine or version != self._version:
+                self._engine, self._version, self._masks = engine, version, {}
+            cached = self._masks
+            result = {username: cached.get(username, 0) for username in usernames}
+        missing = [username for username in result if username not in cached]
+        if missing:
+            roles = engine.get_user_roles(missing)
+            for username in missing:
+                role = roles.get(username)
+                result[username] = None if role is None else ROLE_MASKS.get(role, 0)
+            # Records read inside a transaction may still be rolled back
+            if not engine.in_transaction():
+                with self._lock:
+                    if engine is self._engine and version == self._version:
+                        self._masks.update((username, result[username]) for username in missing)
+        return result
+
+    def invalidate(self, username: str = None) -> None:
+        """Drop one user's entry, or every entry."""
+        with self._lock:
+            if username is None:
+                self._masks = {}
+            else:
+                self._masks.pop(username, None)
+
+_permissions = PermissionCache()
+
+@timed('rbac.check_permission')
 def check_permission(username: str, permission: str) -> bool:
     """
     Check if a user has permission to perform an action.
@@ -33,11 +103,8 @@ def check_permission(username: str, permission: str) -> bool:
     Returns:
         bool: True if the user has permission, False otherwise
     """
-    try:
-        role = get_user_role(username)
-        return ROLE_PERMISSIONS[role].get(permission, False)
-    except ValueError:
-        return False
+    mask = _permissions.mask(username)
+    return mask is not None and bool(mask & PERMISSION_BITS.get(permission, 0))
 
 def get_user_permissions(username: str) -> dict:
     """
@@ -49,8 +116,68 @@ def get_user_permissions(username: str) -> dict:
     Returns:
         dict: Dictionary of permission: bool pairs
     """
-    try:
-        role = get_user_role(username)
-        return ROLE_PERMISSIONS[role].copy()
-    except ValueError:
-        return {} 
\ No newline at end of file
+    mask = _permissions.mask(username)
+    if mask is None:
+        return {}
+    return {permission: bool(mask & bit) for permission, bit in PERMISSION_BITS.items()}
+
+@timed('rbac.check_permissions_bulk')
+def check_permissions_bulk(usernames: Iterable[str], permissions: Iterable[str]) -> dict:
+    """
+    Check several permissions for many users at once.
+
+    Users not already cached are looked up together in one read of the
+    user store.
+    Args:
+        usernames: The users to check
+        permissions: The permissions to check
+    Returns:
+        dict: {username: mask}, where a permission is held if
+              ``mask & PERMISSION_BITS[permission]``; 0 for unknown users
+    """
+    wanted = 0
+    for permission in permissions:
+        wanted |= PERMISSION_BITS.get(permission, 0)
+    return {username: (mask or 0) & wanted for username, mask in _permissions.masks(usernames).items()}
+
+@timed('rbac.users_with_permission')
+def users_with_permission(permission: str) -> list:
+    """
+    List the users holding a permission, from the storage engine's
+    role -> users index rather than a scan of every user.
+    Args:
+        permission: The permission to look for
+    Returns:
+        list: Sorted usernames
+    """
+    bit = PERMISSION_BITS.get(permission, 0)
+    engine = get_engine()
+    usernames = []
+    for role, mask in ROLE_MASKS.items():
+        if mask & bit:
+            usernames.extend(engine.find_users_by_role(role))
+    return sorted(usernames)
+
+@retry_on_conflict
+def set_user_role(username: str, role: str) -> None:
+    """
+    Change a user's role.
+    Args:
+        username: The user whose role changes
+        role: The new role (Sender, Receiver, Moderator or Admin)
+    Raises:
+        ValueError: If the user does not exist or the role is invalid
+    """
+    if role.lower() not in VALID_ROLES:
+        raise ValueError("Invalid role. Must be one of: Sender, Receiver, Moderator, Admin")
+    engine = get_engine()
+    with engine.transaction():
+        user = engine.get_user(username)
+        if user is None:
+            raise ValueError("User does not exist")
+        engine.add_user(username, {**user, 'role': role})
+    _permissions.invalidate(username)
+
+def invalidate_permissions(username: str = None) -> None:
+    """Forget cached permissions of one user, or of every user."""
+    _permissions.invalidate(username)
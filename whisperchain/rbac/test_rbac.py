@@ -1,6 +1,11 @@
 import unittest
-from whisperchain.rbac.access_control import check_permission
+from unittest import mock
+from whisperchain.rbac.access_control import (PERMISSION_BITS, ROLE_MASKS, check_permission,
+                                              check_permissions_bulk, get_user_permissions, set_user_role,
+                                              users_with_permission)
 from whisperchain.auth.register import register_user
+from whisperchain.storage.engine import ConflictError, open_engine
+from whisperchain.storage.testing import TempEngineTestCase
 
 class TestRBAC(unittest.TestCase):
     def setUp(self):
@@ -33,5 +38,58 @@ class TestRBAC(unittest.TestCase):
         self.assertTrue(check_permission("moderator_test", "view_messages"))
         self.assertTrue(check_permission("moderator_test", "flag_message"))
 
+class TestPermissionCache(TempEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+
+    def test_checks_served_from_cache(self):
+        self.assertTrue(check_permission("alice", "send_message"))
+        with mock.patch.object(self.engine, "get_user", wraps=self.engine.get_user) as get_user:
+            for _ in range(10):
+                self.assertTrue(check_permission("alice", "get_token"))
+                self.assertFalse(check_permission("alice", "flag_message"))
+            self.assertEqual(get_user.call_count, 0)
+        self.assertEqual(get_user_permissions("alice"), {"get_token": True, "send_message": True,
+                                                         "view_messages": False, "flag_message": False})
+        self.assertEqual(get_user_permissions("nobody"), {})
+        with self.assertRaises(TypeError):
+            ROLE_MASKS["Sender"] = 0
+
+    def test_role_change_invalidates(self):
+        self.assertFalse(check_permission("alice", "flag_message"))
+        set_user_role("alice", "Moderator")
+        self.assertTrue(check_permission("alice", "flag_message"))
+        # A write by another process shows up through the store's version
+        other = open_engine("json", self.tmp.name)
+        other.add_user("alice", {**other.get_user("alice"), "role": "Sender"})
+        self.assertFalse(check_permission("alice", "flag_message"))
+        self.assertFalse(check_permission("bob", "send_message"))
+        register_user("bob", "password123", "Sender", "bob@dartmouth.edu")
+        self.assertTrue(check_permission("bob", "send_message"))
+        with self.assertRaises(ValueError):
+            set_user_role("nobody", "Sender")
+        other.close()
+
+    def test_role_change_retried_after_conflict(self):
+        # Another process commits to the user store first
+        conflict = ConflictError("'users' was changed by another process")
+        with mock.patch.object(self.engine, "_check_versions", side_effect=[conflict, None]):
+            set_user_role("alice", "Moderator")
+        self.assertEqual(self.engine.get_user("alice")["role"], "Moderator")
+
+    def test_bulk_checks(self):
+        register_user("mod", "password123", "Moderator", "mod@dartmouth.edu")
+        register_user("bob", "password123", "Receiver", "bob@dartmouth.edu")
+        with mock.patch.object(self.engine, "get_user_roles", wraps=self.engine.get_user_roles) as lookup:
+            masks = check_permissions_bulk(["alice", "mod", "bob", "nobody"], ["view_messages", "flag_message"])
+            self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(masks, {"alice": 0, "nobody": 0, "bob": PERMISSION_BITS["view_messages"],
+                                 "mod": PERMISSION_BITS["view_messages"] | PERMISSION_BITS["flag_message"]})
+        self.assertEqual(users_with_permission("view_messages"), ["bob", "mod"])
+        set_user_role("alice", "Moderator")
+        self.assertEqual(users_with_permission("flag_message"), ["alice", "mod"])
+        self.assertEqual(users_with_permission("get_token"), [])
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
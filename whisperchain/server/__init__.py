@@ -0,0 +1,3 @@
+"""
+Local server mode for WhisperChain+.
+"""
@@ -0,0 +1,81 @@
+import json
+import os
+from pathlib import Path
+
+from whisperchain.storage.engine import DB_DIR
+
+SOCKET_PATH = Path(os.environ.get('WHISPERCHAIN_SOCKET', DB_DIR / 'whisperchain.sock'))
+
+class RemoteError(RuntimeError):
+    """An operation failed inside the daemon with an unexpected error."""
+
+class Client:
+    """
+    Connection to a running daemon.
+
+    Operations are called as methods, e.g. ``client.send_message(...)``;
+    each call is one JSON request line and one JSON response line.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+    def call(self, op: str, *args, **kwargs):
+        """Run an operation in the daemon and return its result."""
+        request = {'op': op, 'args': list(args), 'kwargs': kwargs}
+        self._sock.sendall(json.dumps(request).encode() + b'\n')
+        line = self._file.readline()
+        if not line:
+            raise RemoteError("Daemon closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            # ValueError carries the user-facing messages; keep its type
+            if response.get('type') == 'ValueError':
+                raise ValueError(response['error'])
+            raise RemoteError(response['error'])
+        return response['result']
+
+    def __getattr__(self, op: str):
+        return lambda *args, **kwargs: self.call(op, *args, **kwargs)
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+class LocalClient:
+    """Runs operations in this process, for when no daemon is running."""
+
+    def call(self, op: str, *args, **kwargs):
+        from whisperchain.server.operations import run_operation
+        return run_operation(op, args, kwargs)
+
+    def __getattr__(self, op: str):
+        return lambda *args, **kwargs: self.call(op, *args, **kwargs)
+
+    def close(self) -> None:
+        pass
+
+def connect(socket_path=None):
+    """
+    Connect to the daemon, falling back to running operations in-process.
+    Args:
+        socket_path: The daemon's socket (defaults to SOCKET_PATH)
+    Returns:
+        Client or LocalClient: An object exposing the operations as methods
+    """
+    path = Path(socket_path) if socket_path is not None else SOCKET_PATH
+    if not path.exists():
+        return LocalClient()
+    # Only needed when a daemon may be listening; it is slow to import
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return LocalClient()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except (ConnectionRefusedError, FileNotFoundError):
+        # A socket file left behind by a daemon that is no longer running
+        sock.close()
+        return LocalClient()
+    return Client(sock)
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+import signal
+from pathlib import Path
+
+from whisperchain.metrics.instrument import enable, save_metrics
+from whisperchain.server.client import SOCKET_PATH, Client, connect
+from whisperchain.server.service import SEND_BATCH_SIZE, SEND_BATCH_WINDOW_MS, Service
+from whisperchain.storage.engine import open_engine, set_engine
+from whisperchain.tokens.generate import start_token_sweeper
+
+# Longest request line accepted from a client
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+# Message and flag IDs reserved at a time, so daemons sharing a data
+# directory rarely meet on the ID counters
+ID_BLOCK = 100
+
+# Seconds between writes of the metrics file, when one is configured
+METRICS_DUMP_INTERVAL = 15
+
+async def handle_client(service: Service, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Serve JSON-line requests from one client connection, one at a time."""
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                result = await service.call(request['op'], request.get('args', []), request.get('kwargs', {}))
+                response = {'result': result}
+            except Exception as e:
+                response = {'error': str(e), 'type': type(e).__name__}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_server(socket_path, service: Service) -> asyncio.AbstractServer:
+    """Start accepting clients on a Unix socket."""
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_client(service, reader, writer),
+        path=str(socket_path), limit=MAX_REQUEST_BYTES)
+    os.chmod(socket_path, 0o600)
+    return server
+
+async def dump_metrics(path, interval: float = METRICS_DUMP_INTERVAL) -> None:
+    """Add what was recorded to the Prometheus metrics file every ``interval`` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        save_metrics(path)
+
+def serve(socket_path=None, ready=None, batch_window_ms: float = None, batch_size: int = None,
+          metrics: bool = False, metrics_file=None) -> None:
+    """
+    Run the daemon until it is interrupted or sent SIGTERM.
+
+    The storage engine is opened with its document cache enabled, so stores
+    stay parsed in memory between requests; every write still goes straight
+    to disk. Requests are served concurrently by a Service.
+    Args:
+        socket_path: Where to listen (defaults to SOCKET_PATH)
+        ready: Called once the socket is accepting connections
+        batch_window_ms: Longest a send waits to share a commit (defaults to SEND_BATCH_WINDOW_MS)
+        batch_size: Most sends committed together (defaults to SEND_BATCH_SIZE)
+        metrics: Record instrumentation spans (see metrics/instrument.py)
+        metrics_file: Add the metrics to the totals in this Prometheus text file
+            every METRICS_DUMP_INTERVAL seconds and on exit (see save_metrics)
+    Raises:
+        ValueError: If another daemon is already listening there
+    """
+    path = Path(socket_path) if socket_path is not None else SOCKET_PATH
+    if path.exists():
+        client = connect(path)
+        if isinstance(client, Client):
+            client.close()
+            raise ValueError(f"A daemon is already listening on {path}")
+        path.unlink()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if metrics or metrics_file:
+        enable()
+    engine = open_engine(cache=True, id_block=ID_BLOCK)
+    previous = set_engine(engine)
+    stop_sweeper = start_token_sweeper()
+    service = Service(batch_window_ms=SEND_BATCH_WINDOW_MS if batch_window_ms is None else batch_window_ms,
+                      batch_size=batch_size or SEND_BATCH_SIZE)
+
+    async def run():
+        server = await start_server(path, service)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        dumper = asyncio.create_task(dump_metrics(metrics_file)) if metrics_file else None
+        if ready is not None:
+            ready()
+        async with server:
+            await stop.wait()
+        if dumper is not None:
+            dumper.cancel()
+
+    try:
+        asyncio.run(run())
+    finally:
+        service.close()
+        if metrics_file:
+            save_metrics(metrics_file)
+        stop_sweeper.set()
+        path.unlink(missing_ok=True)
+        set_engine(previous)
+        engine.close()
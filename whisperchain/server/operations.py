@@ -0,0 +1,58 @@
+from types import GeneratorType
+
+# Module defining each operation clients may run, by operation name. Modules
+# are imported on first use, so a CLI command only loads what it calls.
+OPERATION_MODULES = {
+    'register_user': 'whisperchain.auth.register',
+    'register_users_bulk': 'whisperchain.auth.register',
+    'login_user': 'whisperchain.auth.register',
+    'start_session': 'whisperchain.auth.session',
+    'verify_session': 'whisperchain.auth.session',
+    'revoke_session': 'whisperchain.auth.session',
+    'generate_token': 'whisperchain.tokens.generate',
+    'generate_tokens': 'whisperchain.tokens.generate',
+    'send_message': 'whisperchain.messaging.send',
+    'send_messages': 'whisperchain.messaging.send',
+    'get_receiver_messages': 'whisperchain.messaging.send',
+    'get_receiver_page': 'whisperchain.messaging.send',
+    'mark_messages_read': 'whisperchain.messaging.send',
+    'flag_message': 'whisperchain.messaging.flag',
+    'flag_messages': 'whisperchain.messaging.flag',
+    'list_flags': 'whisperchain.messaging.flag',
+    'list_unreviewed': 'whisperchain.messaging.flag',
+    'check_permission': 'whisperchain.rbac.access_control',
+    'check_permissions_bulk': 'whisperchain.rbac.access_control',
+    'users_with_permission': 'whisperchain.rbac.access_control',
+    'log_event': 'whisperchain.logging.audit',
+    'get_metrics': 'whisperchain.metrics.instrument',
+    'reset_metrics': 'whisperchain.metrics.instrument',
+}
+
+def get_operation(op: str):
+    """
+    Return the function implementing an operation, importing its module.
+    Raises:
+        ValueError: If the operation is unknown
+    """
+    if op not in OPERATION_MODULES:
+        raise ValueError(f"Unknown operation '{op}'")
+    # __import__ rather than importlib.import_module, whose imports
+    # ``python -X importtime`` leaves out of its report
+    return getattr(__import__(OPERATION_MODULES[op], fromlist=[op]), op)
+
+def run_operation(op: str, args, kwargs):
+    """
+    Run one operation by name in the calling thread.
+    Args:
+        op: The operation's name, a key of OPERATION_MODULES
+        args: Positional arguments
+        kwargs: Keyword arguments
+    Returns:
+        The operation's result, with generators read into lists
+    Raises:
+        ValueError: If the operation is unknown or fails validation
+    """
+    result = get_operation(op)(*args, **kwargs)
+    if isinstance(result, GeneratorType):
+        result = list(result)
+    return result
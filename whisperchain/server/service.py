@@ -0,0 +1,200 @@
+import asyncio
+import functools
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from whisperchain.auth.register import (_check_password, _hash_password, _needs_rehash, _update_password_hash,
+                                        get_user_role, register_user_hashed)
+from whisperchain.auth.session import get_authority
+from whisperchain.messaging.send import send_messages
+from whisperchain.metrics.instrument import span
+from whisperchain.server.operations import OPERATION_MODULES, get_operation, run_operation
+from whisperchain.storage.engine import get_engine, retry_on_conflict
+
+# Threads running storage calls; the engine serializes transactions, so a
+# few are enough to keep the event loop free while one commits
+IO_WORKERS = 4
+
+# Longest a send waits for others to share its commit, and the most sends
+# committed together; a full batch commits at once
+SEND_BATCH_WINDOW_MS = 2
+SEND_BATCH_SIZE = 64
+
+# Operations that hash passwords before opening their own transactions;
+# wrapping them in one would hold the engine lock while they hash
+OWN_TRANSACTIONS = {'register_users_bulk'}
+
+class GroupCommit:
+    """
+    Collects concurrent calls and runs them as one batch.
+
+    The first call waits up to ``window_ms`` for others to join it, or less
+    if ``max_size`` calls arrive first. One batch runs at a time; calls that
+    arrive while it commits form the next one, which starts as soon as it
+    finishes. Each caller gets back its own result or error.
+    """
+
+    def __init__(self, run_batch, window_ms: float = SEND_BATCH_WINDOW_MS, max_size: int = SEND_BATCH_SIZE):
+        """
+        Args:
+            run_batch: Coroutine function taking a list of items and returning
+                (result, error message or None) for each, in order
+            window_ms: Longest time a call waits for the batch to fill
+            max_size: Most calls in one batch
+        """
+        self.run_batch = run_batch
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self._pending = []
+        self._timer = None
+        self._running = None
+
+    async def submit(self, item):
+        """Add an item to the next batch and return its result once committed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None and self._running is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._running is not None or not self._pending:
+            return
+        batch, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+        self._running = asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list) -> None:
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ValueError(error))
+        finally:
+            self._running = None
+            # Calls that queued up during the commit have waited long enough
+            self._flush()
+
+class Service:
+    """
+    Asyncio core serving WhisperChain+ operations concurrently.
+
+    Clients are served on the event loop. Each storage call runs on a
+    small thread pool inside an engine transaction; the engine serializes
+    transactions, so storage calls run one at a time while the loop goes
+    on accepting requests. Password hashing runs on its own pool before
+    any transaction is opened, so a burst of logins does not hold up
+    sends. Concurrent sends are group committed: gathered for a few
+    milliseconds and persisted in one transaction (see GroupCommit).
+    """
+
+    def __init__(self, io_workers: int = IO_WORKERS, hash_workers: int = None,
+                 batch_window_ms: float = SEND_BATCH_WINDOW_MS, batch_size: int = SEND_BATCH_SIZE):
+        """
+        Args:
+            io_workers: Threads running storage calls
+            hash_workers: Threads hashing passwords (defaults to the CPU count)
+            batch_window_ms: Longest a send waits for others to share its commit
+            batch_size: Most sends committed together (1 commits each send alone)
+        """
+        self._io = ThreadPoolExecutor(io_workers, thread_name_prefix='whisperchain-io')
+        self._hash = ThreadPoolExecutor(hash_workers or os.cpu_count() or 1,
+                                        thread_name_prefix='whisperchain-hash')
+        self._sends = None
+        if batch_size > 1:
+            self._sends = GroupCommit(functools.partial(self._storage, send_messages),
+                                      batch_window_ms, batch_size)
+
+    def close(self) -> None:
+        self._io.shutdown()
+        self._hash.shutdown()
+
+    async def _in(self, executor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *args))
+
+    @staticmethod
+    @retry_on_conflict
+    def _transaction(function, *args, **kwargs):
+        with get_engine().transaction():
+            return function(*args, **kwargs)
+
+    async def _storage(self, function, *args, **kwargs):
+        """Run a storage call on the I/O pool inside an engine transaction."""
+        return await self._in(self._io, functools.partial(self._transaction, function, *args, **kwargs))
+
+    async def call(self, op: str, args=(), kwargs=None):
+        """
+        Run one operation by name.
+        Returns:
+            The operation's result, with generators read into lists
+        Raises:
+            ValueError: If the operation is unknown or fails validation
+        """
+        with span('server.request', op if op in OPERATION_MODULES else 'unknown'):
+            return await self._dispatch(op, args, kwargs or {})
+
+    async def _dispatch(self, op: str, args, kwargs: dict):
+        if op == 'register_user':
+            return await self.register_user(*args, **kwargs)
+        if op == 'login_user':
+            return await self.login_user(*args, **kwargs)
+        if op == 'start_session':
+            return await self.start_session(*args, **kwargs)
+        if op not in OPERATION_MODULES:
+            raise ValueError(f"Unknown operation '{op}'")
+        if op == 'send_message' and self._sends is not None:
+            # Sends in one batch share a transaction, which orders them
+            arguments = self._bind(op, args, kwargs)
+            return await self._sends.submit((arguments['username'], arguments['token'],
+                                             arguments['message'], arguments['receiver']))
+        if op in OWN_TRANSACTIONS:
+            return await self._in(self._io, run_operation, op, args, kwargs)
+        return await self._storage(run_operation, op, args, kwargs)
+
+    def _bind(self, op: str, args, kwargs) -> dict:
+        """Return an operation's arguments by name, with defaults filled in."""
+        try:
+            bound = inspect.signature(get_operation(op)).bind(*args, **kwargs)
+        except TypeError as e:
+            raise ValueError(str(e))
+        bound.apply_defaults()
+        return bound.arguments
+
+    async def register_user(self, username: str, password: str, role: str, email: str) -> None:
+        """Register a user, hashing the password off the event loop."""
+        hashed_password, salt = await self._in(self._hash, _hash_password, password)
+        await self._storage(register_user_hashed, username, hashed_password, salt, role, email)
+
+    async def login_user(self, username: str, password: str) -> bool:
+        """Verify credentials, hashing the password off the event loop."""
+        user = await self._storage(get_engine().get_user, username)
+        if user is None:
+            return False
+        if not await self._in(self._hash, _check_password, user, password):
+            return False
+        if _needs_rehash(user):
+            hashed_password, salt = await self._in(self._hash, _hash_password, password)
+            await self._storage(_update_password_hash, username, user['password_hash'], hashed_password, salt)
+        return True
+
+    async def start_session(self, username: str, password: str, ttl: int = None) -> str:
+        """Log a user in and issue a session ticket, hashing off the event loop."""
+        if not await self.login_user(username, password):
+            raise ValueError("Invalid credentials!")
+        role = await self._storage(get_user_role, username)
+        return get_authority().issue(username, role, ttl)
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from whisperchain.server.client import Client, LocalClient, connect
+from whisperchain.server.daemon import start_server
+from whisperchain.auth.register import _hash_password
+from whisperchain.messaging.send import send_messages
+from whisperchain.server.service import Service, run_operation
+from whisperchain.storage.engine import open_engine
+from whisperchain.storage.testing import TempEngineTestCase
+from whisperchain.tokens.generate import generate_tokens
+
+class TestDaemon(TempEngineTestCase):
+    cache = True
+
+    def setUp(self):
+        super().setUp()
+        self.socket_path = os.path.join(self.tmp.name, "test.sock")
+        self.service = Service()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            start_server(self.socket_path, self.service), self.loop).result()
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.service.close()
+        super().tearDown()
+
+    async def _shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def test_operations_over_socket(self):
+        client = connect(self.socket_path)
+        self.assertIsInstance(client, Client)
+        try:
+            client.register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+            self.assertTrue(client.login_user("alice", "password123"))
+            self.assertFalse(client.login_user("alice", "wrong"))
+            ticket = client.start_session("alice", "password123")
+            self.assertEqual(client.verify_session(ticket)["username"], "alice")
+            with self.assertRaises(ValueError):
+                client.start_session("alice", "wrong")
+            self.engine.add_receiver("bob")
+            token = client.generate_token("alice")
+            message_id = client.send_message("alice", token, "Hello", "bob")
+            messages = client.get_receiver_messages("bob")
+            self.assertEqual([m["message_id"] for m in messages], [str(message_id)])
+            with self.assertRaises(ValueError):
+                client.send_message("alice", token, "Again", "bob")
+            with self.assertRaises(ValueError):
+                client.no_such_operation()
+        finally:
+            client.close()
+
+    def test_falls_back_without_daemon(self):
+        self.assertIsInstance(connect(os.path.join(self.tmp.name, "missing.sock")), LocalClient)
+        stale = os.path.join(self.tmp.name, "stale")
+        open(stale, "w").close()
+        self.assertIsInstance(connect(stale), LocalClient)
+
+    def test_run_operation_reads_generators(self):
+        self.engine.add_receiver("bob")
+        self.assertEqual(run_operation("get_receiver_messages", ["bob"], {}), [])
+
+class TestService(TempEngineTestCase):
+    cache = True
+
+    def setUp(self):
+        super().setUp()
+        self.service = Service()
+
+    def tearDown(self):
+        self.service.close()
+        super().tearDown()
+
+    def test_concurrent_sends_and_views(self):
+        receivers = [f"r{i}" for i in range(5)]
+        for receiver in receivers:
+            self.engine.add_receiver(receiver)
+        tokens = generate_tokens("alice", 50)
+
+        async def run():
+            await self.service.call("register_user", ["alice", "pw", "Sender", "alice@dartmouth.edu"])
+            sends = [self.service.call("send_message", ["alice", token, f"m{i}", receivers[i % 5]])
+                     for i, token in enumerate(tokens)]
+            # Spending a token twice fails for exactly one of the two callers
+            sends.append(self.service.call("send_message", ["alice", tokens[0], "again", "r0"]))
+            results = await asyncio.gather(*sends, return_exceptions=True)
+            views = await asyncio.gather(*(self.service.call("get_receiver_messages", [r], {"limit": None})
+                                           for r in receivers))
+            return results, views, await self.service.call("login_user", ["alice", "pw"])
+
+        results, views, logged_in = asyncio.run(run())
+        self.assertEqual(sum(isinstance(r, ValueError) for r in results), 1)
+        self.assertEqual(len({r for r in results if isinstance(r, int)}), 50)
+        self.assertEqual(sum(len(view) for view in views), 50)
+        self.assertTrue(logged_in)
+
+    def test_sends_group_committed(self):
+        self.engine.add_receiver("bob")
+        tokens = generate_tokens("alice", 10)
+        with mock.patch("whisperchain.server.service.send_messages", wraps=send_messages) as batch:
+            service = Service(batch_window_ms=50, batch_size=8)
+
+            async def run():
+                sends = [service.call("send_message", ["alice", token, f"m{i}", "bob"])
+                         for i, token in enumerate(tokens)]
+                sends.append(service.call("send_message", [], {"username": "alice", "token": tokens[0],
+                                                               "message": "lost", "receiver": "nobody"}))
+                return await asyncio.gather(*sends, return_exceptions=True)
+
+            try:
+                results = asyncio.run(run())
+            finally:
+                service.close()
+        self.assertEqual(len(set(results[:10])), 10)
+        self.assertIsInstance(results[10], ValueError)
+        self.assertIn("nobody", str(results[10]))
+        # A full batch of 8 commits at once; the other 3 share the next commit
+        self.assertEqual([len(call.args[0]) for call in batch.call_args_list], [8, 3])
+
+    def test_bulk_import_hashes_outside_transaction(self):
+        rows = [{"username": "bulk", "password": "pw", "role": "Sender", "email": "bulk@dartmouth.edu"}]
+        in_transaction = []
+
+        def hash_password(password):
+            in_transaction.append(self.engine.in_transaction())
+            return _hash_password(password)
+
+        with mock.patch("whisperchain.auth.register._hash_password", hash_password):
+            registered, errors = asyncio.run(self.service.call("register_users_bulk", [rows], {"workers": 1}))
+        self.assertEqual((registered, errors), (["bulk"], []))
+        self.assertEqual(in_transaction, [False])
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.service.call("no_such_operation"))
+
+class TestDocumentCache(unittest.TestCase):
+    def test_cache_reloads_replaced_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cached = open_engine("json", tmp, cache=True)
+            other = open_engine("json", tmp)
+            cached.add_receiver("bob")
+            self.assertTrue(cached.receiver_exists("bob"))
+            other.add_receiver("carol")
+            self.assertTrue(cached.receiver_exists("carol"))
+            with self.assertRaises(RuntimeError):
+                with cached.transaction():
+                    cached.add_receiver("dave")
+                    raise RuntimeError("abort")
+            self.assertFalse(cached.receiver_exists("dave"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,3 @@
+"""
+Storage engine module for WhisperChain+.
+"""
@@ -0,0 +1,60 @@
+from typing import Callable, Iterable
+
+def new_bitmap() -> dict:
+    """
+    Return an empty bitmap.
+
+    A bitmap is stored as a JSON-friendly dict: every position below
+    ``base`` is set, and ``bits`` holds the positions from ``base`` up as a
+    hex-encoded integer. Bits that fill in contiguously from the start are
+    folded into ``base``, so a mostly-set bitmap stays a few bytes long.
+    """
+    return {'base': 0, 'bits': '0'}
+
+def _bits(bitmap: dict) -> int:
+    return int(bitmap['bits'], 16)
+
+def _store(bitmap: dict, base: int, bits: int) -> None:
+    # Fold the run of set bits at the bottom into base
+    run = (~bits & (bits + 1)).bit_length() - 1
+    bitmap['base'] = base + run
+    bitmap['bits'] = format(bits >> run, 'x')
+
+def is_set(bitmap: dict, position: int) -> bool:
+    """Return True if a position is set."""
+    return reader(bitmap)(position)
+
+def reader(bitmap: dict) -> Callable[[int], bool]:
+    """
+    Return a function telling whether a position is set, for testing many
+    positions. The bitmap is decoded once, into bytes, so each test costs
+    the same however long the bitmap is; later changes to it are not seen.
+    """
+    base, bits = bitmap['base'], _bits(bitmap)
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+    def test(position: int) -> bool:
+        if position < base:
+            return True
+        offset = position - base
+        index = offset >> 3
+        return index < len(data) and bool(data[index] >> (offset & 7) & 1)
+    return test
+
+def set_bits(bitmap: dict, positions: Iterable[int]) -> int:
+    """
+    Set positions in a bitmap.
+    Returns:
+        int: The number of positions that were not already set
+    """
+    base, bits = bitmap['base'], _bits(bitmap)
+    changed = 0
+    for position in positions:
+        if position < base:
+            continue
+        mask = 1 << (position - base)
+        if not bits & mask:
+            bits |= mask
+            changed += 1
+    _store(bitmap, base, bits)
+    return changed
@@ -0,0 +1,232 @@
+import json
+import os
+import struct
+import sys
+from array import array
+
+# Codec new documents are written with; any codec's files can be read
+DEFAULT_CODEC = os.environ.get('WHISPERCHAIN_CODEC', 'json')
+
+# Binary documents start with this header: magic, format version, flags,
+# number of interned keys and length of the body that follows the key table
+MAGIC = b'WCBF'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+
+# Value tags of the binary format
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _DICT, _BIGINT, _INTS = range(10)
+
+_U32 = struct.Struct('<I')
+_TAG_U32 = struct.Struct('<BI')
+_TAG_I64 = struct.Struct('<Bq')
+_TAG_F64 = struct.Struct('<Bd')
+_I64_MIN, _I64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# Array typecodes tried for lists of integers, narrowest first
+_INT_ARRAYS = [(code, -2 ** (8 * array(code).itemsize - 1), 2 ** (8 * array(code).itemsize - 1) - 1)
+               for code in 'bhiq']
+
+def _int_array_code(values) -> str:
+    """Return the narrowest array typecode holding a non-empty list of integers, or None."""
+    if not values or not all(type(value) is int for value in values):
+        return None
+    low, high = min(values), max(values)
+    for code, lowest, highest in _INT_ARRAYS:
+        if lowest <= low and high <= highest:
+            return code
+    return None
+
+class Codec:
+    """Turns a store document (JSON-compatible values) into bytes and back."""
+    name = None
+
+    def encode(self, doc) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data):
+        """Decode a document from a bytes-like object."""
+        raise NotImplementedError
+
+class JSONCodec(Codec):
+    """
+    JSON text. The compact form (the default) leaves out all whitespace;
+    ``indent`` gives the layout files had before codecs were introduced.
+    """
+
+    def __init__(self, name: str, indent: int = None):
+        self.name = name
+        self.indent = indent
+        self.separators = (',', ': ') if indent is not None else (',', ':')
+
+    def encode(self, doc) -> bytes:
+        # json.dumps uses the C encoder for the whole document; json.dump
+        # and indented output go through the pure-Python one
+        return json.dumps(doc, indent=self.indent, separators=self.separators).encode()
+
+    def decode(self, data):
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+class BinaryCodec(Codec):
+    """
+    Length-prefixed binary records built with ``struct`` and ``array``.
+
+    After the header comes a table of every distinct dict key, each written
+    once; dicts refer to their keys by index, so a key repeated across
+    thousands of records costs four bytes per use. Every value is a one-byte
+    tag followed by its payload: 64-bit integers and doubles inline, strings
+    and containers prefixed with their length, and lists made only of
+    integers as one packed array of the narrowest type that holds them.
+    Decoding reads through a memoryview with ``struct.unpack_from``, so no
+    part of the input is copied before it is turned into Python objects.
+    """
+    name = 'binary'
+
+    def encode(self, doc) -> bytes:
+        keys = {}
+        body = bytearray()
+        self._encode(doc, body, keys)
+        table = bytearray()
+        for key in keys:
+            encoded = key.encode()
+            table += _U32.pack(len(encoded))
+            table += encoded
+        return HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(keys), len(body)) + table + body
+
+    def _encode(self, value, out: bytearray, keys: dict) -> None:
+        if value is None:
+            out.append(_NONE)
+        elif value is True:
+            out.append(_TRUE)
+        elif value is False:
+            out.append(_FALSE)
+        elif type(value) is int:
+            if _I64_MIN <= value <= _I64_MAX:
+                out += _TAG_I64.pack(_INT, value)
+            else:
+                digits = str(value).encode()
+                out += _TAG_U32.pack(_BIGINT, len(digits))
+                out += digits
+        elif type(value) is float:
+            out += _TAG_F64.pack(_FLOAT, value)
+        elif isinstance(value, str):
+            encoded = value.encode()
+            out += _TAG_U32.pack(_STR, len(encoded))
+            out += encoded
+        elif isinstance(value, dict):
+            out += _TAG_U32.pack(_DICT, len(value))
+            for key, item in value.items():
+                if not isinstance(key, str):
+                    key = str(key)  # as json.dumps does
+                index = keys.get(key)
+                if index is None:
+                    index = keys[key] = len(keys)
+                out += _U32.pack(index)
+                self._encode(item, out, keys)
+        elif isinstance(value, (list, tuple)):
+            code = _int_array_code(value)
+            if code is not None:
+                packed = array(code, value)
+                if sys.byteorder == 'big':
+                    packed.byteswap()
+                out += _TAG_U32.pack(_INTS, len(value))
+                out.append(ord(code))
+                out += packed.tobytes()
+            else:
+                out += _TAG_U32.pack(_LIST, len(value))
+                for item in value:
+                    self._encode(item, out, keys)
+        else:
+            raise TypeError(f"Cannot encode {type(value).__name__} values")
+
+    def decode(self, data):
+        view = memoryview(data)
+        magic, version, _, key_count, body_length = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a binary WhisperChain+ document")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Binary document format {version} is newer than this version supports")
+        offset = HEADER.size
+        keys = []
+        for _ in range(key_count):
+            length, = _U32.unpack_from(view, offset)
+            offset += 4
+            keys.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
+        if len(view) - offset != body_length:
+            raise ValueError("Binary document is truncated")
+
+        unpack_u32 = _U32.unpack_from
+        unpack_i64 = struct.Struct('<q').unpack_from
+        unpack_f64 = struct.Struct('<d').unpack_from
+
+        def read(offset: int):
+            tag = view[offset]
+            offset += 1
+            if tag == _INT:
+                return unpack_i64(view, offset)[0], offset + 8
+            if tag == _STR:
+                length, = unpack_u32(view, offset)
+                offset += 4
+                return str(view[offset:offset + length], 'utf-8'), offset + length
+            if tag == _DICT:
+                count, = unpack_u32(view, offset)
+                offset += 4
+                result = {}
+                for _ in range(count):
+                    key = keys[unpack_u32(view, offset)[0]]
+                    result[key], offset = read(offset + 4)
+                return result, offset
+            if tag == _LIST:
+                count, = unpack_u32(view, offset)
+                offset += 4
+                result = []
+                for _ in range(count):
+                    item, offset = read(offset)
+                    result.append(item)
+                return result, offset
+            if tag == _INTS:
+                count, = unpack_u32(view, offset)
+                packed = array(chr(view[offset + 4]))
+                offset += 5
+                end = offset + packed.itemsize * count
+                packed.frombytes(view[offset:end])
+                if sys.byteorder == 'big':
+                    packed.byteswap()
+                return packed.tolist(), end
+            if tag == _NONE:
+                return None, offset
+            if tag == _TRUE:
+                return True, offset
+            if tag == _FALSE:
+                return False, offset
+            if tag == _FLOAT:
+                return unpack_f64(view, offset)[0], offset + 8
+            if tag == _BIGINT:
+                length, = unpack_u32(view, offset)
+                offset += 4
+                return int(str(view[offset:offset + length], 'ascii')), offset + length
+            raise ValueError(f"Unknown value tag {tag} in binary document")
+
+        doc, _ = read(offset)
+        return doc
+
+CODECS = {codec.name: codec for codec in (JSONCodec('json'), JSONCodec('json-indent', indent=4), BinaryCodec())}
+
+def get_codec(name: str = None) -> Codec:
+    """
+    Return a codec by name (defaults to DEFAULT_CODEC).
+    Raises:
+        ValueError: If the codec is unknown
+    """
+    name = name or DEFAULT_CODEC
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}'. Must be one of: {', '.join(CODECS)}")
+    return CODECS[name]
+
+def detect_codec(data) -> Codec:
+    """Return the codec that can read a document, from its first bytes."""
+    return CODECS['binary'] if bytes(data[:len(MAGIC)]) == MAGIC else CODECS['json']
+
+def decode_document(data):
+    """Decode a document written by any codec."""
+    return detect_codec(data).decode(data)
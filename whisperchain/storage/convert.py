@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pathlib import Path
+
+if __package__ in (None, ''):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from whisperchain.storage.codec import CODECS
+from whisperchain.storage.engine import DB_DIR, open_engine
+
+def _documents_size(db_dir: Path) -> int:
+    return sum(path.stat().st_size for path in db_dir.rglob('*.json'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite the JSON backend\'s documents with another codec')
+    parser.add_argument('--to', dest='codec', required=True, choices=list(CODECS), help='Codec to write')
+    parser.add_argument('--db-dir', default=str(DB_DIR), help='Data directory')
+    args = parser.parse_args()
+
+    db_dir = Path(args.db_dir)
+    before = _documents_size(db_dir)
+    engine = open_engine('json', db_dir, codec=args.codec)
+    try:
+        count = engine.rewrite_documents(args.codec)
+    finally:
+        engine.close()
+
+    print(f"Rewrote {count} documents as {args.codec}: {before} -> {_documents_size(db_dir)} bytes")
+    if args.codec != 'json':
+        print(f"Set WHISPERCHAIN_CODEC={args.codec} so new writes use it too.")
+
+if __name__ == '__main__':
+    main()
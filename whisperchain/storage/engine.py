@@ -0,0 +1,322 @@
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from whisperchain.metrics.instrument import span
+
+DB_DIR = Path(os.environ.get('WHISPERCHAIN_DB_DIR', Path(__file__).parent.parent / 'db'))
+BACKENDS = ('json', 'sqlite')
+DEFAULT_BACKEND = os.environ.get('WHISPERCHAIN_STORAGE', 'json')
+
+# Attempts retry_on_conflict makes before letting a ConflictError through
+CONFLICT_RETRIES = 10
+
+_engine = None
+
+class ConflictError(RuntimeError):
+    """A transaction read data that another process changed before it committed."""
+
+class StorageEngine:
+    """
+    Interface shared by every storage backend.
+
+    Each method operates on a single record so backends can implement it
+    without touching unrelated data. Calls made outside ``transaction()``
+    are committed immediately; calls made inside it are committed together
+    when the outermost block exits and discarded if it raises. Transactions
+    from different threads are serialized. A backend shared between
+    processes may refuse a commit with ConflictError when another process
+    changed what the transaction read; see ``retry_on_conflict``.
+    """
+    name = None
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def in_transaction(self) -> bool:
+        """Return True if the calling thread has a transaction open."""
+        return getattr(self._local, 'depth', 0) > 0
+
+    @contextmanager
+    def transaction(self):
+        """Group the enclosed calls into one commit; nested blocks join the outer one."""
+        with self._lock:
+            depth = getattr(self._local, 'depth', 0)
+            if depth == 0:
+                self._begin()
+            self._local.depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                self._local.depth = depth
+                if depth == 0:
+                    self._rollback()
+                raise
+            self._local.depth = depth
+            if depth == 0:
+                with span('storage.commit', self.name):
+                    self._commit()
+
+    def _begin(self) -> None:
+        """Start the outermost transaction."""
+
+    def _commit(self) -> None:
+        """Commit the outermost transaction."""
+
+    def _rollback(self) -> None:
+        """Discard the outermost transaction."""
+
+    def close(self) -> None:
+        """Release any resources held by the engine."""
+
+    def rebuild_indexes(self) -> None:
+        """Rebuild secondary indexes from the primary records."""
+        raise NotImplementedError
+
+    # Users
+
+    def get_user(self, username: str) -> Optional[dict]:
+        """Return the stored record for a user, or None."""
+        raise NotImplementedError
+
+    def find_user_by_email(self, email: str) -> Optional[str]:
+        """Return the username registered with an email (compared normalized), or None."""
+        raise NotImplementedError
+
+    def get_user_roles(self, usernames: list) -> dict:
+        """Return {username: role} for the given users that exist."""
+        raise NotImplementedError
+
+    def find_users_by_role(self, role: str) -> list:
+        """Return the usernames holding a role, sorted."""
+        raise NotImplementedError
+
+    def add_user(self, username: str, record: dict) -> None:
+        """Store a new user record."""
+        raise NotImplementedError
+
+    def iter_users(self) -> Iterator[tuple[str, dict]]:
+        """Yield (username, record) pairs."""
+        raise NotImplementedError
+
+    def users_version(self):
+        """
+        Return a value that changes whenever a change to the user store is
+        committed, for caches of user records to check before trusting them.
+        """
+        raise NotImplementedError
+
+    # Tokens
+
+    def get_token(self, token: str) -> Optional[dict]:
+        """Return the stored record for a token, or None."""
+        raise NotImplementedError
+
+    def find_unused_token(self, username: str, now: int = None) -> Optional[str]:
+        """Return an unused token belonging to a user that has not expired at ``now``, or None."""
+        raise NotImplementedError
+
+    def add_token(self, token: str, record: dict) -> None:
+        """
+        Store a new token record.
+        Raises:
+            ValueError: If the token already exists, outstanding or archived
+        """
+        raise NotImplementedError
+
+    def set_token_used(self, token: str) -> bool:
+        """Mark a token as used. Returns False if the token does not exist."""
+        raise NotImplementedError
+
+    def consume_token(self, token: str, username: str, now: int) -> bool:
+        """
+        Mark a token used if it belongs to ``username``, is unused and has not
+        expired at ``now``, as one atomic compare-and-set. Returns whether the
+        token was consumed.
+        """
+        raise NotImplementedError
+
+    def sweep_tokens(self, now: int = None) -> int:
+        """
+        Move used tokens, and tokens expired at ``now`` if given, out of the
+        working set into the archive. Returns the number moved.
+        """
+        raise NotImplementedError
+
+    def log_issuance(self, timestamp: int, record: dict) -> None:
+        """Record that a token was issued at a given time."""
+        raise NotImplementedError
+
+    def iter_tokens(self) -> Iterator[tuple[str, dict]]:
+        """Yield (token, record) pairs."""
+        raise NotImplementedError
+
+    def iter_issued(self) -> Iterator[tuple[int, dict]]:
+        """Yield (timestamp, record) pairs from the issuance log."""
+        raise NotImplementedError
+
+    # Messages
+
+    def add_message(self, record: dict, message_id: int = None) -> int:
+        """Store a message and return its ID, allocating one if not given."""
+        raise NotImplementedError
+
+    def get_message(self, message_id) -> Optional[dict]:
+        """Return the stored record for a message, or None."""
+        raise NotImplementedError
+
+    def get_messages(self, message_ids: list) -> dict:
+        """Return {message_id: record} for the given IDs that exist, keyed by string ID."""
+        raise NotImplementedError
+
+    def set_message_flagged(self, message_id, flagged: bool = True) -> None:
+        """Set the flagged state of a message."""
+        raise NotImplementedError
+
+    def iter_messages(self, since_id: int = None, unflagged_only: bool = False) -> Iterator[tuple[int, dict]]:
+        """Yield (message_id, record) pairs in ID order, after ``since_id`` and optionally only unflagged ones."""
+        raise NotImplementedError
+
+    # Receiver queues
+
+    def add_receiver(self, username: str) -> None:
+        """Create an empty message queue for a receiver."""
+        raise NotImplementedError
+
+    def receiver_exists(self, username: str) -> bool:
+        """Return True if a receiver queue exists."""
+        raise NotImplementedError
+
+    def append_to_queue(self, receiver: str, entry: dict) -> None:
+        """Append an entry to a receiver's queue."""
+        raise NotImplementedError
+
+    def get_queue(self, receiver: str) -> list:
+        """Return a receiver's queue entries in arrival order."""
+        raise NotImplementedError
+
+    def iter_queue(self, receiver: str, since_id: int = None, unread_only: bool = False,
+                   limit: int = None) -> Iterator[dict]:
+        """
+        Yield a receiver's queue entries in arrival order, only those queued
+        after the message ``since_id`` (or with a higher ID, if it is not in
+        the queue) and optionally only unread ones.
+        """
+        raise NotImplementedError
+
+    def set_queue_read(self, receiver: str, message_ids: list) -> int:
+        """Mark queued messages as read by a receiver. Returns how many were unread."""
+        raise NotImplementedError
+
+    def iter_receivers(self) -> Iterator[tuple[str, list]]:
+        """Yield (receiver, queue) pairs."""
+        raise NotImplementedError
+
+    # Flags
+
+    def add_flag(self, record: dict, flag_id: int = None) -> int:
+        """Store a flag and return its ID, allocating one if not given."""
+        raise NotImplementedError
+
+    def iter_flags(self) -> Iterator[tuple[int, dict]]:
+        """Yield (flag_id, record) pairs in ID order."""
+        raise NotImplementedError
+
+    def query_flags(self, since: int = None, moderator: str = None,
+                    limit: int = None) -> Iterator[tuple[int, dict]]:
+        """
+        Yield (flag_id, record) pairs oldest first, only those created at or
+        after ``since`` and optionally only those raised by one moderator.
+        """
+        raise NotImplementedError
+
+    # Audit events
+
+    def append_event(self, event: dict) -> None:
+        """Append an event to the audit log."""
+        raise NotImplementedError
+
+    def iter_events(self, event_type: str = None, start_time: int = None,
+                    end_time: int = None, limit: int = None, offset: int = 0) -> Iterator[dict]:
+        """Lazily yield audit events oldest first, optionally filtered and paged."""
+        raise NotImplementedError
+
+def retry_on_conflict(function):
+    """
+    Re-run a function whose transaction was refused with ConflictError.
+
+    Only the outermost transaction commits, so only a function that opens
+    it can usefully be retried; inside another transaction the conflict is
+    left to the caller that opened it.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, CONFLICT_RETRIES + 1):
+            try:
+                return function(*args, **kwargs)
+            except ConflictError:
+                if attempt == CONFLICT_RETRIES:
+                    raise
+                # Back off a little so the competing writers spread out
+                import random
+                time.sleep(random.uniform(0, 0.002 * attempt))
+    return wrapper
+
+def atomic(method):
+    """Run a storage engine method inside its own transaction, retried on conflict."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return retry_on_conflict(wrapper)
+
+def normalize_email(email: str) -> str:
+    """Return the form of an email address used for uniqueness checks."""
+    return email.strip().lower()
+
+def open_engine(backend: str = None, db_dir=None, cache: bool = False, id_block: int = None,
+                codec: str = None) -> StorageEngine:
+    """
+    Open a storage engine.
+    Args:
+        backend: 'json' for the legacy JSON files or 'sqlite'
+        db_dir: Directory holding the data files (defaults to DB_DIR)
+        cache: Keep parsed JSON documents in memory between calls (for
+            long-running processes; SQLite has its own page cache)
+        id_block: Message and flag IDs the JSON backend reserves at a time
+            (defaults to ID_BLOCK_SIZE in locking.py)
+        codec: Codec the JSON backend writes documents with (defaults to
+            DEFAULT_CODEC in codec.py)
+    Returns:
+        StorageEngine: The opened engine
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    backend = backend or DEFAULT_BACKEND
+    db_dir = Path(db_dir) if db_dir is not None else DB_DIR
+    if backend == 'json':
+        from whisperchain.storage.json_store import JSONStorageEngine
+        from whisperchain.storage.locking import ID_BLOCK_SIZE
+        return JSONStorageEngine(db_dir, cache=cache, id_block=id_block or ID_BLOCK_SIZE, codec=codec)
+    if backend == 'sqlite':
+        from whisperchain.storage.sqlite_store import SQLiteStorageEngine
+        return SQLiteStorageEngine(db_dir)
+    raise ValueError(f"Unknown storage backend '{backend}'. Must be one of: {', '.join(BACKENDS)}")
+
+def get_engine() -> StorageEngine:
+    """Return the process-wide storage engine, opening it on first use."""
+    global _engine
+    if _engine is None:
+        _engine = open_engine()
+    return _engine
+
+def set_engine(engine: Optional[StorageEngine]) -> Optional[StorageEngine]:
+    """Replace the process-wide storage engine and return the previous one."""
+    global _engine
+    previous, _engine = _engine, engine
+    return previous
@@ -0,0 +1,877 @@
+import json
+import os
+from bisect import bisect_left, bisect_right, insort
+from pathlib import Path
+from urllib.parse import quote
+from typing import Iterator, Optional
+
+from whisperchain.logging.segments import SegmentedLog
+from whisperchain.metrics.instrument import span
+from whisperchain.storage.bitmap import new_bitmap, reader, set_bits
+from whisperchain.storage.codec import decode_document, get_codec
+from whisperchain.storage.engine import ConflictError, StorageEngine, atomic, normalize_email
+from whisperchain.storage.locking import ID_BLOCK_SIZE, FileLock, IdAllocator
+
+# Initial contents of each database file; sharded stores are keyed by directory
+_EMPTY = {
+    'users': lambda: {},
+    'users_email_index': lambda: {},
+    'users_role_index': lambda: {},
+    'tokens': lambda: {'tokens': {}, 'unused': {}},
+    'messages': lambda: {'next_id': 1},
+    'messages/': lambda: {'messages': {}},
+    'message_flags': lambda: {'flagged': []},
+    'receivers': lambda: {'receivers': {}},
+    'inbox/': lambda: {'messages': []},
+    'inbox_read/': new_bitmap,
+    'flags': lambda: {'flags': {}, 'next_id': 1},
+    'flags_index': lambda: {},
+}
+
+# Messages stored per shard file of db/messages/
+MESSAGE_SHARD_SIZE = 1000
+
+# Append-only line files
+TOKENS_ISSUED = 'tokens_issued.jsonl'
+TOKENS_ARCHIVE = 'tokens_archive.jsonl.gz'
+
+# Redo journal holding the last commit until it has been applied
+JOURNAL = 'journal.json'
+
+# Lock shared by every process using the directory
+LOCK_FILE = 'db.lock'
+
+# Counter files of the message and flag ID allocators
+MESSAGE_IDS = 'message_ids.counter'
+FLAG_IDS = 'flag_ids.counter'
+
+def _kind(name: str) -> str:
+    """Return the kind of store a document belongs to, e.g. ``inbox/`` for any receiver's inbox."""
+    return name.rpartition('/')[0] + '/' if '/' in name else name
+
+def _fsync_directory(path: Path) -> None:
+    """Make the renames and unlinks done in a directory durable."""
+    if os.name == 'nt':
+        return  # Windows cannot open a directory to fsync it
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _opener(file_name: str):
+    """Return the function opening a line file, gzip for ``.gz`` archives."""
+    if file_name.endswith('.gz'):
+        import gzip
+        return gzip.open
+    return open
+
+class JSONStorageEngine(StorageEngine):
+    """
+    Legacy backend keeping each store in its own ``db/*.json`` file.
+
+    Every write rewrites the whole file. Inside a transaction each file is
+    loaded at most once and written at most once, when the outermost block
+    commits. Logs that only grow are kept in append-only line files instead:
+    the audit log (a segmented log under ``db/audit_log/``), the token
+    issuance log and the gzip-compressed archive of retired tokens.
+    Message bodies are split by ID into ``db/messages/<shard>.json`` files of
+    MESSAGE_SHARD_SIZE messages, with ``messages.json`` holding only the
+    next ID, and which messages are flagged is a sorted ID list in
+    ``message_flags.json``, so a lookup or a flag touches one small file.
+    Each receiver's queue is a separate ``db/inbox/<receiver>.json`` shard,
+    so reading or updating one inbox does not touch any other. Which of its
+    messages have been read is a bitmap over queue positions kept in
+    ``db/inbox_read/<receiver>.json`` (see ``bitmap.py``), so marking
+    messages read never rewrites the queue.
+
+    A commit first writes everything it changes to ``db/journal.json`` and
+    fsyncs it; renaming the journal into place is the commit point. The
+    changes are then applied by writing and fsyncing each document to a
+    temporary file and renaming it over the old one; once the renamed
+    directories are fsynced too, the journal is removed. A journal
+    left behind by a crash is replayed when an engine is next opened, or by
+    any open engine before it commits.
+
+    Several processes may share the directory. A transaction holds a shared
+    lock on ``db/db.lock`` while it reads and upgrades it to an exclusive
+    lock to commit. The upgrade lets another process commit first, so each
+    document read is remembered with its version stamp (inode, mtime and
+    size) and a commit whose documents have changed since is refused with
+    ConflictError, to be retried (see ``retry_on_conflict``). Message and
+    flag IDs come from counter files that hand out blocks of ``id_block``
+    IDs, so writers do not meet on a shared ``next_id``.
+
+    Documents are written with ``codec`` (see ``codec.py``): compact JSON by
+    default, or the binary record format. Each file is read with whichever
+    codec wrote it, so switching codecs needs no conversion;
+    ``rewrite_documents`` converts the existing files when wanted.
+
+    With ``cache`` enabled, parsed documents are kept in memory between
+    calls and only re-read when their file is replaced, which a
+    long-running process uses to avoid re-parsing every store per request.
+    """
+    name = 'json'
+
+    def __init__(self, db_dir, cache: bool = False, id_block: int = ID_BLOCK_SIZE, codec: str = None):
+        super().__init__()
+        self.db_dir = Path(db_dir)
+        self.cache = cache
+        self.codec = get_codec(codec)
+        self._cache = {}
+        self._docs = {}
+        self._versions = {}
+        self._dirty = set()
+        self._appends = {}
+        self._audit_log = None
+        self._archived = (0, set())
+        self._file_lock = FileLock(self.db_dir / LOCK_FILE)
+        self._message_ids = IdAllocator(self.db_dir / MESSAGE_IDS, id_block,
+                                        initial=lambda: self._messages()['next_id'])
+        self._flag_ids = IdAllocator(self.db_dir / FLAG_IDS, id_block,
+                                     initial=lambda: self._load('flags')['next_id'])
+        with self._file_lock.exclusive():
+            self._recover()
+
+    def path(self, name: str) -> Path:
+        """Return the file backing a store."""
+        return self.db_dir / f'{name}.json'
+
+    def close(self) -> None:
+        if self._audit_log is not None:
+            self._audit_log.close()
+        self._file_lock.close()
+        self._message_ids.close()
+        self._flag_ids.close()
+
+    @staticmethod
+    def _stamp(path: Path) -> Optional[tuple]:
+        # Every write renames a new file into place, so the inode changes too
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self, name: str) -> dict:
+        in_transaction = self.in_transaction()
+        if in_transaction and name in self._docs:
+            return self._docs[name]
+        path = self.path(name)
+        stamp = self._stamp(path)
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == stamp:
+            doc = cached[1]
+        else:
+            if stamp is not None:
+                with span('storage.json.load', _kind(name)) as timing:
+                    data = path.read_bytes()
+                    doc = decode_document(data)
+                    timing.add_bytes(read=len(data))
+            else:
+                doc = _EMPTY[_kind(name)]()
+            if self.cache:
+                self._cache[name] = (stamp, doc)
+        if in_transaction:
+            self._docs[name] = doc
+            self._versions[name] = stamp
+        return doc
+
+    def _save(self, name: str, doc: dict) -> None:
+        if self.in_transaction():
+            self._docs[name] = doc
+            self._dirty.add(name)
+            return
+        self._write(name, doc)
+
+    def _append(self, file_name: str, records: list) -> None:
+        """Queue records to be appended to a line file when the transaction commits."""
+        self._appends.setdefault(file_name, []).extend(records)
+
+    def _write(self, name: str, doc: dict) -> None:
+        # Write a new file and rename it over the old one so a crash never
+        # leaves a truncated document behind
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with span('storage.json.dump', _kind(name)) as timing:
+            data = self.codec.encode(doc)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            timing.add_bytes(written=len(data))
+        if self.cache:
+            self._cache[name] = (self._stamp(path), doc)
+
+    def _write_lines(self, file_name: str, records: list, offset: int = None) -> None:
+        """Append records to a line file, first cutting it back to ``offset`` bytes if given."""
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        path = self.db_dir / file_name
+        if offset is not None and path.exists() and path.stat().st_size > offset:
+            os.truncate(path, offset)
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        opener = _opener(file_name)
+        with span('storage.lines.append', file_name) as timing:
+            with opener(path, 'at') as f:
+                f.write(data)
+            # The gzip writer hides its file, so sync through a handle of our own
+            with open(path, 'ab') as f:
+                os.fsync(f.fileno())
+            timing.add_bytes(written=len(data))
+
+    def _read_lines(self, file_name: str) -> Iterator[dict]:
+        path = self.db_dir / file_name
+        if not path.exists():
+            return
+        opener = _opener(file_name)
+        with opener(path, 'rt') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+
+    def _begin(self) -> None:
+        self._file_lock.acquire_shared()
+
+    def _check_versions(self) -> None:
+        """Refuse the commit if a document it read has been replaced since."""
+        for name, stamp in self._versions.items():
+            if self._stamp(self.path(name)) != stamp:
+                raise ConflictError(f"'{name}' was changed by another process")
+
+    def _commit(self) -> None:
+        try:
+            if not self._dirty and not self._appends:
+                return
+            self._file_lock.acquire_exclusive()
+            # A crashed process may have left its commit half applied; finish
+            # it first, or the journal below would overwrite it. Documents it
+            # rewrites fail the version check, so the caller retries.
+            self._recover()
+            self._check_versions()
+            journal = {
+                'documents': {name: self._docs[name] for name in sorted(self._dirty)},
+                # Each line file's size before the commit, so replaying is idempotent
+                'appends': {
+                    file_name: {'offset': self._size(file_name), 'records': records}
+                    for file_name, records in self._appends.items()
+                }
+            }
+            self._write_journal(journal)
+            self._apply(journal)
+        except BaseException:
+            self._evict()
+            raise
+        finally:
+            self._reset()
+
+    def _size(self, file_name: str) -> int:
+        path = self.db_dir / file_name
+        return path.stat().st_size if path.exists() else 0
+
+    def _write_journal(self, journal: dict) -> None:
+        """Durably record a commit; the rename is the commit point."""
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        path = self.db_dir / JOURNAL
+        tmp = path.with_suffix('.tmp')
+        with span('storage.journal.write') as timing, open(tmp, 'wb') as f:
+            data = json.dumps(journal, separators=(',', ':')).encode()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            timing.add_bytes(written=len(data))
+        os.replace(tmp, path)
+        _fsync_directory(self.db_dir)
+
+    def _apply(self, journal: dict) -> None:
+        """Write a journaled commit to the data files and drop the journal."""
+        directories = {self.db_dir}
+        # Appends go first so a crash never drops a record removed from a document
+        for file_name, append in journal['appends'].items():
+            self._write_lines(file_name, append['records'], offset=append['offset'])
+        for name, doc in journal['documents'].items():
+            self._write(name, doc)
+            directories.add(self.path(name).parent)
+        # The journal may only go once the renames above have reached the disk
+        for directory in sorted(directories):
+            _fsync_directory(directory)
+        (self.db_dir / JOURNAL).unlink()
+
+    def _recover(self) -> None:
+        """Finish applying a commit interrupted by a crash."""
+        path = self.db_dir / JOURNAL
+        if not path.exists():
+            return
+        with open(path, 'r') as f:
+            journal = json.load(f)
+        self._apply(journal)
+
+    def _rollback(self) -> None:
+        self._evict()
+        self._reset()
+
+    def _evict(self) -> None:
+        # Documents loaded in a failed transaction may have been changed in place
+        for name in self._docs:
+            self._cache.pop(name, None)
+
+    def _reset(self) -> None:
+        self._docs.clear()
+        self._versions.clear()
+        self._dirty.clear()
+        self._appends.clear()
+        self._file_lock.release()
+
+    # Users
+
+    @atomic
+    def rebuild_indexes(self) -> None:
+        self._save('users_email_index', self._build_email_index(self._load('users')))
+        self._save('users_role_index', self._build_role_index(self._load('users')))
+        data = self._tokens()
+        data['unused'] = self._build_unused_index(data['tokens'])
+        self._save('tokens', data)
+
+    @atomic
+    def rewrite_documents(self, codec: str = None) -> int:
+        """
+        Rewrite every document with a codec, which new writes then use too.
+        Args:
+            codec: Name of the codec (defaults to DEFAULT_CODEC in codec.py)
+        Returns:
+            int: The number of documents rewritten
+        """
+        self.codec = get_codec(codec)
+        names = [path.relative_to(self.db_dir).with_suffix('').as_posix()
+                 for path in sorted(self.db_dir.rglob('*.json'))]
+        names = [name for name in names if _kind(name) in _EMPTY]
+        for name in names:
+            self._save(name, self._load(name))
+        return len(names)
+
+    def _build_email_index(self, users: dict) -> dict:
+        emails = {}
+        for username, user_data in users.items():
+            if user_data.get('email'):
+                emails.setdefault(normalize_email(user_data['email']), username)
+        return {'users': len(users), 'emails': emails}
+
+    def _email_index(self) -> dict:
+        """
+        Return the email -> username index kept in users_email_index.json.
+
+        The index records the number of users it was built from; if the file
+        is missing, corrupt or out of step with users.json it is rebuilt.
+        """
+        users = self._load('users')
+        try:
+            index = self._load('users_email_index')
+        except ValueError:
+            index = {}
+        if index.get('users') != len(users) or 'emails' not in index:
+            index = self._build_email_index(users)
+            self._save('users_email_index', index)
+        return index
+
+    def _build_role_index(self, users: dict) -> dict:
+        roles = {}
+        for username in sorted(users):
+            roles.setdefault(users[username]['role'], []).append(username)
+        return {'users': len(users), 'roles': roles}
+
+    def _role_index(self) -> dict:
+        """
+        Return the role -> sorted usernames index kept in users_role_index.json,
+        rebuilt like the email index if it is missing, corrupt or out of step.
+        """
+        users = self._load('users')
+        try:
+            index = self._load('users_role_index')
+        except ValueError:
+            index = {}
+        if index.get('users') != len(users) or 'roles' not in index:
+            index = self._build_role_index(users)
+            self._save('users_role_index', index)
+        return index
+
+    def get_user(self, username: str) -> Optional[dict]:
+        return self._load('users').get(username)
+
+    def get_user_roles(self, usernames: list) -> dict:
+        users = self._load('users')
+        return {username: users[username]['role'] for username in usernames if username in users}
+
+    @atomic
+    def find_users_by_role(self, role: str) -> list:
+        return list(self._role_index()['roles'].get(role, []))
+
+    @atomic
+    def find_user_by_email(self, email: str) -> Optional[str]:
+        return self._email_index()['emails'].get(normalize_email(email))
+
+    @atomic
+    def add_user(self, username: str, record: dict) -> None:
+        index = self._email_index()
+        role_index = self._role_index()
+        users = self._load('users')
+        previous = users.get(username)
+        if previous and previous.get('email'):
+            if index['emails'].get(normalize_email(previous['email'])) == username:
+                del index['emails'][normalize_email(previous['email'])]
+        if previous is not None:
+            holders = role_index['roles'].get(previous['role'], [])
+            if username in holders:
+                holders.remove(username)
+                if not holders:
+                    del role_index['roles'][previous['role']]
+        users[username] = record
+        if record.get('email'):
+            index['emails'][normalize_email(record['email'])] = username
+        insort(role_index['roles'].setdefault(record['role'], []), username)
+        index['users'] = role_index['users'] = len(users)
+        self._save('users', users)
+        self._save('users_email_index', index)
+        self._save('users_role_index', role_index)
+
+    def iter_users(self) -> Iterator[tuple[str, dict]]:
+        yield from self._load('users').items()
+
+    def users_version(self):
+        return self._stamp(self.path('users'))
+
+    # Tokens
+
+    def _tokens(self) -> dict:
+        """
+        Load tokens.json, which holds the outstanding tokens.
+
+        Its 'unused' map indexes each user's unused tokens so lookups by
+        username do not scan every token; it is rebuilt for files written
+        before the index existed. Files that still embed the 'issued' map
+        have it moved to the append-only issuance log.
+        """
+        data = self._load('tokens')
+        if 'unused' not in data:
+            data['unused'] = self._build_unused_index(data['tokens'])
+        if 'issued' in data:
+            with self.transaction():
+                self._append(TOKENS_ISSUED, [{'issued_at': int(timestamp), **record}
+                                             for timestamp, record in data.pop('issued').items()])
+                self._save('tokens', data)
+        return data
+
+    def _build_unused_index(self, tokens: dict) -> dict:
+        unused = {}
+        for token, info in tokens.items():
+            if not info['used']:
+                unused.setdefault(info['username'], []).append(token)
+        return unused
+
+    def get_token(self, token: str) -> Optional[dict]:
+        return self._tokens()['tokens'].get(token)
+
+    def find_unused_token(self, username: str, now: int = None) -> Optional[str]:
+        data = self._tokens()
+        for token in data['unused'].get(username, []):
+            expires_at = data['tokens'][token].get('expires_at')
+            if now is None or expires_at is None or expires_at > now:
+                return token
+        return None
+
+    def _archived_tokens(self) -> set:
+        """
+        Return the tokens in the archive. The archive only grows by whole gzip
+        members, so each call decompresses just the members appended since
+        the last one.
+        """
+        import gzip
+        import zlib
+        path = self.db_dir / TOKENS_ARCHIVE
+        size = path.stat().st_size if path.exists() else 0
+        offset, tokens = self._archived
+        if size < offset:
+            # Cut back by a replayed commit; read it again from the start
+            offset, tokens = 0, set()
+        if size > offset:
+            try:
+                with open(path, 'rb') as raw:
+                    raw.seek(offset)
+                    with gzip.open(raw, 'rt') as f:
+                        for line in f:
+                            if line.endswith('\n'):
+                                tokens.add(json.loads(line)['token'])
+            except (EOFError, OSError, zlib.error):
+                # A torn member left by a crash, or a boundary moved by its
+                # replay: answer from what was read and start over next time
+                self._archived = (0, set())
+                return tokens
+        self._archived = (size, tokens)
+        return tokens
+
+    @atomic
+    def add_token(self, token: str, record: dict) -> None:
+        data = self._tokens()
+        if token in data['tokens'] or token in self._archived_tokens():
+            raise ValueError("Token already exists")
+        data['tokens'][token] = record
+        if not record['used']:
+            data['unused'].setdefault(record['username'], []).append(token)
+        self._save('tokens', data)
+
+    def _mark_used(self, data: dict, token: str) -> None:
+        info = data['tokens'][token]
+        info['used'] = True
+        unused = data['unused'].get(info['username'], [])
+        if token in unused:
+            unused.remove(token)
+            if not unused:
+                del data['unused'][info['username']]
+        self._save('tokens', data)
+
+    @atomic
+    def set_token_used(self, token: str) -> bool:
+        data = self._tokens()
+        if token not in data['tokens']:
+            return False
+        self._mark_used(data, token)
+        return True
+
+    @atomic
+    def consume_token(self, token: str, username: str, now: int) -> bool:
+        data = self._tokens()
+        info = data['tokens'].get(token)
+        if info is None or info['used'] or info['username'] != username:
+            return False
+        expires_at = info.get('expires_at')
+        if expires_at is not None and expires_at <= now:
+            return False
+        self._mark_used(data, token)
+        return True
+
+    @atomic
+    def sweep_tokens(self, now: int = None) -> int:
+        data = self._tokens()
+        retired = {}
+        for token, info in data['tokens'].items():
+            expires_at = info.get('expires_at')
+            if info['used'] or (now is not None and expires_at is not None and expires_at <= now):
+                retired[token] = info
+        if not retired:
+            return 0
+        self._append(TOKENS_ARCHIVE, [{'token': token, **info} for token, info in retired.items()])
+        for token, info in retired.items():
+            del data['tokens'][token]
+            unused = data['unused'].get(info['username'], [])
+            if token in unused:
+                unused.remove(token)
+                if not unused:
+                    del data['unused'][info['username']]
+        self._save('tokens', data)
+        return len(retired)
+
+    @atomic
+    def log_issuance(self, timestamp: int, record: dict) -> None:
+        self._append(TOKENS_ISSUED, [{'issued_at': timestamp, **record}])
+
+    def iter_tokens(self) -> Iterator[tuple[str, dict]]:
+        for record in self._read_lines(TOKENS_ARCHIVE):
+            yield record.pop('token'), record
+        yield from self._tokens()['tokens'].items()
+
+    def iter_issued(self) -> Iterator[tuple[int, dict]]:
+        self._tokens()
+        for record in self._read_lines(TOKENS_ISSUED):
+            yield record.pop('issued_at'), record
+
+    # Messages
+
+    def _message_shard(self, message_id: int) -> str:
+        """Return the name of the document holding a message."""
+        return f'messages/{(message_id - 1) // MESSAGE_SHARD_SIZE:06d}'
+
+    def _messages(self) -> dict:
+        """
+        Load messages.json, which holds the next message ID from before IDs
+        came from the allocator; it seeds the allocator's counter.
+
+        Files written before the store was sharded hold every message; those
+        are moved out to the shard files and their flags to message_flags.json.
+        """
+        data = self._load('messages')
+        if 'messages' in data:
+            with self.transaction():
+                shards = {}
+                flags = self._load('message_flags')
+                for message_id, record in data.pop('messages').items():
+                    if record.pop('flagged', False):
+                        insort(flags['flagged'], int(message_id))
+                    shards.setdefault(self._message_shard(int(message_id)), {})[message_id] = record
+                for name, messages in shards.items():
+                    self._save(name, {'messages': messages})
+                self._save('message_flags', flags)
+                self._save('messages', data)
+        return data
+
+    def _flagged(self) -> list:
+        self._messages()
+        return self._load('message_flags')['flagged']
+
+    @staticmethod
+    def _is_flagged(flagged: list, message_id: int) -> bool:
+        index = bisect_left(flagged, message_id)
+        return index < len(flagged) and flagged[index] == message_id
+
+    @atomic
+    def add_message(self, record: dict, message_id: int = None) -> int:
+        self._messages()
+        if message_id is None:
+            message_id = self._message_ids.allocate()
+        else:
+            message_id = int(message_id)
+            self._message_ids.observe(message_id)
+
+        record = dict(record)
+        if record.pop('flagged', False):
+            self.set_message_flagged(message_id)
+        shard = self._load(self._message_shard(message_id))
+        shard['messages'][str(message_id)] = record
+        self._save(self._message_shard(message_id), shard)
+        return message_id
+
+    def get_message(self, message_id) -> Optional[dict]:
+        return self.get_messages([message_id]).get(str(message_id))
+
+    def get_messages(self, message_ids: list) -> dict:
+        ids = {int(message_id) for message_id in message_ids if str(message_id).isdigit()}
+        flagged = self._flagged()
+        shards = {}
+        for message_id in ids:
+            shards.setdefault(self._message_shard(message_id), []).append(message_id)
+        result = {}
+        for name, shard_ids in shards.items():
+            messages = self._load(name)['messages']
+            for message_id in shard_ids:
+                if str(message_id) in messages:
+                    result[str(message_id)] = {**messages[str(message_id)],
+                                               'flagged': self._is_flagged(flagged, message_id)}
+        return result
+
+    @atomic
+    def set_message_flagged(self, message_id, flagged: bool = True) -> None:
+        flags = self._load('message_flags')
+        message_id = int(message_id)
+        if flagged != self._is_flagged(self._flagged(), message_id):
+            if flagged:
+                insort(flags['flagged'], message_id)
+            else:
+                flags['flagged'].remove(message_id)
+            self._save('message_flags', flags)
+
+    def iter_messages(self, since_id: int = None, unflagged_only: bool = False) -> Iterator[tuple[int, dict]]:
+        next_id = self._message_ids.high_water()
+        flagged = self._flagged()
+        first = 1 if since_id is None else int(since_id) + 1
+        for start in range(first - (first - 1) % MESSAGE_SHARD_SIZE, next_id, MESSAGE_SHARD_SIZE):
+            messages = self._load(self._message_shard(start))['messages']
+            for message_id in sorted(map(int, messages)):
+                if message_id < first:
+                    continue
+                is_flagged = self._is_flagged(flagged, message_id)
+                if unflagged_only and is_flagged:
+                    continue
+                yield message_id, {**messages[str(message_id)], 'flagged': is_flagged}
+
+    # Receiver queues
+
+    def _inbox(self, receiver: str) -> str:
+        """Return the name of the document holding a receiver's queue."""
+        return 'inbox/' + quote(receiver, safe='')
+
+    def _receivers(self) -> dict:
+        """
+        Load receivers.json, the registry of receivers.
+
+        Files written before inboxes were sharded keep every queue inline;
+        those queues are moved out to one inbox file per receiver.
+        """
+        data = self._load('receivers')
+        if any('messages' in receiver_data for receiver_data in data['receivers'].values()):
+            with self.transaction():
+                for receiver, receiver_data in data['receivers'].items():
+                    if 'messages' in receiver_data:
+                        self._save(self._inbox(receiver), {'messages': receiver_data.pop('messages')})
+                self._save('receivers', data)
+        return data
+
+    @atomic
+    def add_receiver(self, username: str) -> None:
+        data = self._receivers()
+        if username not in data['receivers']:
+            data['receivers'][username] = {}
+            self._save('receivers', data)
+
+    def receiver_exists(self, username: str) -> bool:
+        return username in self._receivers()['receivers']
+
+    def _read_state(self, receiver: str) -> str:
+        """Return the name of the document holding a receiver's read bitmap."""
+        return 'inbox_read/' + quote(receiver, safe='')
+
+    def _queue(self, receiver: str) -> tuple[dict, dict]:
+        """
+        Load a receiver's inbox and read bitmap.
+
+        Inboxes written before the bitmap existed store a 'read' flag on
+        every entry; those flags are moved into the bitmap.
+        """
+        self._receivers()
+        inbox = self._load(self._inbox(receiver))
+        state = self._load(self._read_state(receiver))
+        if any('read' in entry for entry in inbox['messages']):
+            with self.transaction():
+                set_bits(state, [position for position, entry in enumerate(inbox['messages'])
+                                 if entry.pop('read', False)])
+                self._save(self._inbox(receiver), inbox)
+                self._save(self._read_state(receiver), state)
+        return inbox, state
+
+    @atomic
+    def append_to_queue(self, receiver: str, entry: dict) -> None:
+        inbox, state = self._queue(receiver)
+        entry = dict(entry)
+        if entry.pop('read', False):
+            set_bits(state, [len(inbox['messages'])])
+            self._save(self._read_state(receiver), state)
+        inbox['messages'].append(entry)
+        self._save(self._inbox(receiver), inbox)
+
+    def get_queue(self, receiver: str) -> list:
+        return list(self.iter_queue(receiver))
+
+    def iter_queue(self, receiver: str, since_id: int = None, unread_only: bool = False,
+                   limit: int = None) -> Iterator[dict]:
+        if limit is not None and limit <= 0:
+            return
+        inbox, state = self._queue(receiver)
+        entries = inbox['messages']
+        is_read = reader(state)
+        start, after = 0, None
+        if since_id is not None:
+            # IDs are handed out in blocks per process, so a queue need not be
+            # in ID order; page from since_id's position, or by ID if it is not queued
+            start = next((position + 1 for position in range(len(entries) - 1, -1, -1)
+                          if entries[position]['message_id'] == str(since_id)), 0)
+            if start == 0:
+                after = int(since_id)
+        for position in range(start, len(entries)):
+            entry = entries[position]
+            if after is not None and int(entry['message_id']) <= after:
+                continue
+            read = is_read(position)
+            if unread_only and read:
+                continue
+            yield {**entry, 'read': read}
+            if limit is not None:
+                limit -= 1
+                if limit <= 0:
+                    return
+
+    @atomic
+    def set_queue_read(self, receiver: str, message_ids: list) -> int:
+        inbox, state = self._queue(receiver)
+        wanted = {str(message_id) for message_id in message_ids}
+        changed = set_bits(state, [position for position, entry in enumerate(inbox['messages'])
+                                   if entry['message_id'] in wanted])
+        if changed:
+            self._save(self._read_state(receiver), state)
+        return changed
+
+    def iter_receivers(self) -> Iterator[tuple[str, list]]:
+        for receiver in list(self._receivers()['receivers']):
+            yield receiver, self.get_queue(receiver)
+
+    # Flags
+
+    def _build_flag_index(self, flags: dict) -> dict:
+        entries = sorted((record['created_at'], int(flag_id), record['moderator'])
+                         for flag_id, record in flags.items())
+        index = {'flags': len(flags), 'all': {'created_at': [], 'ids': []}, 'moderators': {}}
+        for created_at, flag_id, moderator in entries:
+            for columns in (index['all'], index['moderators'].setdefault(moderator, {'created_at': [], 'ids': []})):
+                columns['created_at'].append(created_at)
+                columns['ids'].append(flag_id)
+        return index
+
+    def _flag_index(self) -> dict:
+        """
+        Return the flag index kept in flags_index.json.
+
+        It lists flag IDs sorted by creation time, overall and per moderator,
+        and records the number of flags it was built from; if the file is
+        missing, corrupt or out of step with flags.json it is rebuilt.
+        """
+        flags = self._load('flags')['flags']
+        try:
+            index = self._load('flags_index')
+        except ValueError:
+            index = {}
+        if index.get('flags') != len(flags) or 'all' not in index:
+            index = self._build_flag_index(flags)
+            self._save('flags_index', index)
+        return index
+
+    @atomic
+    def add_flag(self, record: dict, flag_id: int = None) -> int:
+        index = self._flag_index()
+        data = self._load('flags')
+        if flag_id is None:
+            flag_id = self._flag_ids.allocate()
+        else:
+            self._flag_ids.observe(int(flag_id))
+        if str(flag_id) not in data['flags']:
+            index['flags'] += 1
+            for columns in (index['all'], index['moderators'].setdefault(record['moderator'], {'created_at': [], 'ids': []})):
+                position = bisect_right(columns['created_at'], record['created_at'])
+                columns['created_at'].insert(position, record['created_at'])
+                columns['ids'].insert(position, int(flag_id))
+            self._save('flags_index', index)
+        data['flags'][str(flag_id)] = record
+        self._save('flags', data)
+        return int(flag_id)
+
+    def iter_flags(self) -> Iterator[tuple[int, dict]]:
+        flags = self._load('flags')['flags']
+        for flag_id in sorted(flags, key=int):
+            yield int(flag_id), flags[flag_id]
+
+    @atomic
+    def query_flags(self, since: int = None, moderator: str = None,
+                    limit: int = None) -> Iterator[tuple[int, dict]]:
+        index = self._flag_index()
+        columns = index['all'] if moderator is None else index['moderators'].get(moderator)
+        if not columns:
+            return iter(())
+        lo = 0 if since is None else bisect_left(columns['created_at'], since)
+        hi = len(columns['ids']) if limit is None else lo + limit
+        flags = self._load('flags')['flags']
+        return iter([(flag_id, flags[str(flag_id)]) for flag_id in columns['ids'][lo:hi]])
+
+    # Audit events
+
+    def audit_log(self) -> SegmentedLog:
+        """Return the audit log, converting a legacy audit_log.json first."""
+        if self._audit_log is None:
+            self._audit_log = SegmentedLog(self.db_dir / 'audit_log')
+            legacy = self.path('audit_log')
+            if legacy.exists():
+                self._audit_log.import_file(legacy, lambda path: json.loads(path.read_text())['events'])
+        return self._audit_log
+
+    def append_event(self, event: dict) -> None:
+        self.audit_log().append(event)
+
+    def iter_events(self, event_type: str = None, start_time: int = None,
+                    end_time: int = None, limit: int = None, offset: int = 0) -> Iterator[dict]:
+        return self.audit_log().iter_events(event_type, start_time, end_time, limit, offset)
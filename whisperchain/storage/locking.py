@@ -0,0 +1,153 @@
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; only in-process locking applies there
+    fcntl = None
+
+# IDs reserved per trip to the counter file
+ID_BLOCK_SIZE = 1
+
+COUNTER = struct.Struct('<Q')
+
+class FileLock:
+    """
+    Advisory lock shared by every process using a data directory.
+
+    Holders of the shared lock may run alongside each other; the exclusive
+    lock waits for all of them. Moving between the two is not atomic, so
+    callers that upgrade must re-check what they read (see ``version``
+    stamps in the JSON backend).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fd = None
+        self._mode = None
+
+    def _acquire(self, mode: int) -> None:
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self._fd, mode)
+        self._mode = mode
+
+    def acquire_shared(self) -> None:
+        """Take the shared lock unless this holder already has a lock."""
+        if self._mode is None:
+            self._acquire(fcntl.LOCK_SH if fcntl is not None else 0)
+
+    def acquire_exclusive(self) -> None:
+        """Take the exclusive lock, upgrading a shared one."""
+        if fcntl is None:
+            self._mode = 0
+        elif self._mode != fcntl.LOCK_EX:
+            self._acquire(fcntl.LOCK_EX)
+
+    def release(self) -> None:
+        if self._mode is not None and fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mode = None
+
+    @property
+    def held(self) -> bool:
+        return self._mode is not None
+
+    def close(self) -> None:
+        self.release()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @contextmanager
+    def shared(self):
+        """Hold the shared lock for the enclosed block."""
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the exclusive lock for the enclosed block."""
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release()
+
+class IdAllocator:
+    """
+    Hands out increasing IDs from a counter file shared between processes.
+
+    Each trip to the file reserves a block of ``block_size`` IDs under an
+    exclusive lock, so concurrent writers only meet on the counter once per
+    block. IDs reserved by a process that exits unused are skipped.
+    """
+
+    def __init__(self, path, block_size: int = ID_BLOCK_SIZE, initial: Callable[[], int] = None):
+        """
+        Args:
+            path: The counter file, holding the next unreserved ID
+            block_size: IDs reserved per trip to the counter file
+            initial: Returns the first ID to use when the counter file does not exist yet
+        """
+        self.path = Path(path)
+        self.block_size = block_size
+        self.initial = initial
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(self.path.with_suffix('.lock'))
+        self._next = self._end = 0
+
+    def _read(self) -> int:
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read(COUNTER.size)
+        except FileNotFoundError:
+            data = b''
+        if len(data) == COUNTER.size:
+            return COUNTER.unpack(data)[0]
+        return self.initial() if self.initial is not None else 1
+
+    def _write(self, value: int) -> None:
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(COUNTER.pack(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def allocate(self) -> int:
+        """Return a new ID."""
+        with self._lock:
+            if self._next >= self._end:
+                with self._file_lock.exclusive():
+                    self._next = self._read()
+                    self._end = self._next + self.block_size
+                    self._write(self._end)
+            allocated = self._next
+            self._next += 1
+            return allocated
+
+    def observe(self, used_id: int) -> None:
+        """Make sure an ID chosen by the caller is never handed out."""
+        with self._lock, self._file_lock.exclusive():
+            if self._read() <= used_id:
+                self._write(used_id + 1)
+            if self._next <= used_id < self._end:
+                self._next = self._end
+
+    def high_water(self) -> int:
+        """Return one more than the highest ID reserved so far."""
+        with self._file_lock.shared():
+            return self._read()
+
+    def close(self) -> None:
+        self._file_lock.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pathlib import Path
+
+if __package__ in (None, ''):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from whisperchain.storage.engine import BACKENDS, DB_DIR, StorageEngine, open_engine
+
+def migrate(source: StorageEngine, target: StorageEngine) -> dict:
+    """
+    Copy every record from one storage engine into another.
+    Args:
+        source: The engine to read from
+        target: The engine to write to; it should be empty
+    Returns:
+        dict: Number of records copied per store
+    """
+    counts = dict.fromkeys(['users', 'tokens', 'issued', 'messages', 'receivers', 'flags', 'events'], 0)
+    with target.transaction():
+        for username, record in source.iter_users():
+            target.add_user(username, record)
+            counts['users'] += 1
+        for token, record in source.iter_tokens():
+            target.add_token(token, record)
+            counts['tokens'] += 1
+        for timestamp, record in source.iter_issued():
+            target.log_issuance(timestamp, record)
+            counts['issued'] += 1
+        for message_id, record in source.iter_messages():
+            target.add_message(record, message_id=message_id)
+            counts['messages'] += 1
+        for receiver, queue in source.iter_receivers():
+            target.add_receiver(receiver)
+            for entry in queue:
+                target.append_to_queue(receiver, entry)
+            counts['receivers'] += 1
+        for flag_id, record in source.iter_flags():
+            target.add_flag(record, flag_id=flag_id)
+            counts['flags'] += 1
+        for event in source.iter_events():
+            target.append_event(event)
+            counts['events'] += 1
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate WhisperChain+ data between storage backends')
+    parser.add_argument('--from', dest='source', default='json', choices=BACKENDS, help='Source backend')
+    parser.add_argument('--to', dest='target', default='sqlite', choices=BACKENDS, help='Target backend')
+    parser.add_argument('--db-dir', default=str(DB_DIR), help='Source data directory')
+    parser.add_argument('--target-dir', help='Target data directory (defaults to --db-dir)')
+    args = parser.parse_args()
+
+    if args.source == args.target and not args.target_dir:
+        print("Error: source and target are the same")
+        sys.exit(1)
+
+    source = open_engine(args.source, args.db_dir)
+    target = open_engine(args.target, args.target_dir or args.db_dir)
+    try:
+        counts = migrate(source, target)
+    finally:
+        source.close()
+        target.close()
+
+    for store, count in counts.items():
+        print(f"{store}: {count}")
+    print(f"Migrated {args.source} -> {args.target} successfully!")
+
+if __name__ == '__main__':
+    main()
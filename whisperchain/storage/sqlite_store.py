@@ -0,0 +1,455 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterator, Optional
+
+from whisperchain.storage.engine import StorageEngine, atomic, normalize_email
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    salt TEXT NOT NULL,
+    role TEXT NOT NULL,
+    email TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_email_normalized ON users (lower(trim(email)));
+CREATE INDEX IF NOT EXISTS users_role ON users (role, username);
+
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    expires_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS token_archive (
+    token TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    used INTEGER NOT NULL,
+    expires_at INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS issued (
+    id INTEGER PRIMARY KEY,
+    issued_at INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    token TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content TEXT NOT NULL,
+    token TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    flagged INTEGER NOT NULL DEFAULT 0,
+    read_by TEXT
+);
+
+CREATE TABLE IF NOT EXISTS receivers (
+    username TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS receiver_messages (
+    id INTEGER PRIMARY KEY,
+    receiver TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    received_at INTEGER NOT NULL,
+    read INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS receiver_messages_receiver ON receiver_messages (receiver, message_id);
+
+CREATE TABLE IF NOT EXISTS flags (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT NOT NULL,
+    moderator TEXT NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flags_message_id ON flags (message_id);
+CREATE INDEX IF NOT EXISTS flags_created_at ON flags (created_at);
+CREATE INDEX IF NOT EXISTS flags_moderator ON flags (moderator, created_at);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+CREATE INDEX IF NOT EXISTS events_type_timestamp ON events (type, timestamp);
+"""
+
+# Indexes on columns added after the first schema version
+INDEXES = """
+CREATE INDEX IF NOT EXISTS tokens_unused ON tokens (username) WHERE used = 0;
+CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at);
+"""
+
+# Columns added after the first schema version
+COLUMNS = {
+    'tokens': {'expires_at': 'INTEGER'},
+    'token_archive': {'expires_at': 'INTEGER'},
+}
+
+DB_FILE = 'whisperchain.sqlite3'
+
+class SQLiteStorageEngine(StorageEngine):
+    """
+    Backend keeping every store in one SQLite database in WAL mode.
+
+    Each table is keyed or indexed on the columns the application looks
+    records up by, so single-record operations do not scan the store.
+    """
+    name = 'sqlite'
+
+    def __init__(self, db_dir):
+        super().__init__()
+        self.db_dir = Path(db_dir)
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path(), isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self._upgrade_schema()
+        # Bumped by this connection's user writes, which data_version does not count
+        self._users_written = 0
+
+    def path(self) -> Path:
+        """Return the database file."""
+        return self.db_dir / DB_FILE
+
+    def _upgrade_schema(self) -> None:
+        """Add columns missing from databases created by older versions."""
+        for table, columns in COLUMNS.items():
+            existing = {row['name'] for row in self.conn.execute(f'PRAGMA table_info({table})')}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        self.conn.executescript(INDEXES)
+
+    def _begin(self) -> None:
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def _commit(self) -> None:
+        self.conn.execute('COMMIT')
+
+    def _rollback(self) -> None:
+        self.conn.execute('ROLLBACK')
+        # Other threads share the connection and may have read the discarded users
+        self._users_written += 1
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # Users
+
+    def get_user(self, username: str) -> Optional[dict]:
+        row = self.conn.execute(
+            'SELECT password_hash, salt, role, email FROM users WHERE username = ?',
+            (username,)).fetchone()
+        return dict(row) if row else None
+
+    def get_user_roles(self, usernames: list) -> dict:
+        usernames = list(usernames)
+        roles = {}
+        # Stay well under SQLite's limit on bound parameters
+        for start in range(0, len(usernames), 500):
+            batch = usernames[start:start + 500]
+            roles.update((row['username'], row['role']) for row in self.conn.execute(
+                f'SELECT username, role FROM users WHERE username IN ({", ".join("?" * len(batch))})', batch))
+        return roles
+
+    def find_users_by_role(self, role: str) -> list:
+        return [row['username'] for row in self.conn.execute(
+            'SELECT username FROM users WHERE role = ? ORDER BY username', (role,))]
+
+    def rebuild_indexes(self) -> None:
+        self.conn.execute('REINDEX')
+
+    def find_user_by_email(self, email: str) -> Optional[str]:
+        row = self.conn.execute(
+            'SELECT username FROM users WHERE lower(trim(email)) = ? LIMIT 1',
+            (normalize_email(email),)).fetchone()
+        return row['username'] if row else None
+
+    @atomic
+    def add_user(self, username: str, record: dict) -> None:
+        self.conn.execute(
+            'INSERT OR REPLACE INTO users (username, password_hash, salt, role, email) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (username, record['password_hash'], record['salt'], record['role'], record['email']))
+        self._users_written += 1
+
+    def iter_users(self) -> Iterator[tuple[str, dict]]:
+        for row in self.conn.execute(
+                'SELECT username, password_hash, salt, role, email FROM users'):
+            record = dict(row)
+            yield record.pop('username'), record
+
+    def users_version(self):
+        # data_version changes when another connection commits
+        return self._users_written, self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    # Tokens
+
+    def get_token(self, token: str) -> Optional[dict]:
+        row = self.conn.execute(
+            'SELECT username, created_at, used, expires_at FROM tokens WHERE token = ?',
+            (token,)).fetchone()
+        return _token_record(row) if row else None
+
+    def find_unused_token(self, username: str, now: int = None) -> Optional[str]:
+        row = self.conn.execute(
+            'SELECT token FROM tokens WHERE username = ? AND used = 0 '
+            'AND (? IS NULL OR expires_at IS NULL OR expires_at > ?) LIMIT 1',
+            (username, now, now)).fetchone()
+        return row['token'] if row else None
+
+    @atomic
+    def add_token(self, token: str, record: dict) -> None:
+        if self.conn.execute('SELECT 1 FROM token_archive WHERE token = ?', (token,)).fetchone():
+            raise ValueError("Token already exists")
+        try:
+            self.conn.execute(
+                'INSERT INTO tokens (token, username, created_at, used, expires_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (token, record['username'], record['created_at'], int(record['used']),
+                 record.get('expires_at')))
+        except sqlite3.IntegrityError:
+            raise ValueError("Token already exists")
+
+    @atomic
+    def set_token_used(self, token: str) -> bool:
+        cursor = self.conn.execute('UPDATE tokens SET used = 1 WHERE token = ?', (token,))
+        return cursor.rowcount > 0
+
+    def consume_token(self, token: str, username: str, now: int) -> bool:
+        # A single conditional UPDATE is the compare-and-set; SQLite serialises writers
+        cursor = self.conn.execute(
+            'UPDATE tokens SET used = 1 WHERE token = ? AND username = ? AND used = 0 '
+            'AND (expires_at IS NULL OR expires_at > ?)',
+            (token, username, now))
+        return cursor.rowcount > 0
+
+    def sweep_tokens(self, now: int = None) -> int:
+        condition = 'used = 1 OR (? IS NOT NULL AND expires_at <= ?)'
+        with self.transaction():
+            self.conn.execute(
+                'INSERT OR REPLACE INTO token_archive '
+                'SELECT token, username, created_at, used, expires_at FROM tokens WHERE ' + condition,
+                (now, now))
+            cursor = self.conn.execute('DELETE FROM tokens WHERE ' + condition, (now, now))
+        return cursor.rowcount
+
+    @atomic
+    def log_issuance(self, timestamp: int, record: dict) -> None:
+        self.conn.execute(
+            'INSERT INTO issued (issued_at, username, token) VALUES (?, ?, ?)',
+            (timestamp, record['username'], record['token']))
+
+    def iter_tokens(self) -> Iterator[tuple[str, dict]]:
+        for row in self.conn.execute(
+                'SELECT token, username, created_at, used, expires_at FROM token_archive '
+                'UNION ALL SELECT token, username, created_at, used, expires_at FROM tokens'):
+            yield row['token'], _token_record(row)
+
+    def iter_issued(self) -> Iterator[tuple[int, dict]]:
+        for row in self.conn.execute('SELECT issued_at, username, token FROM issued ORDER BY id'):
+            yield row['issued_at'], {'username': row['username'], 'token': row['token']}
+
+    # Messages
+
+    @atomic
+    def add_message(self, record: dict, message_id: int = None) -> int:
+        cursor = self.conn.execute(
+            'INSERT INTO messages (id, content, token, created_at, flagged, read_by) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (message_id, record['content'], record['token'], record['created_at'],
+             int(record.get('flagged', False)),
+             json.dumps(record['read_by']) if 'read_by' in record else None))
+        return cursor.lastrowid
+
+    def get_message(self, message_id) -> Optional[dict]:
+        try:
+            message_id = int(message_id)
+        except ValueError:
+            return None
+        row = self.conn.execute(
+            'SELECT content, token, created_at, flagged, read_by FROM messages WHERE id = ?',
+            (message_id,)).fetchone()
+        return _message_record(row) if row else None
+
+    def get_messages(self, message_ids: list) -> dict:
+        ids = [int(message_id) for message_id in message_ids if str(message_id).isdigit()]
+        messages = {}
+        # Stay well under SQLite's limit on bound parameters
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            messages.update((str(row['id']), _message_record(row)) for row in self.conn.execute(
+                'SELECT id, content, token, created_at, flagged, read_by FROM messages '
+                f'WHERE id IN ({", ".join("?" * len(batch))})', batch))
+        return messages
+
+    @atomic
+    def set_message_flagged(self, message_id, flagged: bool = True) -> None:
+        self.conn.execute('UPDATE messages SET flagged = ? WHERE id = ?',
+                          (int(flagged), int(message_id)))
+
+    def iter_messages(self, since_id: int = None, unflagged_only: bool = False) -> Iterator[tuple[int, dict]]:
+        query = 'SELECT id, content, token, created_at, flagged, read_by FROM messages WHERE id > ?'
+        if unflagged_only:
+            query += ' AND flagged = 0'
+        for row in self.conn.execute(query + ' ORDER BY id', (since_id or 0,)):
+            yield row['id'], _message_record(row)
+
+    # Receiver queues
+
+    @atomic
+    def add_receiver(self, username: str) -> None:
+        self.conn.execute('INSERT OR IGNORE INTO receivers (username) VALUES (?)', (username,))
+
+    def receiver_exists(self, username: str) -> bool:
+        row = self.conn.execute(
+            'SELECT 1 FROM receivers WHERE username = ?', (username,)).fetchone()
+        return row is not None
+
+    @atomic
+    def append_to_queue(self, receiver: str, entry: dict) -> None:
+        self.conn.execute(
+            'INSERT INTO receiver_messages (receiver, message_id, received_at, read) '
+            'VALUES (?, ?, ?, ?)',
+            (receiver, entry['message_id'], entry['received_at'], int(entry['read'])))
+
+    def get_queue(self, receiver: str) -> list:
+        rows = self.conn.execute(
+            'SELECT message_id, received_at, read FROM receiver_messages '
+            'WHERE receiver = ? ORDER BY id', (receiver,))
+        return [_queue_entry(row) for row in rows]
+
+    def iter_queue(self, receiver: str, since_id: int = None, unread_only: bool = False,
+                   limit: int = None) -> Iterator[dict]:
+        query = 'SELECT message_id, received_at, read FROM receiver_messages WHERE receiver = ?'
+        params = [receiver]
+        if since_id is not None:
+            # IDs need not be queued in order; page from since_id's entry,
+            # or by ID if it is not queued, as the JSON backend does
+            row = self.conn.execute(
+                'SELECT id FROM receiver_messages WHERE receiver = ? AND message_id = ? '
+                'ORDER BY id DESC LIMIT 1', (receiver, str(since_id))).fetchone()
+            if row is not None:
+                query += ' AND id > ?'
+                params.append(row['id'])
+            else:
+                query += ' AND CAST(message_id AS INTEGER) > ?'
+                params.append(int(since_id))
+        if unread_only:
+            query += ' AND read = 0'
+        query += ' ORDER BY id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        for row in self.conn.execute(query, params).fetchall():
+            yield _queue_entry(row)
+
+    @atomic
+    def set_queue_read(self, receiver: str, message_ids: list) -> int:
+        message_ids = [str(message_id) for message_id in message_ids]
+        changed = 0
+        # Stay well under SQLite's limit on bound parameters
+        for start in range(0, len(message_ids), 500):
+            batch = message_ids[start:start + 500]
+            cursor = self.conn.execute(
+                'UPDATE receiver_messages SET read = 1 WHERE receiver = ? AND read = 0 '
+                f'AND message_id IN ({", ".join("?" * len(batch))})',
+                [receiver] + batch)
+            changed += cursor.rowcount
+        return changed
+
+    def iter_receivers(self) -> Iterator[tuple[str, list]]:
+        receivers = [row['username'] for row in self.conn.execute('SELECT username FROM receivers')]
+        for receiver in receivers:
+            yield receiver, self.get_queue(receiver)
+
+    # Flags
+
+    @atomic
+    def add_flag(self, record: dict, flag_id: int = None) -> int:
+        cursor = self.conn.execute(
+            'INSERT INTO flags (id, message_id, moderator, created_at) VALUES (?, ?, ?, ?)',
+            (flag_id, record['message_id'], record['moderator'], record['created_at']))
+        return cursor.lastrowid
+
+    def iter_flags(self) -> Iterator[tuple[int, dict]]:
+        for row in self.conn.execute(
+                'SELECT id, message_id, moderator, created_at FROM flags ORDER BY id'):
+            record = dict(row)
+            yield record.pop('id'), record
+
+    def query_flags(self, since: int = None, moderator: str = None,
+                    limit: int = None) -> Iterator[tuple[int, dict]]:
+        query = 'SELECT id, message_id, moderator, created_at FROM flags WHERE created_at >= ?'
+        params = [since if since is not None else 0]
+        if moderator is not None:
+            query += ' AND moderator = ?'
+            params.append(moderator)
+        query += ' ORDER BY created_at, id LIMIT ?'
+        params.append(-1 if limit is None else limit)
+        for row in self.conn.execute(query, params).fetchall():
+            record = dict(row)
+            yield record.pop('id'), record
+
+    # Audit events
+
+    @atomic
+    def append_event(self, event: dict) -> None:
+        self.conn.execute(
+            'INSERT INTO events (timestamp, type, data) VALUES (?, ?, ?)',
+            (event['timestamp'], event['type'], json.dumps(event['data'])))
+
+    def iter_events(self, event_type: str = None, start_time: int = None,
+                    end_time: int = None, limit: int = None, offset: int = 0) -> Iterator[dict]:
+        clauses, params = [], []
+        if event_type is not None:
+            clauses.append('type = ?')
+            params.append(event_type)
+        if start_time is not None:
+            clauses.append('timestamp >= ?')
+            params.append(start_time)
+        if end_time is not None:
+            clauses.append('timestamp <= ?')
+            params.append(end_time)
+        query = 'SELECT timestamp, type, data FROM events'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY timestamp, id'
+        if limit is not None or offset:
+            query += ' LIMIT ? OFFSET ?'
+            params += [-1 if limit is None else limit, offset]
+        for row in self.conn.execute(query, params):
+            yield {'timestamp': row['timestamp'], 'type': row['type'],
+                   'data': json.loads(row['data'])}
+
+def _token_record(row) -> dict:
+    record = {'username': row['username'], 'created_at': row['created_at'],
+              'used': bool(row['used'])}
+    if row['expires_at'] is not None:
+        record['expires_at'] = row['expires_at']
+    return record
+
+def _message_record(row) -> dict:
+    record = {
+        'content': row['content'],
+        'token': row['token'],
+        'created_at': row['created_at'],
+        'flagged': bool(row['flagged'])
+    }
+    if row['read_by'] is not None:
+        record['read_by'] = json.loads(row['read_by'])
+    return record
+
+def _queue_entry(row) -> dict:
+    return {'message_id': row['message_id'], 'received_at': row['received_at'],
+            'read': bool(row['read'])}
@@ -0,0 +1,510 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from whisperchain.storage import json_store
+from whisperchain.storage.bitmap import is_set, new_bitmap, reader, set_bits
+from whisperchain.storage.codec import CODECS, FORMAT_VERSION, HEADER, MAGIC, decode_document, get_codec
+from whisperchain.storage.engine import ConflictError, open_engine, set_engine
+from whisperchain.storage.locking import IdAllocator
+from whisperchain.storage.migrate import migrate
+from whisperchain.storage.testing import TempEngineTestCase
+from whisperchain.auth.register import register_user, login_user
+from whisperchain.tokens.generate import generate_token, generate_tokens, validate_token, archive_used_tokens, consume_token
+from whisperchain.messaging.flag import flag_message
+from whisperchain.messaging.send import send_message, get_receiver_messages, get_receiver_page, mark_message_read, mark_messages_read
+
+def _add_messages(db_dir, worker, count):
+    # Runs in a child process sharing db_dir with its siblings
+    engine = open_engine("json", db_dir, id_block=4)
+    for i in range(count):
+        engine.add_receiver(f"r{worker}-{i}")
+        engine.add_message({"content": f"{worker}-{i}", "token": "t", "created_at": i, "flagged": False})
+    engine.close()
+
+class StorageEngineTests:
+    # Mixed into a TempEngineTestCase per backend and codec
+
+    def test_users(self):
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        self.assertEqual(self.engine.get_user("alice")["role"], "Sender")
+        self.assertEqual(self.engine.find_user_by_email("alice@dartmouth.edu"), "alice")
+        self.assertIsNone(self.engine.get_user("nobody"))
+        self.assertTrue(login_user("alice", "password123"))
+
+    def test_email_uniqueness_is_normalized(self):
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        self.assertEqual(self.engine.find_user_by_email("Alice@Dartmouth.edu"), "alice")
+        with self.assertRaises(ValueError):
+            register_user("alice2", "password123", "Sender", "ALICE@dartmouth.edu")
+        self.engine.rebuild_indexes()
+        self.assertEqual(self.engine.find_user_by_email("alice@dartmouth.edu"), "alice")
+
+    def test_users_version_changes_on_write(self):
+        before = self.engine.users_version()
+        self.assertEqual(self.engine.users_version(), before)
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        self.assertNotEqual(self.engine.users_version(), before)
+
+    def test_users_by_role(self):
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        register_user("bob", "password123", "Receiver", "bob@dartmouth.edu")
+        register_user("carol", "password123", "Sender", "carol@dartmouth.edu")
+        self.assertEqual(self.engine.find_users_by_role("Sender"), ["alice", "carol"])
+        self.assertEqual(self.engine.get_user_roles(["bob", "nobody"]), {"bob": "Receiver"})
+        self.engine.add_user("alice", {**self.engine.get_user("alice"), "role": "Receiver"})
+        self.assertEqual(self.engine.find_users_by_role("Sender"), ["carol"])
+        self.assertEqual(self.engine.find_users_by_role("Receiver"), ["alice", "bob"])
+
+    def test_tokens(self):
+        token = generate_token("alice")
+        self.assertEqual(generate_token("alice"), token)
+        self.assertEqual(validate_token(token), "alice")
+        self.assertTrue(self.engine.set_token_used(token))
+        self.assertIsNone(validate_token(token))
+        self.assertFalse(self.engine.set_token_used("invalid"))
+        self.assertEqual(len(list(self.engine.iter_issued())), 1)
+
+    def test_unused_token_index_and_archive(self):
+        first = generate_token("alice")
+        self.assertEqual(self.engine.find_unused_token("alice"), first)
+        self.assertIsNone(self.engine.find_unused_token("bob"))
+        self.engine.set_token_used(first)
+        self.assertIsNone(self.engine.find_unused_token("alice"))
+        second = generate_token("alice")
+        self.assertNotEqual(second, first)
+        self.assertEqual(archive_used_tokens(), 1)
+        self.assertIsNone(self.engine.get_token(first))
+        self.assertEqual(validate_token(second), "alice")
+        self.assertEqual(sorted(token for token, _ in self.engine.iter_tokens()), sorted([first, second]))
+        self.assertEqual(archive_used_tokens(), 0)
+
+    def test_consume_token(self):
+        token = generate_token("alice")
+        with self.assertRaises(ValueError):
+            consume_token(token, "bob")
+        consume_token(token, "alice")
+        self.assertIsNone(validate_token(token))
+        self.assertIsNone(self.engine.find_unused_token("alice"))
+        with self.assertRaises(ValueError):
+            consume_token(token, "alice")
+        self.engine.add_token("old", {"username": "alice", "created_at": 1, "expires_at": 5, "used": False})
+        self.assertFalse(self.engine.consume_token("old", "alice", now=10))
+        with self.assertRaises(ValueError):
+            self.engine.add_token("old", {"username": "bob", "created_at": 1, "expires_at": 50, "used": False})
+        self.assertEqual(self.engine.get_token("old")["username"], "alice")
+        self.assertEqual(self.engine.sweep_tokens(now=10), 2)
+        with self.assertRaises(ValueError):
+            self.engine.add_token("old", {"username": "bob", "created_at": 1, "expires_at": 50, "used": False})
+        self.assertIsNone(self.engine.get_token("old"))
+
+    def test_consume_token_once_under_contention(self):
+        token = generate_token("alice")
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.engine.consume_token(token, "alice", 0)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 1)
+
+    def test_send_and_view(self):
+        self.engine.add_receiver("bob")
+        token = generate_token("alice")
+        message_id = send_message("alice", token, "Hello", "bob")
+        messages = list(get_receiver_messages("bob"))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["message_id"], str(message_id))
+        self.assertEqual(messages[0]["content"], "Hello")
+        self.assertFalse(messages[0]["read"])
+
+    def test_queue_paged_by_position(self):
+        # Processes reserving ID blocks can queue a lower ID after a higher one
+        self.engine.add_receiver("bob")
+        for message_id in ("11", "1", "12"):
+            self.engine.append_to_queue("bob", {"message_id": message_id, "received_at": 1, "read": False})
+        self.assertEqual([e["message_id"] for e in self.engine.iter_queue("bob", since_id=11)], ["1", "12"])
+        self.assertEqual([e["message_id"] for e in self.engine.iter_queue("bob", since_id=5)], ["11", "12"])
+
+    def test_receiver_page_continues_past_missing_bodies(self):
+        self.engine.add_receiver("bob")
+        ids = [str(self.engine.add_message({"content": f"m{i}", "token": "t", "created_at": i, "flagged": False}))
+               for i in range(3)]
+        for message_id in (ids[0], "999999", ids[1], ids[2]):
+            self.engine.append_to_queue("bob", {"message_id": message_id, "received_at": 1, "read": False})
+        page = get_receiver_page("bob", limit=2)
+        self.assertEqual([m["content"] for m in page["messages"]], ["m0"])
+        self.assertEqual(page["next"], "999999")
+        page = get_receiver_page("bob", since_id=page["next"], limit=2)
+        self.assertEqual([m["content"] for m in page["messages"]], ["m1", "m2"])
+        page = get_receiver_page("bob", since_id=page["next"], limit=2)
+        self.assertEqual(page, {"messages": [], "next": None})
+
+    def test_receiver_messages_paged(self):
+        self.engine.add_receiver("bob")
+        self.engine.add_receiver("carol")
+        ids = [send_message("alice", token, f"m{i}", "bob")
+               for i, token in enumerate(generate_tokens("alice", 5))]
+        send_message("alice", generate_token("alice"), "other", "carol")
+        page = list(get_receiver_messages("bob", limit=2))
+        self.assertEqual([m["content"] for m in page], ["m0", "m1"])
+        page = list(get_receiver_messages("bob", since_id=page[-1]["message_id"], limit=2))
+        self.assertEqual([m["content"] for m in page], ["m2", "m3"])
+        mark_message_read("bob", str(ids[4]))
+        unread = list(get_receiver_messages("bob", since_id=ids[1], unread_only=True))
+        self.assertEqual([m["content"] for m in unread], ["m2", "m3"])
+        self.assertEqual(len(list(get_receiver_messages("bob", limit=None))), 5)
+
+    def test_mark_messages_read_in_bulk(self):
+        self.engine.add_receiver("bob")
+        ids = [send_message("alice", token, f"m{i}", "bob")
+               for i, token in enumerate(generate_tokens("alice", 4))]
+        self.assertEqual(mark_messages_read("bob", [ids[0], ids[2]]), 2)
+        self.assertEqual(mark_messages_read("bob", [ids[0], ids[1]]), 1)
+        self.assertEqual([m["read"] for m in get_receiver_messages("bob")], [True, True, True, False])
+        self.assertEqual(mark_messages_read("bob", ids), 1)
+
+    def test_query_flags(self):
+        self.engine.add_flag({"message_id": "1", "moderator": "mod", "created_at": 30})
+        self.engine.add_flag({"message_id": "2", "moderator": "other", "created_at": 10})
+        self.engine.add_flag({"message_id": "3", "moderator": "mod", "created_at": 20})
+        self.assertEqual([r["message_id"] for _, r in self.engine.query_flags()], ["2", "3", "1"])
+        self.assertEqual([r["message_id"] for _, r in self.engine.query_flags(since=15)], ["3", "1"])
+        self.assertEqual([r["message_id"] for _, r in self.engine.query_flags(moderator="mod", limit=1)], ["3"])
+        self.assertEqual(list(self.engine.query_flags(moderator="nobody")), [])
+
+    def test_send_to_missing_receiver_keeps_token(self):
+        token = generate_token("alice")
+        with self.assertRaises(ValueError):
+            send_message("alice", token, "Hello", "nobody")
+        self.assertEqual(validate_token(token), "alice")
+        self.assertEqual(list(self.engine.iter_messages()), [])
+
+    def test_transaction_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with self.engine.transaction():
+                self.engine.add_receiver("bob")
+                raise RuntimeError("abort")
+        self.assertFalse(self.engine.receiver_exists("bob"))
+
+    def test_events(self):
+        self.engine.append_event({"timestamp": 10, "type": "a", "data": {"n": 1}})
+        self.engine.append_event({"timestamp": 20, "type": "b", "data": {"n": 2}})
+        self.engine.append_event({"timestamp": 30, "type": "a", "data": {"n": 3}})
+        events = list(self.engine.iter_events(event_type="a", start_time=15))
+        self.assertEqual([e["data"]["n"] for e in events], [3])
+        events = list(self.engine.iter_events(limit=1, offset=1))
+        self.assertEqual([e["data"]["n"] for e in events], [2])
+
+class TestJSONStorage(StorageEngineTests, TempEngineTestCase):
+    backend = "json"
+
+    def test_commit_is_durable_before_journal_is_dropped(self):
+        journal = self.engine.db_dir / "journal.json"
+        synced = []
+        self.engine.add_receiver("bob")
+        with mock.patch.object(json_store, "_fsync_directory",
+                               side_effect=lambda path: synced.append((path, journal.exists()))), \
+                mock.patch.object(os, "fsync", wraps=os.fsync) as fsync:
+            with self.engine.transaction():
+                self.engine.append_to_queue("bob", {"message_id": "1", "received_at": 1, "read": False})
+                self.engine.log_issuance(1, {"username": "alice", "token": "t"})
+        # The journal, the line file and the queue were each fsynced
+        self.assertGreaterEqual(fsync.call_count, 3)
+        self.assertIn((self.engine.db_dir / "inbox", True), synced)
+        self.assertIn((self.engine.db_dir, True), synced)
+        self.assertFalse(journal.exists())
+
+    def test_email_index_rebuilt_when_corrupt(self):
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        register_user("bob", "password123", "Receiver", "bob@dartmouth.edu")
+        index_path = self.engine.path("users_email_index")
+        index_path.write_text("{not json")
+        self.assertEqual(self.engine.find_user_by_email("bob@dartmouth.edu"), "bob")
+        index_path.unlink()
+        self.assertEqual(self.engine.find_user_by_email("alice@dartmouth.edu"), "alice")
+        self.assertTrue(index_path.exists())
+
+    def test_role_index_built_for_legacy_users_file(self):
+        self.engine.path("users").write_text(
+            '{"bob": {"password_hash": "h", "salt": "s", "role": "Receiver", "email": "bob@dartmouth.edu"}}')
+        self.assertEqual(self.engine.find_users_by_role("Receiver"), ["bob"])
+        self.assertTrue(self.engine.path("users_role_index").exists())
+
+    def test_unused_index_built_for_legacy_tokens_file(self):
+        self.engine.path("tokens").write_text(
+            '{"tokens": {"t1": {"username": "alice", "created_at": 1, "used": true},'
+            ' "t2": {"username": "alice", "created_at": 2, "used": false}}, "issued": {}}')
+        self.assertEqual(self.engine.find_unused_token("alice"), "t2")
+
+    def test_legacy_issued_map_moved_to_log(self):
+        self.engine.path("tokens").write_text(
+            '{"tokens": {"t1": {"username": "alice", "created_at": 5, "used": false}},'
+            ' "issued": {"5": {"username": "alice", "token": "t1"}}}')
+        self.assertEqual(list(self.engine.iter_issued()), [(5, {"username": "alice", "token": "t1"})])
+        self.assertNotIn("issued", json.loads(self.engine.path("tokens").read_text()))
+        self.engine.log_issuance(5, {"username": "bob", "token": "t2"})
+        self.assertEqual(len(list(self.engine.iter_issued())), 2)
+
+    def test_interrupted_commit_replayed_on_open(self):
+        self.engine.add_receiver("bob")
+        token = generate_token("alice")
+        with mock.patch.object(self.engine, "_apply", side_effect=OSError("crash")):
+            with self.assertRaises(OSError):
+                send_message("alice", token, "Hello", "bob")
+        self.assertTrue((self.engine.db_dir / "journal.json").exists())
+        self.engine = open_engine("json", self.tmp.name)
+        set_engine(self.engine)
+        self.assertFalse((self.engine.db_dir / "journal.json").exists())
+        self.assertIsNone(validate_token(token))
+        self.assertEqual(next(get_receiver_messages("bob"))["content"], "Hello")
+
+    def test_interrupted_commit_replayed_by_running_engine(self):
+        peer = open_engine("json", self.tmp.name, cache=True)
+        self.addCleanup(peer.close)
+        self.engine.add_receiver("bob")
+        token = generate_token("alice")
+        with mock.patch.object(self.engine, "_apply", side_effect=OSError("crash")):
+            with self.assertRaises(OSError):
+                send_message("alice", token, "Hello", "bob")
+        peer.add_receiver("carol")
+        self.assertFalse((self.engine.db_dir / "journal.json").exists())
+        self.assertTrue(peer.get_token(token)["used"])
+        self.assertEqual([entry["message_id"] for entry in peer.get_queue("bob")], ["1"])
+        self.assertTrue(peer.receiver_exists("carol"))
+
+    def test_journal_replay_does_not_duplicate_appends(self):
+        self.engine.log_issuance(1, {"username": "alice", "token": "t1"})
+        offset = (self.engine.db_dir / "tokens_issued.jsonl").stat().st_size
+        records = [{"issued_at": 2, "username": "bob", "token": "t2"}]
+        # Crash after the append was applied but before the journal was removed
+        self.engine._write_journal({"documents": {}, "appends": {
+            "tokens_issued.jsonl": {"offset": offset, "records": records}}})
+        self.engine._write_lines("tokens_issued.jsonl", records)
+        self.engine = open_engine("json", self.tmp.name)
+        set_engine(self.engine)
+        self.assertEqual([timestamp for timestamp, _ in self.engine.iter_issued()], [1, 2])
+
+    def test_legacy_receiver_queues_moved_to_inboxes(self):
+        self.engine.path("receivers").write_text(
+            '{"receivers": {"bob": {"messages": [{"message_id": "1", "received_at": 1, "read": false}]}}}')
+        self.engine.add_message({"content": "hi", "token": "t", "created_at": 1, "flagged": False}, message_id=1)
+        self.assertEqual(next(get_receiver_messages("bob"))["content"], "hi")
+        self.assertEqual(json.loads(self.engine.path("receivers").read_text()), {"receivers": {"bob": {}}})
+        self.assertTrue(self.engine.path("inbox/bob").exists())
+
+    def test_legacy_read_flags_moved_to_bitmap(self):
+        self.engine.path("receivers").write_text('{"receivers": {"bob": {"messages": ['
+            '{"message_id": "1", "received_at": 1, "read": true},'
+            '{"message_id": "2", "received_at": 1, "read": false}]}}}')
+        self.assertEqual([entry["read"] for entry in self.engine.get_queue("bob")], [True, False])
+        self.assertNotIn("read", json.loads(self.engine.path("inbox/bob").read_text())["messages"][0])
+        self.assertEqual(json.loads(self.engine.path("inbox_read/bob").read_text())["base"], 1)
+
+    def test_legacy_messages_moved_to_shards(self):
+        self.engine.path("messages").write_text(
+            '{"messages": {"1": {"content": "a", "token": "t", "created_at": 1, "flagged": true},'
+            ' "1500": {"content": "b", "token": "t", "created_at": 2, "flagged": false}}, "next_id": 1501}')
+        self.assertTrue(self.engine.get_message("1")["flagged"])
+        self.assertEqual(self.engine.get_message(1500)["content"], "b")
+        self.assertEqual(json.loads(self.engine.path("messages").read_text()), {"next_id": 1501})
+        self.assertTrue(self.engine.path("messages/000001").exists())
+        self.assertEqual([message_id for message_id, _ in self.engine.iter_messages()], [1, 1500])
+        self.assertEqual(self.engine.add_message({"content": "c", "token": "t", "created_at": 3}), 1501)
+
+    def test_flag_touches_only_flag_files(self):
+        message_id = self.engine.add_message({"content": "a", "token": "t", "created_at": 1, "flagged": False})
+        shard = self.engine.path("messages/000000")
+        before = shard.stat().st_mtime_ns
+        flag_message("mod", str(message_id))
+        self.assertEqual(shard.stat().st_mtime_ns, before)
+        self.assertEqual(json.loads(self.engine.path("message_flags").read_text()), {"flagged": [message_id]})
+        self.assertTrue(self.engine.get_message(message_id)["flagged"])
+        with self.assertRaises(ValueError):
+            flag_message("mod", str(message_id))
+
+    def test_flag_index_rebuilt_when_stale(self):
+        self.engine.path("flags").write_text(
+            '{"flags": {"1": {"message_id": "1", "moderator": "mod", "created_at": 5}}, "next_id": 2}')
+        self.assertEqual([flag_id for flag_id, _ in self.engine.query_flags(moderator="mod")], [1])
+        self.assertEqual(json.loads(self.engine.path("flags_index").read_text())["flags"], 1)
+
+    def test_conflicting_commit_refused(self):
+        engines = [open_engine("json", self.tmp.name) for _ in range(2)]
+        both_read = threading.Barrier(2)
+        results = []
+
+        def add(engine, receiver):
+            try:
+                with engine.transaction():
+                    engine.add_receiver(receiver)
+                    both_read.wait()
+                results.append("committed")
+            except ConflictError:
+                results.append("conflict")
+
+        threads = [threading.Thread(target=add, args=(engine, f"r{i}")) for i, engine in enumerate(engines)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ["committed", "conflict"])
+        self.assertEqual(sum(self.engine.receiver_exists(f"r{i}") for i in range(2)), 1)
+        for engine in engines:
+            engine.close()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_writers_in_several_processes(self):
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=_add_messages, args=(self.tmp.name, worker, 10)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(len(list(self.engine.iter_receivers())), 40)
+        contents = sorted(record["content"] for _, record in self.engine.iter_messages())
+        self.assertEqual(contents, sorted(f"{w}-{i}" for w in range(4) for i in range(10)))
+
+class TestBinaryJSONStorage(StorageEngineTests, TempEngineTestCase):
+    backend = "json"
+    codec = "binary"
+
+    def test_documents_are_binary(self):
+        register_user("alice", "password123", "Sender", "alice@dartmouth.edu")
+        self.assertEqual(self.engine.path("users").read_bytes()[:len(MAGIC)], MAGIC)
+
+class TestSQLiteStorage(StorageEngineTests, TempEngineTestCase):
+    backend = "sqlite"
+
+    @unittest.skipUnless(hasattr(sqlite3.Connection, "setlimit"), "needs Connection.setlimit (Python 3.11)")
+    def test_get_messages_beyond_parameter_limit(self):
+        # Older SQLite builds allow only 999 bound parameters
+        self.engine.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        with self.engine.transaction():
+            ids = [self.engine.add_message({"content": f"m{i}", "token": "t", "created_at": i, "flagged": False})
+                   for i in range(1200)]
+        messages = self.engine.get_messages(ids + ["bogus"])
+        self.assertEqual(len(messages), 1200)
+        self.assertEqual(messages[str(ids[-1])]["content"], "m1199")
+
+    def test_schema_upgrade_adds_expiry(self):
+        self.engine.close()
+        conn = sqlite3.connect(self.engine.path())
+        conn.executescript("DROP TABLE tokens; CREATE TABLE tokens (token TEXT PRIMARY KEY, "
+                           "username TEXT NOT NULL, created_at INTEGER NOT NULL, used INTEGER NOT NULL);"
+                           "INSERT INTO tokens VALUES ('t1', 'alice', 1, 0);")
+        conn.close()
+        self.engine = open_engine("sqlite", self.tmp.name)
+        set_engine(self.engine)
+        self.assertEqual(self.engine.find_unused_token("alice", now=10), "t1")
+        self.engine.add_token("t2", {"username": "bob", "created_at": 1, "expires_at": 5, "used": False})
+        self.assertIsNone(self.engine.find_unused_token("bob", now=10))
+        self.assertEqual(self.engine.sweep_tokens(now=10), 1)
+
+class TestBitmap(unittest.TestCase):
+    def test_set_bits(self):
+        bitmap = new_bitmap()
+        self.assertEqual(set_bits(bitmap, [1, 3]), 2)
+        self.assertEqual(bitmap["base"], 0)
+        self.assertEqual(set_bits(bitmap, [0, 1]), 1)
+        self.assertEqual(bitmap["base"], 2)
+        self.assertEqual([is_set(bitmap, i) for i in range(5)], [True, True, False, True, False])
+        set_bits(bitmap, range(5))
+        self.assertEqual(bitmap, {"base": 5, "bits": "0"})
+
+    def test_reader(self):
+        bitmap = new_bitmap()
+        set_bits(bitmap, [0, 1, 2, 9, 16, 17, 40])
+        is_read = reader(bitmap)
+        self.assertEqual([position for position in range(100) if is_read(position)], [0, 1, 2, 9, 16, 17, 40])
+        self.assertEqual([is_read(position) for position in range(100)],
+                         [is_set(bitmap, position) for position in range(100)])
+
+class TestCodecs(unittest.TestCase):
+    doc = {"messages": {"1": {"content": "héllo", "token": "t", "created_at": 1700000000, "flagged": False,
+                              "read_by": [], "score": 0.5, "note": None}},
+           "ids": [1, 2, 300], "wide": [-1, 2 ** 40], "mixed": [1, "a", True], "big": 2 ** 70, "empty": {}}
+
+    def test_round_trip(self):
+        for name, codec in CODECS.items():
+            data = codec.encode(self.doc)
+            self.assertEqual(decode_document(data), self.doc, name)
+            self.assertEqual(decode_document(memoryview(data)), self.doc, name)
+        self.assertLess(len(get_codec("json").encode(self.doc)), len(get_codec("json-indent").encode(self.doc)))
+
+    def test_binary_header(self):
+        data = bytearray(get_codec("binary").encode(self.doc))
+        self.assertEqual(HEADER.unpack_from(data)[:2], (MAGIC, FORMAT_VERSION))
+        with self.assertRaises(ValueError):
+            decode_document(data[:-1])
+        HEADER.pack_into(data, 0, MAGIC, FORMAT_VERSION + 1, *HEADER.unpack_from(data)[2:])
+        with self.assertRaises(ValueError):
+            decode_document(data)
+
+    def test_rewrite_documents(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = open_engine("json", tmp, codec="json-indent")
+            try:
+                engine.add_user("alice", {"password_hash": "h", "salt": "s", "role": "Sender",
+                                          "email": "alice@dartmouth.edu"})
+                engine.add_message({"content": "hi", "token": "tok", "created_at": 2, "flagged": False})
+                # users, the email and role indexes and one message shard
+                self.assertEqual(engine.rewrite_documents("binary"), 4)
+                self.assertEqual(engine.path("messages/000000").read_bytes()[:len(MAGIC)], MAGIC)
+                reader = open_engine("json", tmp)
+                self.assertEqual(reader.get_message("1")["content"], "hi")
+                reader.close()
+                engine.rewrite_documents("json")
+                self.assertEqual(json.loads(engine.path("users").read_text())["alice"]["role"], "Sender")
+            finally:
+                engine.close()
+
+class TestIdAllocator(unittest.TestCase):
+    def test_blocks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ids.counter")
+            first = IdAllocator(path, block_size=10, initial=lambda: 5)
+            second = IdAllocator(path, block_size=10)
+            self.assertEqual([first.allocate(), first.allocate()], [5, 6])
+            self.assertEqual(second.allocate(), 15)
+            self.assertEqual(first.high_water(), 25)
+            self.assertEqual(first.allocate(), 7)
+            # An ID stored by the caller is skipped, inside a block or beyond the counter
+            first.observe(8)
+            second.observe(40)
+            self.assertEqual([first.allocate(), second.allocate()], [41, 16])
+            first.close()
+            second.close()
+
+class TestMigration(unittest.TestCase):
+    def test_json_to_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = open_engine("json", tmp)
+            source.add_user("alice", {"password_hash": "h", "salt": "s", "role": "Sender",
+                                      "email": "alice@dartmouth.edu"})
+            source.add_token("tok", {"username": "alice", "created_at": 1, "used": True})
+            source.add_message({"content": "hi", "token": "tok", "created_at": 2, "flagged": False},
+                               message_id=7)
+            source.add_receiver("bob")
+            source.append_to_queue("bob", {"message_id": "7", "received_at": 2, "read": False})
+            source.add_flag({"message_id": "7", "moderator": "mod", "created_at": 3})
+
+            target = open_engine("sqlite", tmp)
+            counts = migrate(source, target)
+            self.assertEqual(counts["users"], 1)
+            self.assertEqual(target.get_user("alice")["email"], "alice@dartmouth.edu")
+            self.assertTrue(target.get_token("tok")["used"])
+            self.assertEqual(target.get_message("7")["content"], "hi")
+            self.assertEqual(target.get_queue("bob")[0]["message_id"], "7")
+            self.assertEqual(list(target.iter_flags())[0][1]["moderator"], "mod")
+            self.assertEqual(target.add_message({"content": "x", "token": "t", "created_at": 4}), 8)
+            target.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import tempfile
+import unittest
+
+from whisperchain.storage.engine import open_engine, set_engine
+
+class TempEngineTestCase(unittest.TestCase):
+    """
+    Test case run against a fresh storage engine in a temporary directory.
+
+    setUp opens the engine as ``self.engine`` on ``self.tmp`` and makes it
+    the process-wide engine; tearDown restores the previous engine, closes
+    this one and removes the directory. Subclasses choose the engine with
+    the class attributes below and call ``super()`` when they extend setUp
+    or tearDown.
+    """
+    backend = "json"
+    codec = None
+    cache = False
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = open_engine(self.backend, self.tmp.name, cache=self.cache, codec=self.codec)
+        self.previous = set_engine(self.engine)
+
+    def tearDown(self):
+        set_engine(self.previous)
+        self.engine.close()
+        self.tmp.cleanup()
@@ -1,86 +1,152 @@
-import json
-import secrets
+import os
+import threading
 import time
-from pathlib import Path
 from typing import Optional
 
-TOKENS_DB = Path(__file__).parent.parent / 'db' / 'tokens.json'
+from whisperchain.metrics.instrument import timed
+from whisperchain.storage.engine import DB_DIR, get_engine, retry_on_conflict
 
-def _ensure_tokens_db():
-    """Ensure the tokens database file exists."""
-    TOKENS_DB.parent.mkdir(exist_ok=True)
-    if not TOKENS_DB.exists():
-        with open(TOKENS_DB, 'w') as f:
-            json.dump({
-                'tokens': {},
-                'issued': {}
-            }, f)
+TOKENS_DB = DB_DIR / 'tokens.json'
 
-def generate_token(username: str) -> str:
-    """Generate a new anonymous token for a user."""
-    _ensure_tokens_db()
-    
-    # Load existing tokens
-    with open(TOKENS_DB, 'r') as f:
-        data = json.load(f)
-    
-    # Check if user already has an unused token
-    for token, info in data['tokens'].items():
-        if info['username'] == username and not info['used']:
-            return token
-    
-    # Generate new token
-    token = secrets.token_urlsafe(32)
+# Seconds a token stays valid after it is issued
+TOKEN_TTL = int(os.environ.get('WHISPERCHAIN_TOKEN_TTL', 24 * 60 * 60))
+
+# Seconds between runs of the background token sweeper
+SWEEP_INTERVAL = 5 * 60
+
+def _is_expired(token_info: dict, now: int) -> bool:
+    # Tokens issued before expiry was introduced have no expires_at and do not expire
+    expires_at = token_info.get('expires_at')
+    return expires_at is not None and expires_at <= now
+
+@timed('tokens.generate_token')
+@retry_on_conflict
+def generate_token(username: str, ttl: int = None) -> str:
+    """
+    Generate a new anonymous token for a user.
+    Args:
+        username: The user the token is issued to
+        ttl: Seconds until the token expires (defaults to TOKEN_TTL)
+    Returns:
+        str: An unexpired unused token, reusing one the user already holds
+    """
+    engine = get_engine()
     timestamp = int(time.time())
-    
-    # Store token
-    data['tokens'][token] = {
-        'username': username,
-        'created_at': timestamp,
-        'used': False
-    }
-    
-    # Log issuance
-    data['issued'][timestamp] = {
-        'username': username,
-        'token': token
-    }
-    
-    # Save updated data
-    with open(TOKENS_DB, 'w') as f:
-        json.dump(data, f, indent=4)
+    with engine.transaction():
+        # Check if user already has an unused token
+        token = engine.find_unused_token(username, now=timestamp)
+        if token is not None:
+            return token
+        
+        # Claim a pre-minted token and bind it to the user
+        token = _issue(engine, username, 1, timestamp, ttl)[0]
     
     return token
 
+@timed('tokens.generate_tokens')
+@retry_on_conflict
+def generate_tokens(username: str, n: int, ttl: int = None) -> list:
+    """
+    Issue several new anonymous tokens to a user in one round-trip.
+    Args:
+        username: The user the tokens are issued to
+        n: Number of tokens to issue
+        ttl: Seconds until the tokens expire (defaults to TOKEN_TTL)
+    Returns:
+        list: The new tokens
+    """
+    if n < 1:
+        raise ValueError("Number of tokens must be at least 1")
+    engine = get_engine()
+    with engine.transaction():
+        return _issue(engine, username, n, int(time.time()), ttl)
+
+def _issue(engine, username: str, n: int, timestamp: int, ttl: Optional[int]) -> list:
+    """Claim ``n`` tokens from the pool and store them for a user."""
+    from whisperchain.tokens.pool import get_pool
+    pool = get_pool(engine.db_dir)
+    tokens = []
+    while len(tokens) < n:
+        for token in pool.claim(n - len(tokens)):
+            # Store token
+            try:
+                engine.add_token(token, {
+                    'username': username,
+                    'created_at': timestamp,
+                    'expires_at': timestamp + (TOKEN_TTL if ttl is None else ttl),
+                    'used': False
+                })
+            except ValueError:
+                # A token on record, outstanding or archived, was issued before
+                # a crash rolled the pool's cursor back; never hand it out again
+                continue
+            tokens.append(token)
+    for token in tokens:
+        # Log issuance
+        engine.log_issuance(timestamp, {
+            'username': username,
+            'token': token
+        })
+    return tokens
+
 def validate_token(token: str) -> Optional[str]:
     """Validate a token and return the associated username if valid."""
-    if not TOKENS_DB.exists():
-        return None
-    
-    with open(TOKENS_DB, 'r') as f:
-        data = json.load(f)
-    
-    if token not in data['tokens']:
+    token_info = get_engine().get_token(token)
+    if token_info is None:
         return None
     
-    token_info = data['tokens'][token]
-    if token_info['used']:
+    if token_info['used'] or _is_expired(token_info, int(time.time())):
         return None
     
     return token_info['username']
 
 def mark_token_used(token: str) -> None:
     """Mark a token as used."""
-    if not TOKENS_DB.exists():
-        raise ValueError("Tokens database does not exist")
-    
-    with open(TOKENS_DB, 'r') as f:
-        data = json.load(f)
-    
-    if token not in data['tokens']:
+    if not get_engine().set_token_used(token):
         raise ValueError("Invalid token")
+
+def consume_token(token: str, username: str) -> None:
+    """
+    Validate a token and mark it used in one atomic step.
+    Args:
+        token: The anonymous token to spend
+        username: The user the token must belong to
+    Raises:
+        ValueError: If the token is invalid, expired, already used or not the user's
+    """
+    if not get_engine().consume_token(token, username, int(time.time())):
+        raise ValueError("Invalid or already used token")
+
+def archive_used_tokens() -> int:
+    """
+    Move used tokens out of the set of outstanding tokens.
+    Returns:
+        int: The number of tokens archived
+    """
+    return get_engine().sweep_tokens()
+
+@timed('tokens.sweep_tokens')
+def sweep_tokens(now: int = None) -> int:
+    """
+    Archive used and expired tokens so the outstanding set stays small.
+    Args:
+        now: The time to check expiry against (defaults to the current time)
+    Returns:
+        int: The number of tokens archived
+    """
+    return get_engine().sweep_tokens(int(time.time()) if now is None else now)
+
+def start_token_sweeper(interval: int = SWEEP_INTERVAL) -> threading.Event:
+    """
+    Run sweep_tokens every ``interval`` seconds in a daemon thread.
+    Returns:
+        threading.Event: Set it to stop the sweeper
+    """
+    stop = threading.Event()
     
-    data['tokens'][token]['used'] = True
+    def run():
+        while not stop.wait(interval):
+            sweep_tokens()
     
-    with open(TOKENS_DB, 'w') as f:
-        json.dump(data, f, indent=4) 
\ No newline at end of file
+    threading.Thread(target=run, name='token-sweeper', daemon=True).start()
+    return stop
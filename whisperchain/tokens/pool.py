@@ -0,0 +1,155 @@
+import base64
+import os
+import secrets
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; the in-process lock still applies
+    fcntl = None
+
+POOL_FILE = 'token_pool.bin'
+
+# Tokens minted per refill, and the level below which a background refill starts
+POOL_BATCH_SIZE = 1024
+POOL_LOW_WATER = 256
+
+# Raw random bytes per token, matching secrets.token_urlsafe(32)
+TOKEN_BYTES = 32
+
+# magic, version, slot size, slot count, next free slot
+HEADER = struct.Struct('<4sHHII')
+MAGIC = b'WCTP'
+VERSION = 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+class TokenPool:
+    """
+    File of pre-minted anonymous tokens.
+
+    Tokens are stored as fixed-size slots of raw random bytes after a small
+    header holding the slot count and the next free slot. Claiming a token
+    reads the slot at the cursor and advances it; tokens are minted in
+    batches, in a background thread once the pool runs low.
+    """
+
+    def __init__(self, path, batch_size: int = POOL_BATCH_SIZE, low_water: int = POOL_LOW_WATER):
+        """
+        Args:
+            path: The pool file
+            batch_size: Number of tokens minted per refill
+            low_water: Remaining tokens below which a background refill starts
+        """
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self._refilling = False
+
+    @contextmanager
+    def _locked(self):
+        """Hold the pool's cross-process lock."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_suffix('.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _read_header(self) -> tuple[int, int]:
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return 0, 0
+        if len(header) < HEADER.size:
+            return 0, 0
+        magic, version, slot_size, count, cursor = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or slot_size != TOKEN_BYTES:
+            raise ValueError(f"Unsupported token pool file: {self.path}")
+        return count, cursor
+
+    def _refill(self, count: int, cursor: int, minimum: int = 0) -> tuple[int, int]:
+        """Drop claimed slots and append a fresh batch. Returns the new (count, cursor)."""
+        remaining = b''
+        if count > cursor:
+            with open(self.path, 'rb') as f:
+                f.seek(HEADER.size + cursor * TOKEN_BYTES)
+                remaining = f.read((count - cursor) * TOKEN_BYTES)
+        data = remaining + secrets.token_bytes(max(self.batch_size, minimum) * TOKEN_BYTES)
+        count = len(data) // TOKEN_BYTES
+
+        # Write a new file and rename it over the old one so a crash mid-refill
+        # leaves the previous pool intact
+        tmp = self.path.with_suffix('.tmp')
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, TOKEN_BYTES, count, 0) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return count, 0
+
+    def claim(self, n: int = 1) -> list:
+        """
+        Claim the next ``n`` free tokens.
+        Returns:
+            list: The claimed tokens, encoded like secrets.token_urlsafe(32)
+        """
+        with self._lock, self._locked():
+            count, cursor = self._read_header()
+            if count - cursor < n:
+                count, cursor = self._refill(count, cursor, minimum=n)
+            with open(self.path, 'r+b') as f:
+                f.seek(HEADER.size + cursor * TOKEN_BYTES)
+                raw = f.read(n * TOKEN_BYTES)
+                cursor += n
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, VERSION, TOKEN_BYTES, count, cursor))
+                # The cursor must reach the disk before the tokens are handed
+                # out, or a crash could roll it back and issue them again
+                f.flush()
+                os.fsync(f.fileno())
+            remaining = count - cursor
+        if remaining < self.low_water:
+            self._refill_in_background()
+        return [_encode(raw[i:i + TOKEN_BYTES]) for i in range(0, len(raw), TOKEN_BYTES)]
+
+    def available(self) -> int:
+        """Return the number of unclaimed tokens."""
+        with self._lock, self._locked():
+            count, cursor = self._read_header()
+        return count - cursor
+
+    def refill(self) -> None:
+        """Mint a batch of tokens now."""
+        with self._lock, self._locked():
+            self._refill(*self._read_header())
+
+    def _refill_in_background(self) -> None:
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+
+        def run():
+            try:
+                self.refill()
+            finally:
+                self._refilling = False
+
+        threading.Thread(target=run, name='token-pool-refill', daemon=True).start()
+
+def get_pool(db_dir) -> TokenPool:
+    """Return the shared token pool for a data directory."""
+    path = Path(db_dir) / POOL_FILE
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = TokenPool(path)
+        return _pools[path]
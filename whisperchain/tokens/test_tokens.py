@@ -1,6 +1,10 @@
 import unittest
-from whisperchain.tokens.generate import generate_token, validate_token
+import tempfile
+import time
+from whisperchain.tokens.generate import generate_token, generate_tokens, validate_token, mark_token_used, sweep_tokens
+from whisperchain.tokens.pool import HEADER, POOL_FILE, TokenPool
 from whisperchain.auth.register import register_user
+from whisperchain.storage.testing import TempEngineTestCase
 
 class TestTokens(unittest.TestCase):
     def setUp(self):
@@ -44,5 +48,85 @@ class TestTokens(unittest.TestCase):
         # Second use should be invalid
         self.assertIsNone(validate_token(token))
 
+class TestTokenExpiry(TempEngineTestCase):
+    def test_expired_token_is_invalid_and_replaced(self):
+        token = generate_token("testuser", ttl=0)
+        self.assertIsNone(validate_token(token))
+        fresh = generate_token("testuser")
+        self.assertNotEqual(fresh, token)
+        self.assertEqual(validate_token(fresh), "testuser")
+
+    def test_sweep_archives_used_and_expired_tokens(self):
+        expired = generate_token("expired", ttl=0)
+        used = generate_token("used")
+        mark_token_used(used)
+        live = generate_token("live")
+        self.assertEqual(sweep_tokens(), 2)
+        self.assertIsNone(self.engine.get_token(expired))
+        self.assertIsNone(self.engine.get_token(used))
+        self.assertEqual(validate_token(live), "live")
+        self.assertEqual(len(list(self.engine.iter_tokens())), 3)
+        self.assertEqual(sweep_tokens(now=int(time.time()) + 10 ** 6), 1)
+
+    def test_issuance_log_keeps_every_token(self):
+        tokens = [generate_token(f"user{i}") for i in range(3)]
+        issued = [record["token"] for _, record in self.engine.iter_issued()]
+        self.assertEqual(issued, tokens)
+
+    def test_generate_tokens_bulk(self):
+        tokens = generate_tokens("bulkuser", 5)
+        self.assertEqual(len(set(tokens)), 5)
+        for token in tokens:
+            self.assertEqual(validate_token(token), "bulkuser")
+            self.assertEqual(len(token), 43)
+        with self.assertRaises(ValueError):
+            generate_tokens("bulkuser", 0)
+
+    def test_rolled_back_pool_never_reissues(self):
+        token = generate_token("alice")
+        # A crash that lost the cursor update hands out the same slot again
+        self._rewind_pool(1)
+        fresh = generate_token("bob")
+        self.assertNotEqual(fresh, token)
+        self.assertEqual(validate_token(token), "alice")
+        self.assertEqual(validate_token(fresh), "bob")
+
+    def _rewind_pool(self, slots):
+        path = self.engine.db_dir / POOL_FILE
+        with open(path, "r+b") as f:
+            magic, version, slot_size, count, cursor = HEADER.unpack(f.read(HEADER.size))
+            f.seek(0)
+            f.write(HEADER.pack(magic, version, slot_size, count, cursor - slots))
+
+    def test_rolled_back_pool_never_reissues_archived_tokens(self):
+        swept = generate_token("alice")
+        mark_token_used(swept)
+        self.assertEqual(sweep_tokens(), 1)
+        self.assertIsNone(self.engine.get_token(swept))
+        self._rewind_pool(1)
+        fresh = generate_tokens("bob", 2)
+        self.assertNotIn(swept, fresh)
+        self.assertEqual(len(set(fresh)), 2)
+        self.assertIsNone(self.engine.get_token(swept))
+
+class TestTokenPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_claim_and_refill(self):
+        pool = TokenPool(f"{self.tmp.name}/pool.bin", batch_size=4, low_water=0)
+        self.assertEqual(pool.available(), 0)
+        first = pool.claim(3)
+        self.assertEqual(pool.available(), 1)
+        second = pool.claim(3)
+        self.assertEqual(len(set(first + second)), 6)
+        self.assertEqual(pool.available(), 2)
+        reopened = TokenPool(f"{self.tmp.name}/pool.bin", batch_size=4, low_water=0)
+        self.assertEqual(reopened.available(), 2)
+        self.assertNotIn(reopened.claim()[0], first + second)
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file